@@ -0,0 +1,234 @@
+from collections import defaultdict
+from collections.abc import Collection
+from contextlib import nullcontext
+from heapq import heappop, heappush, heapify
+from itertools import count
+from pathlib import Path
+from pydantic import AnyUrl
+import anyio
+from . import config, docker
+from .mirrors import git_mirrors
+from .services.docker_engine import split_image
+from .services.metrics import Gauge
+from .services.registry import Registry
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def registry_reference(image: str) -> tuple[str, str]:
+    # Repository without the registry host and tag of a pushed image
+    name, tag = split_image(image)
+    return name.split("/", 1)[1], tag
+
+
+def immutable_tag(tags: list[str]) -> str | None:
+    # git-<hash> never moves, ref tags can be repointed by later builds and retags
+    return next((tag for tag in tags if split_image(tag)[1].startswith("git-")), None)
+
+
+class InflightBuild:
+    def __init__(self, tags: list[str], push: bool):
+        self.tags = tags
+        self.push = push
+        self.done = anyio.Event()
+        self.result: tuple[str, str, int] | None = None
+        self.error: BaseException | None = None
+
+
+class BuildQueue:
+    def __init__(self):
+        self._running: dict[str, int] = defaultdict(int)
+        self._waiting: dict[str, list[tuple[int, int, anyio.Event]]] = defaultdict(list)
+        self._inflight: dict[tuple[str, str], InflightBuild] = {}
+        self._seq = count()
+        self._last_builder: dict[str, str] = {}  # affinity key (repo url) -> builder
+        self._unreachable: dict[str, float] = {}  # builder -> skipped until
+        self._infos: dict[str, dict] = {}  # builder -> docker info
+        self._probed: dict[str, float] = {}
+
+    def limit(self, builder: str) -> int:
+        return config.settings.build.builder_limits.get(
+            builder, config.settings.build.max_concurrent_builds
+        )
+
+    async def _acquire(self, builder: str, priority: int):
+        if self._running[builder] < self.limit(builder) and not self._waiting[builder]:
+            self._running[builder] += 1
+            return
+
+        entry = (priority, next(self._seq), anyio.Event())
+        heappush(self._waiting[builder], entry)
+        try:
+            await entry[2].wait()
+        except BaseException:
+            if entry[2].is_set():  # slot was already handed over
+                self._release(builder)
+            else:
+                self._waiting[builder].remove(entry)
+                heapify(self._waiting[builder])
+            raise
+
+    def _release(self, builder: str):
+        if self._waiting[builder]:
+            # Hand the slot over to the most important waiting build
+            heappop(self._waiting[builder])[2].set()
+        else:
+            self._running[builder] -= 1
+
+    def load(self, builder: str) -> float:
+        return (self._running[builder] + len(self._waiting[builder])) / self.limit(builder)
+
+    async def reachable(self, builder: str) -> bool:
+        try:
+            info, stderr, code = await docker.get_info(builder)
+        except Exception as e:
+            info, code = None, 1
+            logger.debug(f"Failed to probe builder {builder}: {e}")
+        self._probed[builder] = anyio.current_time()
+        if code:
+            self._unreachable[builder] = (
+                anyio.current_time() + config.settings.build.unreachable_backoff
+            )
+            return False
+        self._unreachable.pop(builder, None)
+        self._infos[builder] = info  # type: ignore
+        return True
+
+    async def probe(self, builders: list[str]):
+        interval = config.settings.build.probe_interval
+        async with anyio.create_task_group() as tg:
+            for builder in builders:
+                if anyio.current_time() - self._probed.get(builder, -interval) >= interval:  # type: ignore
+                    tg.start_soon(self.reachable, builder)
+
+    async def choose(
+        self, builders: list[str], affinity: str | None = None, tried: Collection[str] = ()
+    ) -> str:
+        if len(builders) == 1:
+            return builders[0]
+        if config.settings.build.probe_interval is not None:
+            await self.probe(builders)
+        candidates = [builder for builder in builders if builder not in tried] or builders
+        now = anyio.current_time()
+        # All unreachable, try them anyway
+        candidates = [
+            builder for builder in candidates if self._unreachable.get(builder, 0) <= now
+        ] or candidates
+
+        last = self._last_builder.get(affinity)  # type: ignore
+        if config.settings.build.cache_locality and last in candidates and self.load(last) < 1:  # type: ignore
+            return last  # type: ignore
+
+        def capacity(builder: str) -> tuple[float, int, int]:
+            info = self._infos.get(builder, {})
+            return (self.load(builder), -info.get("NCPU", 0), -info.get("MemTotal", 0))
+
+        return min(candidates, key=capacity)
+
+    async def build_image(
+        self,
+        tags: list[str],
+        build_context: AnyUrl | Path | str,
+        docker_context: str | list[str] = "default",
+        docker_file: Path | None = None,
+        push: bool = False,
+        dry_run: bool = False,
+        cache_from: list[str] | None = None,
+        cache_to: str | None = None,
+        cache_mode: str = "max",
+        priority: int = 0,
+        affinity: str | None = None,
+        registry: Registry | None = None,
+    ):
+        builders = [docker_context] if isinstance(docker_context, str) else docker_context
+        key = (str(build_context), str(docker_file))
+        while build := self._inflight.get(key):
+            logger.info(f"Waiting for in-flight build of {build_context} ({build.tags[0]})")
+            await build.done.wait()
+            if build.error:
+                raise build.error
+            missing = [tag for tag in tags if tag not in build.tags]
+            if not missing:
+                return build.result
+            if push and build.push and registry and (source := immutable_tag(build.tags)):
+                # Pushed once, the other tags point at the same manifest
+                await self.add_tags(registry, source, missing)
+                return build.result
+            # Same source but other tags, build again on a warm cache
+
+        build = self._inflight[key] = InflightBuild(tags, push)
+        try:
+            # Checked out once, whichever builder ends up building it
+            async with nullcontext() if dry_run else git_mirrors.checkout(build_context) as source:
+                tried: list[str] = []
+                while True:
+                    builder = await self.choose(builders, affinity, tried)
+                    tried.append(builder)
+                    await self._acquire(builder, priority)
+                    try:
+                        build.result = await docker.build_image(
+                            tags,
+                            build_context,
+                            builder,
+                            docker_file,
+                            push,
+                            dry_run,
+                            cache_from,
+                            cache_to,
+                            cache_mode,
+                            source,
+                        )
+                    except Exception:
+                        # Only an unreachable builder hands its build over, failed builds stay failed
+                        if len(tried) < len(builders) and not await self.reachable(builder):
+                            logger.warning(f"Builder {builder} unreachable, failing over build of {tags[0]}")
+                            continue
+                        raise
+                    finally:
+                        self._release(builder)
+                    if affinity:
+                        self._last_builder[affinity] = builder
+                    return build.result
+        except BaseException as e:
+            build.error = (
+                e if isinstance(e, Exception) else Exception(f"Build of {tags[0]} cancelled")
+            )
+            raise
+        finally:
+            del self._inflight[key]
+            build.done.set()
+
+    async def add_tags(self, registry: Registry, source: str, tags: list[str]):
+        from_repository, from_tag = registry_reference(source)
+        async with anyio.create_task_group() as tg:
+            for tag in tags:
+                repository, new_tag = registry_reference(tag)
+                tg.start_soon(registry.retag, repository, from_tag, new_tag, from_repository)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            builder: {
+                "running": self._running[builder],
+                "waiting": len(self._waiting[builder]),
+                "limit": self.limit(builder),
+                "unreachable": int(self._unreachable.get(builder, 0) > anyio.current_time()),
+            }
+            for builder in self._running.keys() | self._waiting.keys()
+        }
+
+
+build_queue = BuildQueue()
+
+Gauge(
+    "whalesbook_builds_in_flight",
+    "Builds running on each builder",
+    ("builder",),
+    lambda: {(builder,): running for builder, running in build_queue._running.items()},
+)
+Gauge(
+    "whalesbook_builds_queued",
+    "Builds waiting for a slot on each builder",
+    ("builder",),
+    lambda: {(builder,): len(waiting) for builder, waiting in build_queue._waiting.items()},
+)
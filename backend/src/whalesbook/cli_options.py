@@ -3,6 +3,8 @@ from anyio import sleep, run
 from . import config
 from .services import registry
 from . import state
+from .services.cli_runner import process_limiter
+from .store import store
 from .schedule import schedule_books
 from .server import router, fastapi_options
 from uvicorn import run as uvrun
@@ -23,6 +25,10 @@ class Options:
 
         logger.info(f"Using config file {self.config_file.resolve()}")
         config.settings = config.Settings.from_yaml(Path(config_file))
+        if config.settings.state_file:
+            store.open(config.settings.state_file)
+        process_limiter.total_tokens = config.settings.process.max_processes
+        state.book_limiter.total_tokens = config.settings.schedule.max_concurrent_books
 
     async def test_log(self):
         logger.info("info")
@@ -56,8 +62,7 @@ class Options:
 
         async def update(self, force: bool = False):
             reg = await registry.create_registry(config.settings.docker_registry)  # type: ignore
-            for book in self.books:
-                await state.update_book(reg, book, force)
+            await state.update_books(reg, self.books, force)
 
         async def stop_containers(self):
             reg = await registry.create_registry(config.settings.docker_registry)  # type: ignore
@@ -1,17 +1,58 @@
-from pydantic import BaseModel, field_validator, model_validator
+from pydantic import BaseModel, PrivateAttr, field_validator, model_validator
 from pathlib import Path
 from pydantic_settings import (
     BaseSettings,
     YamlConfigSettingsSource,
 )
 import re
+from fnmatch import translate
 from .services.registry import RegistryConfig
-from typing import Any
+from typing import Any, Literal
+
+
+DEFAULT_BRANCHES = ("refs/heads/main", "refs/heads/master")
+
+
+def parse_size(size: str) -> int:
+    # Docker CLI sizes: bytes, or a number with b, k, m or g
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([bkmg]?)b?", size.strip().lower())
+    if not match:
+        raise ValueError(f"Invalid size {size}")
+    return int(float(match[1]) * 1024 ** "bkmg".index(match[2] or "b"))
+
+
+class ResourceLimits(BaseModel):
+    cpus: float | None = None
+    memory: str | None = None  # docker size, e.g. 512m or 2g
+    memory_reservation: str | None = None  # soft limit enforced under memory pressure
+    pids: int | None = None
+
+    @field_validator("memory", "memory_reservation")
+    @classmethod
+    def validate_size(cls, size: str | None):
+        if size is not None:
+            parse_size(size)
+        return size
+
+    def merge(self, override: "ResourceLimits | None") -> "ResourceLimits":
+        if not override:
+            return self
+        return self.model_copy(update=override.model_dump(exclude_none=True))
+
+    def to_label(self) -> str:
+        # Container labels are listed comma separated
+        return ";".join(f"{k}={v}" for k, v in self.model_dump(exclude_none=True).items())
+
+    @classmethod
+    def from_label(cls, label: str) -> "ResourceLimits":
+        return cls.model_validate(dict(item.split("=", maxsplit=1) for item in label.split(";") if item))
 
 
 class Ref(BaseModel):
     name: str
     subdomain_name: str | None = None
+    priority: int | None = None  # build order, lower first; main/master default to 0
+    resources: ResourceLimits | None = None  # overrides the book's limits
 
     @model_validator(mode="after")
     def serialize_names(self):
@@ -26,13 +67,33 @@ class Ref(BaseModel):
             self.name if self.name.startswith("refs/") else f"refs/heads/{self.name}"
         )
 
+        if self.priority is None:
+            self.priority = 0 if self.name in DEFAULT_BRANCHES else 100
+
         return self
 
+    @property
+    def is_pattern(self):
+        return any(char in self.name for char in "*?[")
+
+    def expand(self, ref_name: str):
+        # Concrete ref matched by this pattern, with its own subdomain name
+        return Ref.model_validate(
+            {
+                **self.model_dump(exclude={"name", "subdomain_name"}),
+                "name": ref_name.removeprefix("refs/heads/"),
+            }
+        )
+
 
 class Repo(BaseModel):
     name: str
     url: str = "https://github.com/username/repo.git"  # End with .git
-    refs: list[Ref] = [Ref(name="main")]  # default to refs/heads/<name>; full ref `refs/xxx/...`
+    refs: list[Ref] = [Ref(name="main")]  # default to refs/heads/<name>; full ref `refs/xxx/...`, globs allowed
+
+    _exact_refs: dict[str, Ref] = PrivateAttr(default_factory=dict)
+    _pattern_refs: list[Ref] = PrivateAttr(default_factory=list)
+    _pattern_matcher: re.Pattern | None = PrivateAttr(default=None)
 
     @field_validator("refs", mode="before")
     @classmethod
@@ -45,6 +106,34 @@ class Repo(BaseModel):
         ]
         return new_refs
 
+    @model_validator(mode="after")
+    def compile_refs(self):
+        self._exact_refs = {ref.name: ref for ref in self.refs if not ref.is_pattern}
+        self._pattern_refs = [ref for ref in self.refs if ref.is_pattern]
+        self._pattern_matcher = (
+            re.compile(
+                "|".join(
+                    f"(?P<p{i}>{translate(ref.name)})"
+                    for i, ref in enumerate(self._pattern_refs)
+                )
+            )
+            if self._pattern_refs
+            else None
+        )
+        return self
+
+    def match_ref(self, ref_name: str) -> Ref | None:
+        if ref_name in self._exact_refs:
+            return self._exact_refs[ref_name]
+        if self._pattern_matcher and (match := self._pattern_matcher.match(ref_name)):
+            return self._pattern_refs[int(match.lastgroup[1:])].expand(ref_name)  # type: ignore
+        return None
+
+    @property
+    def default_ref(self) -> Ref | None:
+        refs = [ref for ref in self.refs if not ref.is_pattern]
+        return min(refs, key=lambda ref: ref.priority) if refs else None  # type: ignore
+
 
 class TraefikConfig(BaseModel):
     base_domain: str = "localhost"
@@ -52,16 +141,40 @@ class TraefikConfig(BaseModel):
     cert_resolver: str = "myresolver"
 
 
+class ReadinessConfig(BaseModel):
+    check: Literal["http", "healthcheck", "tcp"] = "http"  # http and tcp use traefik_config.port
+    path: str = "/"
+    command: str | None = None  # health command run in the container instead of the http or tcp probe
+    timeout: float = 120  # seconds before the swap is aborted
+    interval: float = 2
+    probe_timeout: float | None = None  # seconds one probe may take, defaults to min(interval, 5)
+    drain: float = 5  # seconds the old container keeps serving after the new one is ready
+
+
+class IdleConfig(BaseModel):
+    timeout: float = 1800  # seconds without requests before a ref container is stopped
+
+
+class BuildCacheConfig(BaseModel):
+    repository_suffix: str = "-buildcache"  # <name_registry><suffix>:<subdomain_name>
+    mode: Literal["min", "max"] = "max"
+
+
 class Book(BaseModel):
     name: str
     name_registry: str = ""  # library/default_book, as docker image name
     repos: list[Repo] = [Repo(name="main")]
     docker_file: Path | None = None
-    builder: str = "default"  # existing docker context
-    runner: str = "default"
+    builder: str | list[str] = "default"  # existing docker context, or a pool builds are dispatched across
+    runner: str | list[str] = "default"  # one context, or a pool ref containers are spread across
+    placement: Literal["least_containers", "most_free_memory", "sticky"] = "sticky"
     traefik_config: TraefikConfig | None = TraefikConfig()
     custom_labels: list[str] = []
     docker_network: str | None = None
+    build_cache: BuildCacheConfig | None = None  # registry cache, needs a buildx builder supporting cache export
+    readiness: ReadinessConfig | None = None  # gate container swaps on a readiness check
+    idle: IdleConfig | None = None  # stop containers without traffic, woken by their next request
+    resources: ResourceLimits = ResourceLimits()  # limits of every ref container
 
     @model_validator(mode="after")
     def serialize_name(self):
@@ -71,31 +184,106 @@ class Book(BaseModel):
             )
         return self
 
+    @field_validator("builder", "runner")
+    @classmethod
+    def validate_pool(cls, contexts: str | list[str]):
+        if isinstance(contexts, list) and not contexts:
+            raise ValueError("docker context pool is empty")
+        return contexts
+
+    @property
+    def builders(self) -> list[str]:
+        return [self.builder] if isinstance(self.builder, str) else self.builder
+
+    @property
+    def runners(self) -> list[str]:
+        return [self.runner] if isinstance(self.runner, str) else self.runner
+
     # TODO builder and runner validation
 
 
+class GitConfig(BaseModel):
+    max_concurrent_remotes: int = 8  # parallel ls-remote calls
+    ref_cache_ttl: float = 60  # seconds, 0 only coalesces concurrent lookups
+    mirror_dir: Path | None = None  # bare mirrors builds check out from, relative to config_dir
+    mirror_refs: bool = False  # fetch the mirrors for ref lookups instead of ls-remote
+    mirror_timeout: float = 1800  # seconds, first clones of large repos take a while
+
+
+class BuildConfig(BaseModel):
+    max_concurrent_builds: int = 2  # per builder context
+    builder_limits: dict[str, int] = {}  # context name -> limit override
+    log_lines: int = 1000  # recent output lines kept per build
+    cache_locality: bool = True  # builds of a repo go to the pooled builder that last built it
+    probe_interval: float | None = None  # seconds between docker info probes of pooled builders
+    unreachable_backoff: float = 60  # seconds an unreachable builder gets no builds
+
+
+class ProcessConfig(BaseModel):
+    max_processes: int = 16  # child processes at once across all books
+    git_timeout: float = 60  # seconds, ls-remote
+    docker_timeout: float = 300  # docker CLI and Engine API calls other than builds, pulls included
+    build_timeout: float = 3600
+
+
+class SnapshotConfig(BaseModel):
+    resync_interval: float = 300  # seconds between full refreshes besides docker events
+
+
+class WebhookConfig(BaseModel):
+    secret: str  # HMAC key for GitHub and Gitea, token for GitLab
+
+
 class SchedulerConfig(BaseModel):
     cron: str = "*/5 * * * *"
+    spread: float | None = None  # seconds books are staggered over, defaults to the cron interval
+    max_concurrent_books: int = 4
+
+
+class TraefikMetricsConfig(BaseModel):
+    url: str = "http://traefik:8080/metrics"  # prometheus metrics with service labels
+    interval: float = 60  # seconds between scrapes for idle books
 
 
 class Settings(BaseSettings):
     config_dir: Path = Path("config")
     docker_exec_name: str = "docker"
+    docker_backend: Literal["api", "cli"] = "api"  # api falls back to cli for ssh contexts
 
     # TODO setup contexts
     docker_contexts: list[str] = ["default"]
 
     docker_registry: RegistryConfig | None = None
 
+    state_file: Path | None = Path("whalesbook.sqlite3")  # relative to config_dir, None keeps state in memory
+
     schedule: SchedulerConfig = SchedulerConfig()
 
+    git: GitConfig = GitConfig()
+
+    build: BuildConfig = BuildConfig()
+
+    process: ProcessConfig = ProcessConfig()
+
+    snapshot: SnapshotConfig = SnapshotConfig()
+
+    webhook: WebhookConfig | None = None  # POST /api/v1/webhook, disabled without a secret
+
+    traefik_metrics: TraefikMetricsConfig = TraefikMetricsConfig()
+
     books: list[Book] = [Book(name="default_book")]
 
+    _source: Path | None = PrivateAttr(default=None)  # yaml file, watched for reloads
+
     @model_validator(mode="after")
     def update_path(self):
         for book in self.books:
             if book.docker_file:
                 book.docker_file = self.config_dir / book.docker_file
+        if self.state_file:
+            self.state_file = self.config_dir / self.state_file
+        if self.git.mirror_dir:
+            self.git.mirror_dir = self.config_dir / self.git.mirror_dir
         return self
 
     # FIXME: https://github.com/pydantic/pydantic-settings/issues/259 (Why??)
@@ -103,9 +291,15 @@ class Settings(BaseSettings):
     def from_yaml(cls, path: Path | None = None):
         if not path:
             path = Path(cls().config_dir / "config.yml")
-        return cls(
+        settings = cls(
             **dict(YamlConfigSettingsSource(cls, path)(), config_dir=path.parent)
         )
+        settings._source = path
+        return settings
+
+    @property
+    def source(self) -> Path | None:
+        return self._source
 
 
 settings = Settings()
@@ -1,12 +1,40 @@
 from pydantic import AnyUrl
 from pathlib import Path
+from anyio.streams.text import TextReceiveStream
+from .services.build_log import BuildLog
 from .services.cli_runner import CliInstance
-from .config import settings, TraefikConfig
+from .services.docker_engine import DockerEngine, UnresolvedEngine, get_engine
+from . import config
+from .config import ResourceLimits, TraefikConfig, parse_size
+import anyio
 import logging
 from json import loads
 
 logger = logging.getLogger(__name__)
 
+build_logs: dict[str, BuildLog] = {}  # latest build of each main tag
+
+
+# Engine API client for the context, None to use the docker CLI
+def engine(docker_context: str) -> DockerEngine | UnresolvedEngine | None:
+    if config.settings.docker_backend != "api":
+        return None
+    credentials = None
+    registry = config.settings.docker_registry
+    if registry and registry.username and registry.password:
+        port_str = f":{registry.url.port}" if registry.url.port not in (80, 443) else ""
+        credentials = {
+            f"{registry.url.host}{port_str}": (registry.username, registry.password)
+        }
+    try:
+        docker_engine = get_engine(docker_context, credentials)
+    except Exception as e:
+        # Only this context fails, callers get the same result tuple as from the CLI
+        return UnresolvedEngine(f"Failed to resolve docker context {docker_context}: {e}")
+    if docker_engine:
+        docker_engine.timeout = config.settings.process.docker_timeout
+    return docker_engine
+
 
 async def build_image(
     tags: list[str],
@@ -15,19 +43,27 @@ async def build_image(
     docker_file: Path | None = None,
     push: bool = False,
     dry_run: bool = False,
+    cache_from: list[str] | None = None,
+    cache_to: str | None = None,
+    cache_mode: str = "max",
+    source: Path | None = None,  # local checkout of build_context
 ):
     default_labels = [
         f"whalesbook.main_tag={tags[0]}",
         f"whalesbook.git_tag={tags[1]}",
         f"whalesbook.build_context={build_context}",
     ]
+    if cache_from:
+        default_labels.append(f"whalesbook.cache_from={' '.join(cache_from)}")
 
-    cli = CliInstance()
+    # Always uses the CLI, BuildKit sessions are not exposed by the Engine REST API
+    cli = CliInstance(config.settings.process.build_timeout)
 
-    cli.add_arg(settings.docker_exec_name)
+    cli.add_arg(config.settings.docker_exec_name)
     cli.add_arg("--context", docker_context)
 
     cli.add_arg("build")  # buildx build
+    cli.add_arg("--progress", "plain")
     for label in default_labels:
         cli.add_arg("--label", label)
     for tag in tags:
@@ -36,25 +72,40 @@ async def build_image(
         cli.add_arg("--file", str(docker_file.absolute()))
     if push:
         cli.add_arg("--push")
+    for cache_ref in cache_from or []:
+        cli.add_arg("--cache-from", f"type=registry,ref={cache_ref}")
+    if cache_to:
+        cli.add_arg("--cache-to", f"type=registry,ref={cache_to},mode={cache_mode}")
 
-    cli.add_arg(str(build_context))
+    cli.add_arg(str(source or build_context))
 
     logger.debug(f'Building: "{" ".join(cli.commands)}"')
 
     logger.info(f"Building tag {tags[0]}")
-    stdout, stderr, code = "", "", 0
+    log = build_logs[tags[0]] = BuildLog(config.settings.build.log_lines)
     if not dry_run:
-        stdout, stderr, code = await cli.run()
-        if code:
-            logger.error(f"Failed to build tag {tags[0]}:\n{stderr}")
-            raise Exception(f"Failed to build tag {tags[0]}")
-    logger.info(f"Finished building tag {tags[0]}")
+        async for line in cli.stream():
+            log.append(line)
+    log.finish(cli.returncode or 0)
+    # Only the recent output is kept, BuildKit progress goes to stderr
+    stdout, stderr, code = "", "\n".join(log.lines), log.returncode or 0
+    if code:
+        logger.error(f"Failed to build tag {tags[0]}:\n{stderr}")
+        raise Exception(f"Failed to build tag {tags[0]}")
+    cached, steps = log.cache_stats
+    logger.info(f"Finished building tag {tags[0]} ({cached}/{steps} steps cached)")
     return stdout, stderr, code
 
 
 async def get_images(labels: list[str] | None = None, docker_context: str = "default"):
-    cli = CliInstance()
-    cli.add_arg(settings.docker_exec_name)
+    if docker_engine := engine(docker_context):
+        stdout, stderr, code = await docker_engine.get_images(labels)
+        if code:
+            logger.error(f"Failed to get images:\n{stderr}")
+        return stdout, stderr, code
+
+    cli = CliInstance(config.settings.process.docker_timeout)
+    cli.add_arg(config.settings.docker_exec_name)
     cli.add_arg("--context", docker_context)
 
     cli.add_arg("image")
@@ -74,8 +125,8 @@ async def get_images(labels: list[str] | None = None, docker_context: str = "def
 
 
 async def remove_images(identifiers: list[str], docker_context: str = "default"):
-    cli = CliInstance()
-    cli.add_arg(settings.docker_exec_name)
+    cli = CliInstance(config.settings.process.docker_timeout)
+    cli.add_arg(config.settings.docker_exec_name)
     cli.add_arg("--context", docker_context)
 
     cli.add_arg("image")
@@ -84,7 +135,10 @@ async def remove_images(identifiers: list[str], docker_context: str = "default")
         cli.add_arg(id)
 
     logger.info(f"Removing images {identifiers}")
-    stdout, stderr, code = await cli.run()
+    if docker_engine := engine(docker_context):
+        stdout, stderr, code = await docker_engine.remove_images(identifiers)
+    else:
+        stdout, stderr, code = await cli.run()
     if code:
         logger.error(f"Failed to remove image {identifiers}:\n{stderr}")
     logger.info(f"Removed images {identifiers} ({stdout})")
@@ -95,8 +149,14 @@ async def remove_images(identifiers: list[str], docker_context: str = "default")
 async def get_containers(
     labels: list[str] | None = None, docker_context: str = "default"
 ) -> tuple[list[dict] | str, str, int]:
-    cli = CliInstance()
-    cli.add_arg(settings.docker_exec_name)
+    if docker_engine := engine(docker_context):
+        stdout, stderr, code = await docker_engine.get_containers(labels)
+        if code:
+            logger.error(f"Failed to get containers:\n{stderr}")
+        return stdout, stderr, code
+
+    cli = CliInstance(config.settings.process.docker_timeout)
+    cli.add_arg(config.settings.docker_exec_name)
     cli.add_arg("--context", docker_context)
 
     cli.add_arg("container")
@@ -115,6 +175,90 @@ async def get_containers(
     return stdout, stderr, code
 
 
+async def container_events(
+    labels: list[str], events: list[str], docker_context: str = "default"
+):
+    # Runs until the connection to the daemon is lost
+    filters = {"type": ["container"], "event": events, "label": labels}
+    if docker_engine := engine(docker_context):
+        async for event in docker_engine.events(filters):
+            yield event
+        return
+
+    # Long-lived, so neither limited nor timed out like other commands
+    cli = CliInstance(timeout=None)
+    cli.add_arg(config.settings.docker_exec_name)
+    cli.add_arg("--context", docker_context)
+
+    cli.add_arg("events")
+    cli.add_arg("--format", "{{json .}}")
+    for key, values in filters.items():
+        for value in values:
+            cli.add_arg("--filter", f"{key}={value}")
+
+    async with await anyio.open_process(cli.commands) as proc:
+        buffer = ""
+        async for chunk in TextReceiveStream(proc.stdout):  # type: ignore
+            buffer += chunk
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                if line:
+                    yield loads(line)
+    raise Exception(f"docker events exited with code {proc.returncode}")
+
+
+async def inspect_container(identifier: str, docker_context: str = "default"):
+    if docker_engine := engine(docker_context):
+        stdout, stderr, code = await docker_engine.inspect_container(identifier)
+    else:
+        cli = CliInstance(config.settings.process.docker_timeout)
+        cli.add_arg(config.settings.docker_exec_name)
+        cli.add_arg("--context", docker_context)
+
+        cli.add_arg("container")
+        cli.add_arg("inspect")
+        cli.add_arg(identifier)
+
+        stdout, stderr, code = await cli.run()
+        if not code:
+            stdout = loads(stdout)[0]
+    if code:
+        logger.error(f"Failed to inspect container {identifier}:\n{stderr}")
+    return stdout, stderr, code
+
+
+async def get_info(docker_context: str = "default"):
+    if docker_engine := engine(docker_context):
+        stdout, stderr, code = await docker_engine.info()
+    else:
+        cli = CliInstance(config.settings.process.docker_timeout)
+        cli.add_arg(config.settings.docker_exec_name)
+        cli.add_arg("--context", docker_context)
+
+        cli.add_arg("info")
+        cli.add_arg("--format", "json")
+
+        stdout, stderr, code = await cli.run()
+        if not code:
+            stdout = loads(stdout)
+    if code:
+        logger.error(f"Failed to get info of docker context {docker_context}:\n{stderr}")
+    return stdout, stderr, code
+
+
+def resource_host_config(resources: ResourceLimits) -> dict:
+    host_config = {}
+    if resources.cpus is not None:
+        host_config["NanoCpus"] = int(resources.cpus * 1e9)
+    if resources.memory is not None:
+        host_config["Memory"] = parse_size(resources.memory)
+    if resources.memory_reservation is not None:
+        host_config["MemoryReservation"] = parse_size(resources.memory_reservation)
+    if resources.pids is not None:
+        host_config["PidsLimit"] = resources.pids
+    return host_config
+
+
 async def run_container(
     image: str,
     network: str | None = None,
@@ -123,9 +267,11 @@ async def run_container(
     labels: list[str] | None = None,
     pull: bool | None = True,
     docker_context: str = "default",
+    resources: ResourceLimits | None = None,
+    healthcheck: dict | None = None,  # engine API Healthcheck
 ):
-    cli = CliInstance()
-    cli.add_arg(settings.docker_exec_name)
+    cli = CliInstance(config.settings.process.docker_timeout)
+    cli.add_arg(config.settings.docker_exec_name)
     cli.add_arg("--context", docker_context)
 
     cli.add_arg("run")
@@ -144,22 +290,68 @@ async def run_container(
             cli.add_arg("--label", label)
     if pull is not None:
         cli.add_arg("--pull", "always" if pull else "never")
+    if resources:
+        if resources.cpus is not None:
+            cli.add_arg("--cpus", str(resources.cpus))
+        if resources.memory is not None:
+            cli.add_arg("--memory", resources.memory)
+        if resources.memory_reservation is not None:
+            cli.add_arg("--memory-reservation", resources.memory_reservation)
+        if resources.pids is not None:
+            cli.add_arg("--pids-limit", str(resources.pids))
+    if healthcheck:
+        cli.add_arg("--health-cmd", healthcheck["Test"][1])
+        cli.add_arg("--health-interval", f"{healthcheck['Interval']}ns")
+        cli.add_arg("--health-timeout", f"{healthcheck['Timeout']}ns")
+        cli.add_arg("--health-start-period", f"{healthcheck['StartPeriod']}ns")
+        cli.add_arg("--health-retries", str(healthcheck["Retries"]))
 
     cli.add_arg(image)
 
     logger.info(f"Starting container {image}")
-    stdout, stderr, code = await cli.run()
+    if docker_engine := engine(docker_context):
+        stdout, stderr, code = await docker_engine.run_container(
+            image,
+            network,
+            container_name,
+            restart,
+            labels,
+            pull,
+            resource_host_config(resources) if resources else None,
+            healthcheck,
+        )
+    else:
+        stdout, stderr, code = await cli.run()
     if code:
         logger.error(f"Failed to start container {image}:\n{stderr}")
     logger.info(f"Started container {image} ({stdout})")
     return stdout, stderr, code
 
 
+async def start_container(identifier: str, docker_context: str = "default"):
+    cli = CliInstance(config.settings.process.docker_timeout)
+    cli.add_arg(config.settings.docker_exec_name)
+    cli.add_arg("--context", docker_context)
+
+    cli.add_arg("container")
+    cli.add_arg("start")
+    cli.add_arg(identifier)
+
+    logger.info(f"Starting container {identifier}")
+    if docker_engine := engine(docker_context):
+        stdout, stderr, code = await docker_engine.start_container(identifier)
+    else:
+        stdout, stderr, code = await cli.run()
+    if code:
+        logger.error(f"Failed to start container {identifier}:\n{stderr}")
+    return stdout, stderr, code
+
+
 async def stop_container(
     identifier: str, docker_context: str = "default", remove: bool = True
 ):
-    cli = CliInstance()
-    cli.add_arg(settings.docker_exec_name)
+    cli = CliInstance(config.settings.process.docker_timeout)
+    cli.add_arg(config.settings.docker_exec_name)
     cli.add_arg("--context", docker_context)
 
     cli.add_arg("container")
@@ -167,7 +359,10 @@ async def stop_container(
     cli.add_arg(identifier)
 
     logger.info(f"Stopping container {identifier}")
-    stdout, stderr, code = await cli.run()
+    if docker_engine := engine(docker_context):
+        stdout, stderr, code = await docker_engine.stop_container(identifier)
+    else:
+        stdout, stderr, code = await cli.run()
     if code:
         logger.error(f"Failed to stop container {identifier}:\n{stderr}")
     logger.info(f"Stopped container {identifier} ({stdout})")
@@ -179,8 +374,8 @@ async def stop_container(
 
 
 async def remove_container(identifier: str, docker_context: str = "default"):
-    cli = CliInstance()
-    cli.add_arg(settings.docker_exec_name)
+    cli = CliInstance(config.settings.process.docker_timeout)
+    cli.add_arg(config.settings.docker_exec_name)
     cli.add_arg("--context", docker_context)
 
     cli.add_arg("container")
@@ -188,7 +383,10 @@ async def remove_container(identifier: str, docker_context: str = "default"):
     cli.add_arg(identifier)
 
     logger.info(f"Removing container {identifier}")
-    stdout, stderr, code = await cli.run()
+    if docker_engine := engine(docker_context):
+        stdout, stderr, code = await docker_engine.remove_container(identifier)
+    else:
+        stdout, stderr, code = await cli.run()
     if code:
         if stderr.startswith("Error response from daemon: No such container:"):
             logger.warning(f"No such container {identifier}")
@@ -0,0 +1,164 @@
+from collections import defaultdict
+from html import escape
+from httpx import AsyncClient
+import anyio
+import re
+from . import config, docker
+from .config import Book
+from .readiness import wait_ready
+from .state import MainTag, book_locks, get_containers_by_book, parse_labels
+from .store import store
+import logging
+
+logger = logging.getLogger(__name__)
+
+SERVICE_REQUESTS = re.compile(r"^traefik_service_requests_total\{([^}]*)\} (\S+)", re.M)
+
+HOLDING_PAGE = """<!doctype html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta http-equiv="refresh" content="{refresh}">
+<title>{message}</title>
+</head>
+<body style="font-family: sans-serif; text-align: center; margin-top: 20vh">
+<h1>{message}</h1>
+<p>{host}</p>
+</body>
+</html>
+"""
+
+
+def parse_service_requests(metrics: str) -> dict[str, float]:
+    # Requests per traefik service without provider, summed over codes, methods and protocols
+    requests: dict[str, float] = defaultdict(float)
+    for labels, value in SERVICE_REQUESTS.findall(metrics):
+        if service := re.search(r'service="([^"@]*)', labels):
+            requests[service[1]] += float(value)
+    return requests
+
+
+def find_idle_ref(books: list[Book], host: str) -> tuple[Book, str] | None:
+    # Book and subdomain name of a <subdomain>.<book>.<base_domain> host
+    host = host.split(":")[0].lower()
+    for book in books:
+        if not (book.idle and book.traefik_config):
+            continue
+        suffix = f".{book.name}.{book.traefik_config.base_domain}".lower()
+        subdomain_name = host.removesuffix(suffix)
+        if host.endswith(suffix) and subdomain_name and "." not in subdomain_name:
+            return book, subdomain_name
+    return None
+
+
+class IdleWatcher:
+    def __init__(self):
+        self._requests: dict[str, float] = {}  # traefik service -> request count
+        self._active: dict[str, float] = {}  # traefik service -> last time it had requests
+        self._waking: dict[tuple[str, str], anyio.Event] = {}
+        self.stopped = 0
+        self.woken = 0
+
+    async def scrape(self) -> dict[str, float]:
+        async with AsyncClient(timeout=10) as client:
+            resp = await client.get(config.settings.traefik_metrics.url)
+        resp.raise_for_status()
+        return parse_service_requests(resp.text)
+
+    async def check(self, books: list[Book]):
+        books = [book for book in books if book.idle and book.traefik_config]
+        if not books:
+            return
+        requests = await self.scrape()
+        now = anyio.current_time()
+        containers_by_book = await get_containers_by_book(
+            config.settings.docker_registry.url, books  # type: ignore
+        )
+        for book in books:
+            for container in containers_by_book.get(book.name, []):
+                if container["State"] != "running":
+                    continue
+                subdomain_name = MainTag.model_validate(
+                    parse_labels(container)["whalesbook.main_tag"]
+                ).subdomain_name
+                service = f"{book.name}--{subdomain_name}"
+                # First seen or new requests since the last scrape
+                if service not in self._active or requests.get(service) != self._requests.get(service):
+                    self._active[service] = now
+                    self._requests[service] = requests.get(service)  # type: ignore
+                elif now - self._active[service] >= book.idle.timeout:  # type: ignore
+                    await self.stop(book, subdomain_name, container)  # type: ignore
+
+    async def stop(self, book: Book, subdomain_name: str, container: dict):
+        lock = book_locks[book.name]
+        try:
+            # Left for the next check while the book is updating
+            lock.acquire_nowait()
+        except anyio.WouldBlock:
+            return
+        try:
+            logger.info(f"Stopping idle container {container['ID']} of {subdomain_name} in book {book.name}")
+            # Recorded first, reconciles keep idle containers stopped
+            store.record_idle(book.name, subdomain_name, container["ID"])
+            _, _, code = await docker.stop_container(
+                container["ID"], container["DockerContext"], remove=False
+            )
+            if code:
+                store.remove_idle(book.name, subdomain_name)
+                return
+            self._active.pop(f"{book.name}--{subdomain_name}", None)
+            self.stopped += 1
+        finally:
+            lock.release()
+
+    def is_idle(self, book: Book, subdomain_name: str) -> bool:
+        return (book.name, subdomain_name) in self._waking or subdomain_name in store.get_idle(
+            book.name
+        )
+
+    async def wake(self, book: Book, subdomain_name: str) -> bool:
+        # False if the ref has no idle container
+        key = (book.name, subdomain_name)
+        if waking := self._waking.get(key):
+            await waking.wait()
+            return True
+        container_id = store.get_idle(book.name).get(subdomain_name)
+        container = store.get_containers(book.name).get(subdomain_name)
+        if not container_id or not container:
+            return False
+
+        self._waking[key] = anyio.Event()
+        try:
+            logger.info(f"Waking idle container {container_id} of {subdomain_name} in book {book.name}")
+            _, _, code = await docker.start_container(container_id, container["context"])
+            if not code:
+                # Traefik routes to it once healthy, the holding page is served until then
+                await wait_ready(book, container_id, container["context"])
+                store.remove_idle(book.name, subdomain_name)
+                self._active[f"{book.name}--{subdomain_name}"] = anyio.current_time()
+                self.woken += 1
+        finally:
+            self._waking.pop(key).set()
+        return True
+
+    async def run(self):
+        while True:
+            try:
+                await self.check(config.settings.books)
+            except Exception as e:
+                logger.warning(f"Idle check failed: {e}")
+            await anyio.sleep(config.settings.traefik_metrics.interval)
+
+    def stats(self) -> dict[str, int]:
+        return {"stopped": self.stopped, "woken": self.woken, "waking": len(self._waking)}
+
+
+def holding_page(host: str, waking: bool) -> str:
+    return HOLDING_PAGE.format(
+        refresh=2 if waking else 30,
+        host=escape(host),
+        message="Starting preview, one moment..." if waking else "Preview not available",
+    )
+
+
+idle_watcher = IdleWatcher()
@@ -0,0 +1,135 @@
+from collections import defaultdict
+from collections.abc import Iterable
+from contextlib import asynccontextmanager
+from pathlib import Path
+from uuid import uuid4
+import anyio
+import re
+import shutil
+from . import config
+from .services.cli_runner import CliInstance
+from .webhooks import normalize_repo_url
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFSPECS = ("+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*")
+
+
+class GitMirrors:
+    # Bare mirrors per repo url, shared by every book, builds check out worktrees from them
+    def __init__(self):
+        self._locks: dict[Path, anyio.Lock] = defaultdict(anyio.Lock)
+        self._cleaned = False
+
+    @property
+    def root(self) -> Path | None:
+        return config.settings.git.mirror_dir
+
+    def path(self, repo_url: str) -> Path:
+        # ssh and https urls of the same repo share a mirror
+        return self.root / f"{re.sub(r'[^\w.-]+', '_', normalize_repo_url(repo_url))}.git"  # type: ignore
+
+    async def git(self, *args: str, timeout: float | None = None) -> str:
+        cli = CliInstance(timeout or config.settings.process.git_timeout)
+        cli.add_arg("git")
+        cli.add_arg(*args)
+        stdout, stderr, code = await cli.run()
+        if code:
+            raise Exception(f"git {' '.join(args)} failed", stderr, code)
+        return stdout
+
+    async def fetch(self, repo_url: str, patterns: Iterable[str] = ()) -> Path:
+        path = self.path(repo_url)
+        # Tracked refs outside heads and tags, e.g. refs/merge-requests/*/head
+        refspecs = list(DEFAULT_REFSPECS) + [
+            f"+{pattern}:{pattern}"
+            for pattern in sorted(set(patterns))
+            if not pattern.startswith(("refs/heads/", "refs/tags/"))
+            and pattern.count("*") <= 1
+            and not any(char in pattern for char in "?[")
+        ]
+        async with self._locks[path]:
+            if not (path / "HEAD").exists():
+                logger.info(f"Creating mirror of {repo_url} in {path}")
+                await self.git("init", "--bare", "--quiet", str(path))
+                # No fetch refspec, so only the refspecs below are stored
+                await self.git("-C", str(path), "config", "remote.origin.url", repo_url)
+            logger.info(f"Fetching {repo_url} into its mirror")
+            await self.git(
+                "-C",
+                str(path),
+                "fetch",
+                "--prune",
+                "--no-tags",
+                "--quiet",
+                "origin",
+                *refspecs,
+                timeout=config.settings.git.mirror_timeout,
+            )
+        return path
+
+    async def ls_remote(
+        self, repo_url: str, patterns: Iterable[str] = ()
+    ) -> list[tuple[str, str]]:
+        path = await self.fetch(repo_url, patterns)
+        stdout = await self.git(
+            "-C", str(path), "for-each-ref", "--format=%(objectname) %(*objectname) %(refname)"
+        )
+        refs = []
+        for line in stdout.split("\n"):
+            if not line:
+                continue
+            git_hash, peeled, ref_name = line.split(" ", maxsplit=2)
+            # Annotated tags resolve to their commit
+            refs.append((peeled or git_hash, ref_name))
+        return refs
+
+    async def has_commit(self, path: Path, git_hash: str) -> bool:
+        try:
+            await self.git("-C", str(path), "cat-file", "-e", f"{git_hash}^{{commit}}")
+        except Exception:
+            return False
+        return True
+
+    @asynccontextmanager
+    async def checkout(self, build_context: object):
+        # Local worktree of a url#hash build context, None if mirrors are off
+        repo_url, _, git_hash = str(build_context).rpartition("#")
+        if not self.root or not repo_url or not re.fullmatch(r"[0-9a-f]{40}", git_hash):
+            yield None
+            return
+
+        worktrees = self.root / "worktrees"
+        if not self._cleaned:
+            # Left behind by a previous run
+            await anyio.to_thread.run_sync(shutil.rmtree, worktrees, True)
+            self._cleaned = True
+        worktrees.mkdir(parents=True, exist_ok=True)
+
+        path = self.path(repo_url)
+        if not await self.has_commit(path, git_hash):
+            await self.fetch(repo_url)
+        if not await self.has_commit(path, git_hash):
+            # Commits only reachable from untracked refs
+            async with self._locks[path]:
+                await self.git(
+                    "-C", str(path), "fetch", "--quiet", "origin", git_hash,
+                    timeout=config.settings.git.mirror_timeout,
+                )
+
+        worktree = worktrees / f"{path.stem}-{git_hash[:12]}-{uuid4().hex[:8]}"
+        async with self._locks[path]:
+            await self.git("-C", str(path), "worktree", "add", "--detach", "--quiet", str(worktree), git_hash)
+        # BuildKit leaves .git out of git contexts, so do the same
+        (worktree / ".git").unlink()
+        try:
+            yield worktree
+        finally:
+            with anyio.CancelScope(shield=True):
+                await anyio.to_thread.run_sync(shutil.rmtree, worktree, True)
+                async with self._locks[path]:
+                    await self.git("-C", str(path), "worktree", "prune")
+
+
+git_mirrors = GitMirrors()
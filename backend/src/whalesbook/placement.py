@@ -0,0 +1,60 @@
+from hashlib import sha256
+from .config import Book
+from . import docker
+import anyio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def sticky_runner(runners: list[str], key: str) -> str:
+    # Rendezvous hashing, only refs of a removed runner move when the pool changes
+    return max(runners, key=lambda runner: sha256(f"{runner}/{key}".encode()).digest())
+
+
+class Placement:
+    def __init__(self, book: Book, infos: dict[str, dict]):
+        self.book = book
+        self.infos = infos  # docker info of the reachable runners
+
+    @classmethod
+    async def load(cls, book: Book) -> "Placement":
+        infos: dict[str, dict] = {}
+        if book.placement == "sticky" or len(book.runners) == 1:
+            return cls(book, infos)
+
+        async def get_info(docker_context: str):
+            info, stderr, code = await docker.get_info(docker_context)
+            if not code:
+                infos[docker_context] = info  # type: ignore
+
+        async with anyio.create_task_group() as tg:
+            for docker_context in book.runners:
+                tg.start_soon(get_info, docker_context)
+        return cls(book, infos)
+
+    def choose(self, subdomain_name: str, current: str | None = None) -> str:
+        runners = self.book.runners
+        if self.book.placement == "sticky" or len(runners) == 1:
+            return sticky_runner(runners, f"{self.book.name}/{subdomain_name}")
+        # Load based placements keep refs where they run, moving them only off removed runners
+        if current in runners:
+            return current  # type: ignore
+        reachable = [runner for runner in runners if runner in self.infos]
+        if not reachable:
+            logger.warning(f"No runner of book {self.book.name} reachable, placing by ref")
+            return sticky_runner(runners, f"{self.book.name}/{subdomain_name}")
+
+        def running(runner: str) -> int:
+            return self.infos[runner].get("ContainersRunning", 0)
+
+        if self.book.placement == "least_containers":
+            runner = min(reachable, key=running)
+        else:
+            runner = max(
+                reachable,
+                key=lambda runner: self.infos[runner].get("MemTotal", 0) / (running(runner) + 1),
+            )
+        # Later refs of the same reconcile see this one
+        self.infos[runner]["ContainersRunning"] = running(runner) + 1
+        return runner
@@ -0,0 +1,73 @@
+from shlex import quote
+from .config import Book
+from . import docker
+import anyio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def health_command(book: Book) -> str | None:
+    # Shell command probing the app from inside its container, None keeps the image's HEALTHCHECK
+    readiness = book.readiness
+    if not readiness or readiness.check == "healthcheck":
+        return None
+    if readiness.command:
+        return readiness.command
+    port = book.traefik_config.port if book.traefik_config else 80
+    if readiness.check == "tcp":
+        return f"nc -z 127.0.0.1 {port} || bash -c ': >/dev/tcp/127.0.0.1/{port}'"
+    url = quote(f"http://127.0.0.1:{port}{readiness.path}")
+    return f"wget -q -O /dev/null {url} || curl -fsS -o /dev/null {url}"
+
+
+def healthcheck(book: Book) -> dict | None:
+    # Engine API Healthcheck, durations in nanoseconds
+    if not (command := health_command(book)):
+        return None
+    readiness = book.readiness
+    assert readiness
+    # Capped by default, so a hanging probe does not take up long intervals
+    probe_timeout = readiness.probe_timeout or min(readiness.interval, 5)
+    return {
+        "Test": ["CMD-SHELL", command],
+        "Interval": int(readiness.interval * 1e9),
+        "Timeout": int(probe_timeout * 1e9),
+        # Failures while booting keep it starting rather than unhealthy
+        "StartPeriod": int(readiness.timeout * 1e9),
+        "Retries": 3,
+    }
+
+
+def check_ready(container: dict) -> bool:
+    # Health status as reported by the runner, so remote runners work too
+    health = container["State"].get("Health")
+    if not health:
+        logger.warning(f"Container {container['Id'][:12]} has no healthcheck, ready once running")
+        return True
+    return health["Status"] == "healthy"
+
+
+async def wait_ready(book: Book, container_id: str, docker_context: str) -> bool:
+    readiness = book.readiness
+    if not readiness:
+        return True
+
+    logger.info(f"Waiting for container {container_id[:12]} to become ready")
+    with anyio.move_on_after(readiness.timeout):
+        while True:
+            container, stderr, code = await docker.inspect_container(
+                container_id, docker_context
+            )
+            if code:
+                return False
+            if container["State"]["Status"] in ("exited", "dead"):  # type: ignore
+                logger.error(f"Container {container_id[:12]} exited before becoming ready")
+                return False
+            if container["State"]["Running"] and check_ready(container):  # type: ignore
+                logger.info(f"Container {container_id[:12]} is ready")
+                return True
+            await anyio.sleep(readiness.interval)
+
+    logger.error(f"Container {container_id[:12]} not ready after {readiness.timeout}s")
+    return False
@@ -0,0 +1,106 @@
+from pathlib import Path
+from pydantic import BaseModel
+import anyio
+from . import config
+from .config import Book, Settings
+from .schedule import book_limiter, schedule_book, stagger_keys, unschedule_book
+from .services.cli_runner import process_limiter
+from .services.registry import Registry
+from .snapshots import book_snapshots
+from .store import store
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    from watchfiles import awatch  # inotify on linux
+except ImportError:
+    awatch = None
+
+
+class BooksDiff(BaseModel):
+    added: list[str] = []
+    removed: list[str] = []
+    changed: list[str] = []
+    unchanged: list[str] = []
+
+
+def diff_books(old: list[Book], new: list[Book]) -> BooksDiff:
+    old_books = {book.name: book for book in old}
+    new_books = {book.name: book for book in new}
+    diff = BooksDiff(removed=[name for name in old_books if name not in new_books])
+    for name, book in new_books.items():
+        if name not in old_books:
+            diff.added.append(name)
+        elif book.model_dump() != old_books[name].model_dump():
+            diff.changed.append(name)
+        else:
+            diff.unchanged.append(name)
+    return diff
+
+
+def apply_settings(new: Settings, registry: Registry) -> BooksDiff:
+    old = config.settings
+    diff = diff_books(old.books, new.books)
+    # Untouched books keep their objects, and with them their jobs and caches
+    old_books = {book.name: book for book in old.books}
+    new.books = [
+        old_books[book.name] if book.name in diff.unchanged else book for book in new.books
+    ]
+    if new.docker_registry != old.docker_registry:
+        logger.warning("Registry changes take effect after a restart")
+    config.settings = new
+    book_limiter.total_tokens = new.schedule.max_concurrent_books
+    process_limiter.total_tokens = new.process.max_processes
+    if new.state_file != old.state_file:
+        store.open(new.state_file or ":memory:")
+
+    for name in diff.removed:
+        logger.info(f"Book {name} removed, its containers are kept until stopped")
+        unschedule_book(name)
+    reschedule_all = new.schedule != old.schedule
+    # Repos of other books can join or split the group an unchanged book fires with
+    old_keys, new_keys = stagger_keys(old.books), stagger_keys(new.books)
+    for book in new.books:
+        if book.name in diff.added or book.name in diff.changed:
+            logger.info(f"Book {book.name} {'added' if book.name in diff.added else 'changed'}")
+            schedule_book(new.schedule.cron, registry, book, run_now=True)
+        elif reschedule_all or old_keys[book.name] != new_keys[book.name]:
+            schedule_book(new.schedule.cron, registry, book)
+
+    if diff.added or diff.removed or diff.changed:
+        # Only watchers of runners with added, removed or changed books restart
+        book_snapshots.restart(diff.removed + diff.changed)
+    return diff
+
+
+def reload_settings(path: Path, registry: Registry) -> BooksDiff | None:
+    try:
+        new = Settings.from_yaml(path)
+    except Exception as e:
+        logger.error(f"Invalid config {path}, keeping the last good one: {e}")
+        return None
+    diff = apply_settings(new, registry)
+    logger.info(
+        f"Reloaded config {path}: {len(diff.added)} added, {len(diff.changed)} changed, "
+        f"{len(diff.removed)} removed, {len(diff.unchanged)} unchanged"
+    )
+    return diff
+
+
+async def watch_settings(path: Path, registry: Registry, poll_interval: float = 2):
+    path = path.resolve()
+    if awatch:
+        # Watch the directory, editors replace the file on save
+        async for _ in awatch(path.parent, watch_filter=lambda _, changed: Path(changed) == path):
+            reload_settings(path, registry)
+        return
+
+    logger.info(f"watchfiles not installed, polling {path} every {poll_interval}s")
+    mtime = path.stat().st_mtime_ns if path.exists() else None
+    while True:
+        await anyio.sleep(poll_interval)
+        current = path.stat().st_mtime_ns if path.exists() else None
+        if current != mtime:
+            mtime = current
+            reload_settings(path, registry)
@@ -1,18 +1,161 @@
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+from apscheduler.events import EVENT_JOB_SUBMITTED, JobSubmissionEvent
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.base import BaseTrigger
 from apscheduler.triggers.cron import CronTrigger
+from pydantic import BaseModel
+import time
+from . import config
 from .config import Book
+from .services.metrics import Histogram
 from .services.registry import Registry
-from .state import update_book
+from .state import book_limiter, update_book
+import logging
 
+logger = logging.getLogger(__name__)
+
+
+class StaggeredTrigger(BaseTrigger):
+    # Cron shifted by a deterministic offset within its interval
+    def __init__(self, trigger: CronTrigger, key: str, spread: float | None = None):
+        self.trigger = trigger
+        if spread is None:
+            first = trigger.get_next_fire_time(None, datetime.now(trigger.timezone))
+            second = trigger.get_next_fire_time(first, first + timedelta(seconds=1))  # type: ignore
+            spread = (second - first).total_seconds() if first and second else 0
+        fraction = int.from_bytes(sha256(key.encode()).digest()[:8]) / 2**64
+        self.offset = timedelta(seconds=int(fraction * spread))
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        next_fire_time = self.trigger.get_next_fire_time(
+            previous_fire_time - self.offset if previous_fire_time else None,
+            now - self.offset,
+        )
+        return next_fire_time + self.offset if next_fire_time else None
+
+    def __str__(self):
+        return f"{self.trigger} +{self.offset}"
+
+
+class BookRun(BaseModel):
+    scheduled: float | None = None
+    started: float | None = None
+    finished: float | None = None
+    lag: float | None = None  # seconds from the scheduled time to the start
+    duration: float | None = None
+    next_run: datetime | None = None
+
+
+class ScheduleStats(BaseModel):
+    running: int
+    queued: int
+    limit: int
+    books: dict[str, BookRun]
+
+
+SCHEDULE_LAG = Histogram(
+    "whalesbook_schedule_lag_seconds",
+    "Delay from the scheduled time of a book update to its start",
+    ("book",),
+)
 
 scheduler = AsyncIOScheduler()
+book_runs: dict[str, BookRun] = {}
+
+
+def stagger_keys(books: list[Book]) -> dict[str, str]:
+    # Books sharing a repo url, directly or through other books, get the same offset key
+    parent: dict[str, str] = {}
+
+    def find(url: str) -> str:
+        while parent.setdefault(url, url) != url:
+            url = parent[url]
+        return url
+
+    for book in books:
+        urls = [repo.url for repo in book.repos]
+        for url in urls[1:]:
+            first, other = find(urls[0]), find(url)
+            parent[max(first, other)] = min(first, other)
+    # The smallest url of a group, whatever the order of the books
+    return {book.name: find(book.repos[0].url) if book.repos else book.name for book in books}
+
+
+def job_id(book: Book) -> str:
+    return f"book:{book.name}"
+
+
+def on_submitted(event: JobSubmissionEvent):
+    if event.job_id.startswith("book:"):
+        run = book_runs.setdefault(event.job_id.removeprefix("book:"), BookRun())
+        run.scheduled = event.scheduled_run_times[-1].timestamp()
+
+
+async def scheduled_update(registry: Registry, book: Book, force=False):
+    run = book_runs.setdefault(book.name, BookRun())
+    run.scheduled = run.scheduled or time.time()
+    run.started = None
+
+    def on_start():
+        # Once a slot of book_limiter is free
+        run.started = time.time()
+        run.lag = run.started - run.scheduled  # type: ignore
+        SCHEDULE_LAG.observe(max(run.lag, 0), book=book.name)
+        if run.lag > 60:
+            logger.warning(f"Update of book {book.name} started {run.lag:.0f}s late")
+
+    try:
+        await update_book(registry, book, force, on_start=on_start)
+    except Exception as e:
+        logger.error(f"Failed to update book {book.name}: {e}")
+    finally:
+        run.finished = time.time()
+        run.duration = run.finished - run.started if run.started else None
+        run.scheduled = None
+
+
+def schedule_book(cron: str, registry: Registry, book: Book, force=False, run_now=False):
+    # Books tracking the same repos fire together and share their ls-remote
+    key = stagger_keys(config.settings.books + [book])[book.name]
+    options = {"next_run_time": datetime.now(timezone.utc)} if run_now else {}
+    scheduler.add_job(
+        scheduled_update,
+        StaggeredTrigger(CronTrigger.from_crontab(cron), key, config.settings.schedule.spread),
+        (registry, book, force),
+        id=job_id(book),
+        replace_existing=True,
+        max_instances=1,  # a late tick never overlaps a running update
+        coalesce=True,
+        misfire_grace_time=None,
+        **options,
+    )
+
+
+def unschedule_book(book_name: str):
+    if scheduler.get_job(f"book:{book_name}"):
+        scheduler.remove_job(f"book:{book_name}")
+    book_runs.pop(book_name, None)
 
 
 def schedule_books(cron: str, registry: Registry, books: list[Book], force=False):
+    book_limiter.total_tokens = config.settings.schedule.max_concurrent_books
     for book in books:
-        scheduler.add_job(
-            update_book,
-            CronTrigger.from_crontab(cron),
-            (registry, book, force),
-        )
+        schedule_book(cron, registry, book, force)
+    scheduler.add_listener(on_submitted, EVENT_JOB_SUBMITTED)
     scheduler.start()
+
+
+def schedule_stats() -> ScheduleStats:
+    for job in scheduler.get_jobs():
+        if job.id.startswith("book:"):
+            book_runs.setdefault(job.id.removeprefix("book:"), BookRun()).next_run = (
+                job.next_run_time
+            )
+    statistics = book_limiter.statistics()
+    return ScheduleStats(
+        running=statistics.borrowed_tokens,
+        queued=statistics.tasks_waiting,
+        limit=int(statistics.total_tokens),
+        books=book_runs,
+    )
@@ -1,17 +1,36 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Response
+from fastapi import FastAPI, APIRouter, BackgroundTasks, HTTPException, Request, Response
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.routing import APIRoute
 from contextlib import asynccontextmanager
-from .schedule import scheduler, schedule_books
-from .services.registry import create_registry
-from . import config
-from .state import RefState, get_refs_state
+import anyio
+import json
+import logging
+from .schedule import ScheduleStats, scheduler, schedule_books, schedule_stats
+from .services.registry import Registry, create_registry
+from . import config, docker
+from .builds import build_queue
+from .idle import find_idle_ref, holding_page, idle_watcher
+from .services.build_log import BuildLogTail
+from .services.metrics import render as render_metrics
+from .reload import watch_settings
+from .snapshots import book_snapshots
+from .state import MainTag, RefState, ref_cache, update_pushed_ref
+from .webhooks import find_pushed_repos, is_push_event, parse_push, verify_webhook
+
+logger = logging.getLogger(__name__)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    reg = await create_registry(config.settings.docker_registry)  # type: ignore
+    reg = app.state.registry = await create_registry(config.settings.docker_registry)  # type: ignore
     schedule_books(config.settings.schedule.cron, reg, config.settings.books)
-    yield
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(book_snapshots.run)
+        tg.start_soon(idle_watcher.run)
+        if config.settings.source:
+            tg.start_soon(watch_settings, config.settings.source, reg)
+        yield
+        tg.cancel_scope.cancel()
     scheduler.shutdown()
 
 
@@ -36,6 +55,11 @@ async def get_books() -> list[config.Book]:
     return config.settings.books
 
 
+@router.get("/books/state")
+async def get_books_state() -> dict[str, dict[str, dict[str, RefState]]]:
+    return await book_snapshots.get_all(config.settings.books)
+
+
 @router.get("/books/{book_name}")
 async def get_book(book_name: str) -> config.Book:
     book = tuple(book for book in config.settings.books if book.name == book_name)
@@ -47,7 +71,133 @@ async def get_book(book_name: str) -> config.Book:
 @router.get("/books/{book_name}/state")
 async def get_book_state(book_name: str) -> dict[str, dict[str, RefState]]:
     book = await get_book(book_name)
-    return await get_refs_state(
-        config.settings.docker_registry.url,  # type:ignore
-        book,
+    return await book_snapshots.get(book)
+
+
+@router.get("/books/{book_name}/builds/{subdomain_name}/log")
+async def get_build_log(
+    book_name: str, subdomain_name: str, lines: int = 100
+) -> BuildLogTail:
+    book = await get_book(book_name)
+    main_tag = MainTag(
+        registry_url=config.settings.docker_registry.url if config.settings.docker_registry else None,
+        book_name_registry=book.name_registry,
+        subdomain_name=subdomain_name,
+    ).to_string()
+    if main_tag not in docker.build_logs:
+        raise HTTPException(404, f"No build of {subdomain_name} in book {book_name} since start")
+    return docker.build_logs[main_tag].tail(lines)
+
+
+def server_sent_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@router.get("/books/{book_name}/state/stream", response_class=StreamingResponse)
+async def stream_book_state(book_name: str):
+    book = await get_book(book_name)
+    await book_snapshots.get(book)  # fail before streaming
+
+    async def events():
+        async with book_snapshots.subscribe(book) as changes:
+            states = await book_snapshots.get(book)
+            yield server_sent_event(
+                "snapshot",
+                {
+                    repo_name: {ref_name: state.model_dump(mode="json") for ref_name, state in refs.items()}
+                    for repo_name, refs in states.items()
+                },
+            )
+            while True:
+                change = None
+                with anyio.move_on_after(15):
+                    try:
+                        change = await changes.receive()
+                    except anyio.EndOfStream:
+                        return  # fell behind, the client reconnects for a new snapshot
+                yield server_sent_event("ref", change) if change else ": keepalive\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
+
+
+async def update_pushed_ref_logged(registry: Registry, *args):
+    try:
+        await update_pushed_ref(registry, *args)
+    except Exception as e:
+        logger.error(f"Failed to update pushed ref {args[2]} of book {args[0].name}: {e}")
+
+
+@router.post("/webhook", status_code=202)
+async def receive_webhook(request: Request, background_tasks: BackgroundTasks) -> list[str]:
+    if not config.settings.webhook:
+        raise HTTPException(404, "Webhooks are not configured")
+    body = await request.body()
+    provider = verify_webhook(request.headers, body, config.settings.webhook.secret)
+    if not is_push_event(provider, request.headers):
+        return []
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(400, "Invalid webhook payload")
+
+    repo_urls, ref_name, git_hash = parse_push(provider, payload)
+    pushed = [
+        (book, repo)
+        for book, repo in find_pushed_repos(config.settings.books, repo_urls)
+        if repo.match_ref(ref_name)
+    ]
+    if pushed:
+        registry = getattr(request.app.state, "registry", None) or await create_registry(
+            config.settings.docker_registry  # type: ignore
+        )
+        for book, repo in pushed:
+            background_tasks.add_task(
+                update_pushed_ref_logged, registry, book, repo, ref_name, git_hash
+            )
+    logger.info(f"{provider} push to {ref_name} updates books {[book.name for book, _ in pushed]}")
+    return [book.name for book, _ in pushed]
+
+
+# Catch-all Traefik router for idle book subdomains, replacing the path with /api/v1/wake
+@router.get("/wake", include_in_schema=False)
+async def wake(request: Request, background_tasks: BackgroundTasks) -> HTMLResponse:
+    host = request.headers.get("x-forwarded-host") or request.headers.get("host", "")
+    found = find_idle_ref(config.settings.books, host)
+    if not found or not idle_watcher.is_idle(*found):
+        return HTMLResponse(holding_page(host, False), status_code=404)
+    background_tasks.add_task(idle_watcher.wake, *found)
+    return HTMLResponse(holding_page(host, True), status_code=503, headers={"Retry-After": "2"})
+
+
+@router.get("/idle")
+async def get_idle_stats() -> dict[str, int]:
+    return idle_watcher.stats()
+
+
+@router.get("/cache/refs")
+async def get_ref_cache_stats() -> dict[str, int]:
+    return ref_cache.stats()
+
+
+@router.get("/cache/books")
+async def get_book_snapshot_stats() -> dict[str, int | float]:
+    return book_snapshots.stats()
+
+
+@router.get("/builders")
+async def get_builder_stats() -> dict[str, dict[str, int]]:
+    return build_queue.stats()
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@router.get("/schedule")
+async def get_schedule_stats() -> ScheduleStats:
+    return schedule_stats()
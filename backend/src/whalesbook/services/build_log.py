@@ -0,0 +1,56 @@
+from collections import deque
+from pydantic import BaseModel
+import re
+import time
+
+STEP_PATTERN = re.compile(r"^#(\d+) \[(?:[\w.-]+ )?\d+/\d+\]")
+CACHED_PATTERN = re.compile(r"^#(\d+) CACHED$")
+
+
+class BuildLogTail(BaseModel):
+    running: bool
+    started_at: float
+    finished_at: float | None
+    returncode: int | None
+    line_count: int
+    lines: list[str]
+
+
+class BuildLog:
+    # Recent lines of a build, memory stays bounded whatever the output size
+    def __init__(self, max_lines: int = 1000):
+        self.lines: deque[str] = deque(maxlen=max_lines)
+        self.line_count = 0
+        self.started_at = time.time()
+        self.finished_at: float | None = None
+        self.returncode: int | None = None
+        self._steps: set[str] = set()
+        self._cached: set[str] = set()
+
+    def append(self, line: str):
+        self.lines.append(line)
+        self.line_count += 1
+        # Plain BuildKit progress output
+        if match := STEP_PATTERN.match(line):
+            self._steps.add(match[1])
+        elif match := CACHED_PATTERN.match(line):
+            self._cached.add(match[1])
+
+    def finish(self, returncode: int):
+        self.returncode = returncode
+        self.finished_at = time.time()
+
+    @property
+    def cache_stats(self) -> tuple[int, int]:
+        # (cached, total) Dockerfile steps
+        return len(self._cached & self._steps), len(self._steps)
+
+    def tail(self, lines: int | None = None) -> BuildLogTail:
+        return BuildLogTail(
+            running=self.finished_at is None,
+            started_at=self.started_at,
+            finished_at=self.finished_at,
+            returncode=self.returncode,
+            line_count=self.line_count,
+            lines=list(self.lines)[-lines:] if lines else list(self.lines),
+        )
@@ -1,27 +1,149 @@
-from typing import Tuple
+from subprocess import STDOUT
+from typing import AsyncIterator, Tuple
+from anyio.abc import ByteReceiveStream, Process
 import anyio
+import codecs
 import logging
+import math
+import os
+import signal
+from .metrics import Counter, Histogram
 
 logger = logging.getLogger(__name__)
 
+MAX_LINE_LENGTH = 8192  # longer lines are split
+
+# Child processes running at once across all books
+process_limiter = anyio.CapacityLimiter(16)
+
+COMMAND_DURATION = Histogram(
+    "whalesbook_command_duration_seconds",
+    "Duration of git and docker commands, queueing for a process slot excluded",
+    ("command", "context"),
+)
+COMMAND_TIMEOUTS = Counter(
+    "whalesbook_command_timeouts_total", "Commands killed at their timeout", ("command", "context")
+)
+
+
+def command_labels(commands: list[str]) -> dict[str, str]:
+    # e.g. "docker container ls" on context "runner", options and operands left out
+    context, words, skip = "", [], False
+    for i, arg in enumerate(commands[1:], start=1):
+        if skip:
+            skip = False
+        elif arg in ("--context", "-C"):
+            skip = True
+            if arg == "--context":
+                context = commands[i + 1] if i + 1 < len(commands) else ""
+        elif not arg.startswith("-"):
+            words.append(arg)
+            if arg not in ("container", "image", "buildx", "worktree"):
+                break
+    return {"command": " ".join([os.path.basename(commands[0]), *words]), "context": context}
+
+
+class CommandTimeout(Exception):
+    def __init__(self, commands: list[str], timeout: float):
+        super().__init__(f"{' '.join(commands)} timed out after {timeout}s")
+        self.commands = commands
+        self.timeout = timeout
+
+
+def kill_process_group(proc: Process):
+    # git and docker spawn helpers (ssh, credential helpers, buildx) that must die too
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
 
 class CliInstance:
-    def __init__(self):
+    def __init__(self, timeout: float | None = 300):
         self.commands = []
-        self.timeout = 300
+        self.timeout = timeout  # None waits forever
+        self.returncode: int | None = None
 
     def add_arg(self, *args: str):
         self.commands.extend(args)
 
     async def run(self) -> Tuple[str, str, int]:
         commands = self.commands
-        # timeout = self.timeout
+        stdout, stderr = bytearray(), bytearray()
 
-        proc = await anyio.run_process(commands, check=False)
-        if proc.returncode:
+        async def read(stream: ByteReceiveStream, buffer: bytearray):
+            async for chunk in stream:
+                buffer.extend(chunk)
+
+        labels = command_labels(commands)
+        async with process_limiter:
+            with COMMAND_DURATION.time(**labels):
+                async with await anyio.open_process(commands, start_new_session=True) as proc:
+                    try:
+                        with anyio.move_on_after(self.timeout) as scope:
+                            async with anyio.create_task_group() as tg:
+                                tg.start_soon(read, proc.stdout, stdout)
+                                tg.start_soon(read, proc.stderr, stderr)
+                            await proc.wait()
+                    except BaseException:
+                        kill_process_group(proc)
+                        raise
+                    if scope.cancelled_caught:
+                        kill_process_group(proc)
+                        COMMAND_TIMEOUTS.inc(**labels)
+                        raise CommandTimeout(commands, self.timeout)  # type: ignore
+
+        self.returncode = proc.returncode or 0
+        if self.returncode:
             logger.error(f"{' '.join(commands)}")
         return (
-            proc.stdout.decode().strip(),
-            proc.stderr.decode().strip(),
-            proc.returncode or 0,
+            stdout.decode(errors="replace").strip(),
+            stderr.decode(errors="replace").strip(),
+            self.returncode,
         )
+
+    async def stream(self) -> AsyncIterator[str]:
+        # stdout and stderr interleaved line by line, returncode is set once exhausted
+        commands = self.commands
+        deadline = anyio.current_time() + (math.inf if self.timeout is None else self.timeout)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        labels = command_labels(commands)
+        async with process_limiter:
+            start = anyio.current_time()
+            async with await anyio.open_process(
+                commands, stderr=STDOUT, start_new_session=True
+            ) as proc:
+                try:
+                    buffer = ""
+                    while True:
+                        chunk = None
+                        with anyio.move_on_after(deadline - anyio.current_time()):
+                            try:
+                                chunk = await proc.stdout.receive()  # type: ignore
+                            except anyio.EndOfStream:
+                                chunk = b""
+                        if chunk is None:
+                            COMMAND_TIMEOUTS.inc(**labels)
+                            raise CommandTimeout(commands, self.timeout)  # type: ignore
+                        if not chunk:
+                            break
+
+                        buffer += decoder.decode(chunk)
+                        *lines, buffer = buffer.split("\n")
+                        for line in lines:
+                            yield line.rstrip("\r")
+                        while len(buffer) > MAX_LINE_LENGTH:
+                            yield buffer[:MAX_LINE_LENGTH]
+                            buffer = buffer[MAX_LINE_LENGTH:]
+                    if buffer := buffer + decoder.decode(b"", final=True):
+                        yield buffer.rstrip("\r")
+                except BaseException:
+                    kill_process_group(proc)
+                    raise
+                finally:
+                    COMMAND_DURATION.observe(anyio.current_time() - start, **labels)
+
+        self.returncode = proc.returncode or 0
+        if self.returncode:
+            logger.error(f"{' '.join(commands)}")
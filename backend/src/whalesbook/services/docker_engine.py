@@ -0,0 +1,420 @@
+import base64
+import hashlib
+import json
+import os
+import ssl
+from contextlib import contextmanager
+from pathlib import Path
+from urllib import parse
+from httpx import AsyncClient, AsyncHTTPTransport, HTTPError, Response, Timeout
+from .cli_runner import COMMAND_TIMEOUTS, CommandTimeout, command_labels
+import anyio
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DOCKER_HOST = "unix:///var/run/docker.sock"
+
+
+def docker_config_dir() -> Path:
+    return Path(os.environ.get("DOCKER_CONFIG", Path.home() / ".docker"))
+
+
+# (host, tls files, skip tls verify) from the docker context store
+def resolve_docker_host(
+    docker_context: str = "default",
+) -> tuple[str, dict[str, Path] | None, bool]:
+    if docker_context == "default":
+        cert_path = os.environ.get("DOCKER_CERT_PATH")
+        return (
+            os.environ.get("DOCKER_HOST", DEFAULT_DOCKER_HOST),
+            {
+                name: Path(cert_path) / f"{name}.pem"
+                for name in ("ca", "cert", "key")
+            }
+            if cert_path
+            else None,
+            not os.environ.get("DOCKER_TLS_VERIFY"),
+        )
+
+    context_id = hashlib.sha256(docker_context.encode()).hexdigest()
+    meta_file = docker_config_dir() / "contexts" / "meta" / context_id / "meta.json"
+    if not meta_file.exists():
+        raise Exception(f"Docker context {docker_context} not found", meta_file)
+    endpoint = json.loads(meta_file.read_text())["Endpoints"]["docker"]
+
+    tls_dir = docker_config_dir() / "contexts" / "tls" / context_id / "docker"
+    tls_files = {name: tls_dir / f"{name}.pem" for name in ("ca", "cert", "key")}
+    return (
+        endpoint["Host"],
+        tls_files if tls_dir.exists() else None,
+        endpoint.get("SkipTLSVerify", False),
+    )
+
+
+def split_image(image: str) -> tuple[str, str]:
+    name, at, digest = image.partition("@")
+    repository, sep, tag = name.rpartition(":")
+    if not sep or "/" in tag:
+        repository, tag = name, "latest"
+    return repository, digest if at else tag
+
+
+def image_registry_host(image: str) -> str:
+    first = image.split("/", maxsplit=1)[0]
+    if "/" in image and ("." in first or ":" in first or first == "localhost"):
+        return first
+    return "https://index.docker.io/v1/"
+
+
+class DockerEngine:
+    def __init__(
+        self,
+        host: str,
+        tls_files: dict[str, Path] | None = None,
+        skip_tls_verify: bool = False,
+        credentials: dict[str, tuple[str, str]] | None = None,
+    ):
+        self.host = host
+        self.credentials = credentials or {}
+        self.timeout: float | None = None  # whole call, pulls included, None waits forever
+        self.client: AsyncClient
+
+        url = parse.urlparse(host)
+        if url.scheme == "unix":
+            transport = AsyncHTTPTransport(uds=url.path)
+            base_url = "http://docker"
+        elif url.scheme == "tcp":
+            verify: ssl.SSLContext | bool = False
+            if tls_files:
+                verify = ssl.create_default_context(
+                    cafile=None if skip_tls_verify else tls_files["ca"]
+                )
+                if skip_tls_verify:
+                    verify.check_hostname = False
+                    verify.verify_mode = ssl.CERT_NONE
+                verify.load_cert_chain(tls_files["cert"], tls_files["key"])
+            transport = AsyncHTTPTransport(verify=verify)
+            base_url = f"{'https' if tls_files else 'http'}://{url.netloc}"
+        else:
+            raise Exception(f"Unsupported docker host {host}")
+
+        self.client = AsyncClient(
+            transport=transport,
+            base_url=base_url,
+            timeout=Timeout(60, connect=5),
+        )
+
+    async def request(self, method: str, path: str, **kwargs) -> Response:
+        return await self.client.request(method, path, **kwargs)
+
+    @contextmanager
+    def _timeout(self, *command: str):
+        # Raised like the CLI equivalent killed at its timeout
+        commands = ["docker", *command]
+        try:
+            with anyio.fail_after(self.timeout):
+                yield
+        except TimeoutError:
+            COMMAND_TIMEOUTS.inc(**command_labels(commands))
+            raise CommandTimeout(commands, self.timeout)  # type: ignore
+
+    @staticmethod
+    def _error(resp: Response) -> str:
+        try:
+            message = resp.json()["message"]
+        except (ValueError, KeyError, TypeError):
+            message = resp.text.strip()
+        return f"Error response from daemon: {message}"
+
+    def _unreachable(self, e: HTTPError):
+        return "", f"Cannot connect to the Docker daemon at {self.host}: {e}", 1
+
+    def _registry_auth(self, image: str) -> str | None:
+        host = image_registry_host(image)
+        if host in self.credentials:
+            username, password = self.credentials[host]
+        else:
+            try:
+                auths = json.loads((docker_config_dir() / "config.json").read_text())
+                username, password = (
+                    base64.b64decode(auths["auths"][host]["auth"]).decode().split(":", maxsplit=1)
+                )
+            except (OSError, ValueError, KeyError):
+                return None
+        return base64.urlsafe_b64encode(
+            json.dumps(
+                {"username": username, "password": password, "serveraddress": host}
+            ).encode()
+        ).decode()
+
+    @staticmethod
+    def _label_filters(labels: list[str] | None):
+        return {"filters": json.dumps({"label": labels})} if labels else {}
+
+    async def get_containers(self, labels: list[str] | None = None):
+        with self._timeout("container", "ls"):
+            try:
+                resp = await self.request(
+                    "GET",
+                    "/containers/json",
+                    params={"all": "true", **self._label_filters(labels)},
+                )
+            except HTTPError as e:
+                return self._unreachable(e)
+            if resp.is_error:
+                return "", self._error(resp), 1
+
+            containers = [
+                {
+                    "ID": container["Id"][:12],
+                    "Image": container["Image"],
+                    "Command": container.get("Command", ""),
+                    "Labels": ",".join(
+                        f"{k}={v}" for k, v in (container.get("Labels") or {}).items()
+                    ),
+                    "Names": ",".join(name.lstrip("/") for name in container["Names"]),
+                    "Networks": ",".join(
+                        ((container.get("NetworkSettings") or {}).get("Networks") or {}).keys()
+                    ),
+                    "State": container.get("State", ""),
+                    "Status": container.get("Status", ""),
+                }
+                for container in resp.json()
+            ]
+            return containers or "", "", 0
+
+    async def get_images(self, labels: list[str] | None = None):
+        with self._timeout("image", "ls"):
+            try:
+                resp = await self.request(
+                    "GET",
+                    "/images/json",
+                    params={"all": "true", **self._label_filters(labels)},
+                )
+            except HTTPError as e:
+                return self._unreachable(e)
+            if resp.is_error:
+                return "", self._error(resp), 1
+
+            images = []
+            for image in resp.json():
+                repo_digests = {
+                    digest.split("@")[0]: digest.split("@")[1]
+                    for digest in image.get("RepoDigests") or []
+                }
+                for repo_tag in image.get("RepoTags") or ["<none>:<none>"]:
+                    repository, tag = repo_tag.rsplit(":", maxsplit=1)
+                    images.append(
+                        {
+                            "ID": image["Id"].removeprefix("sha256:")[:12],
+                            "Repository": repository,
+                            "Tag": tag,
+                            "Digest": repo_digests.get(repository, "<none>"),
+                            "Labels": ",".join(
+                                f"{k}={v}" for k, v in (image.get("Labels") or {}).items()
+                            ),
+                        }
+                    )
+            return images or "", "", 0
+
+    async def remove_images(self, identifiers: list[str]):
+        with self._timeout("image", "remove", *identifiers):
+            stdout, stderr, code = [], [], 0
+            for identifier in identifiers:
+                try:
+                    resp = await self.request("DELETE", f"/images/{identifier}")
+                except HTTPError as e:
+                    return self._unreachable(e)
+                if resp.is_error:
+                    stderr.append(self._error(resp))
+                    code = 1
+                    continue
+                for item in resp.json():
+                    stdout.extend(f"{k}: {v}" for k, v in item.items())
+            return "\n".join(stdout), "\n".join(stderr), code
+
+    async def pull_image(self, image: str):
+        with self._timeout("image", "pull", image):
+            repository, tag = split_image(image)
+            auth = self._registry_auth(image)
+            try:
+                async with self.client.stream(
+                    "POST",
+                    "/images/create",
+                    params={"fromImage": repository, "tag": tag},
+                    headers={"X-Registry-Auth": auth} if auth else None,
+                    timeout=Timeout(None, connect=5),
+                ) as resp:
+                    if resp.is_error:
+                        await resp.aread()
+                        return "", self._error(resp), 1
+                    status = ""
+                    async for line in resp.aiter_lines():
+                        if not line:
+                            continue
+                        message = json.loads(line)
+                        if "error" in message:
+                            return "", f"Error response from daemon: {message['error']}", 1
+                        status = message.get("status", status)
+            except HTTPError as e:
+                return self._unreachable(e)
+            return status, "", 0
+
+    async def run_container(
+        self,
+        image: str,
+        network: str | None = None,
+        container_name: str | None = None,
+        restart: str | None = None,
+        labels: list[str] | None = None,
+        pull: bool | None = True,
+        resources: dict | None = None,  # HostConfig limits
+        healthcheck: dict | None = None,
+    ):
+        with self._timeout("container", "run", image):
+            if pull:
+                stdout, stderr, code = await self.pull_image(image)
+                if code:
+                    return stdout, stderr, code
+
+            host_config: dict = {"AutoRemove": not restart}
+            if restart:
+                host_config["RestartPolicy"] = {"Name": restart}
+            if network:
+                host_config["NetworkMode"] = network
+            host_config.update(resources or {})
+            body = {
+                "Image": image,
+                "Labels": dict(label.split("=", maxsplit=1) for label in labels or []),
+                "HostConfig": host_config,
+            }
+            if healthcheck:
+                body["Healthcheck"] = healthcheck
+            params = {"name": container_name} if container_name else None
+
+            try:
+                resp = await self.request(
+                    "POST", "/containers/create", params=params, json=body
+                )
+                if resp.status_code == 404 and pull is None:
+                    stdout, stderr, code = await self.pull_image(image)
+                    if code:
+                        return stdout, stderr, code
+                    resp = await self.request(
+                        "POST", "/containers/create", params=params, json=body
+                    )
+                if resp.is_error:
+                    return "", self._error(resp), 1
+
+                container_id = resp.json()["Id"]
+                resp = await self.request("POST", f"/containers/{container_id}/start")
+            except HTTPError as e:
+                return self._unreachable(e)
+            if resp.is_error:
+                return "", self._error(resp), 1
+            return container_id, "", 0
+
+    async def inspect_container(self, identifier: str):
+        with self._timeout("container", "inspect", identifier):
+            try:
+                resp = await self.request("GET", f"/containers/{identifier}/json")
+            except HTTPError as e:
+                return self._unreachable(e)
+            if resp.is_error:
+                return "", self._error(resp), 1
+            return resp.json(), "", 0
+
+    async def start_container(self, identifier: str):
+        with self._timeout("container", "start", identifier):
+            try:
+                resp = await self.request("POST", f"/containers/{identifier}/start")
+            except HTTPError as e:
+                return self._unreachable(e)
+            if resp.is_error:
+                return "", self._error(resp), 1
+            return identifier, "", 0
+
+    async def stop_container(self, identifier: str):
+        with self._timeout("container", "stop", identifier):
+            try:
+                resp = await self.request("POST", f"/containers/{identifier}/stop")
+            except HTTPError as e:
+                return self._unreachable(e)
+            if resp.is_error:
+                return "", self._error(resp), 1
+            return identifier, "", 0
+
+    async def remove_container(self, identifier: str):
+        with self._timeout("container", "remove", identifier):
+            try:
+                resp = await self.request("DELETE", f"/containers/{identifier}")
+            except HTTPError as e:
+                return self._unreachable(e)
+            if resp.is_error:
+                return "", self._error(resp), 1
+            return identifier, "", 0
+
+    async def info(self):
+        with self._timeout("info"):
+            try:
+                resp = await self.request("GET", "/info")
+            except HTTPError as e:
+                return self._unreachable(e)
+            if resp.is_error:
+                return "", self._error(resp), 1
+            return resp.json(), "", 0
+
+    async def events(self, filters: dict[str, list[str]]):
+        async with self.client.stream(
+            "GET",
+            "/events",
+            params={"filters": json.dumps(filters)},
+            timeout=Timeout(None, connect=5),
+        ) as resp:
+            if resp.is_error:
+                await resp.aread()
+                raise Exception(self._error(resp))
+            async for line in resp.aiter_lines():
+                if line:
+                    yield json.loads(line)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+_engines: dict[str, DockerEngine | None] = {}
+
+
+class UnresolvedEngine:
+    # Stands in for a context that failed to resolve, every call fails like the CLI would
+    def __init__(self, error: str):
+        self.error = error
+
+    async def _fail(self, *args, **kwargs):
+        return "", self.error, 1
+
+    def __getattr__(self, name: str):
+        return self._fail
+
+    async def events(self, filters: dict[str, list[str]]):
+        raise Exception(self.error)
+        yield
+
+
+def get_engine(
+    docker_context: str = "default",
+    credentials: dict[str, tuple[str, str]] | None = None,
+) -> DockerEngine | None:
+    # None if the context can only be reached through the CLI (e.g. ssh://)
+    if docker_context not in _engines:
+        host, tls_files, skip_tls_verify = resolve_docker_host(docker_context)
+        if host.startswith("unix://") or host.startswith("tcp://"):
+            logger.debug(f"Using Engine API at {host} for docker context {docker_context}")
+            _engines[docker_context] = DockerEngine(
+                host, tls_files, skip_tls_verify, credentials
+            )
+        else:
+            logger.info(f"Falling back to docker CLI for context {docker_context} ({host})")
+            _engines[docker_context] = None
+    return _engines[docker_context]
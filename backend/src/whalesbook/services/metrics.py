@@ -0,0 +1,147 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable
+import math
+import time
+
+# Prometheus text exposition without the client library, just enough for whalesbook
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+LabelValues = tuple[str, ...]
+
+
+def escape(value: str) -> str:
+    return escape_help(value).replace('"', '\\"')
+
+
+def escape_help(value: str) -> str:
+    # HELP text keeps its double quotes
+    return value.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        registry.append(self)
+
+    def key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def format_labels(self, values: LabelValues, extra: dict[str, str] | None = None) -> str:
+        pairs = list(zip(self.labelnames, values)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+    @abstractmethod
+    def samples(self) -> list[str]: ...
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {escape_help(self.documentation)}\n# TYPE {self.name} {self.type}\n"
+        return header + "".join(f"{sample}\n" for sample in self.samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[LabelValues, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels: str):
+        self.values[self.key(labels)] += amount
+
+    def samples(self) -> list[str]:
+        return [
+            f"{self.name}{self.format_labels(key)} {format_value(value)}"
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        collect: Callable[[], dict[LabelValues, float]] | None = None,  # read on every scrape
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[LabelValues, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, **labels: str):
+        self.values[self.key(labels)] = value
+
+    def samples(self) -> list[str]:
+        values = self.collect() if self.collect else self.values
+        return [
+            f"{self.name}{self.format_labels(key)} {format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts: dict[LabelValues, list[int]] = {}
+        self.sums: dict[LabelValues, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels: str):
+        key = self.key(labels)
+        counts = self.counts.setdefault(key, [0] * len(self.buckets))
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        samples = []
+        for key, counts in sorted(self.counts.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = self.format_labels(key, {"le": format_value(bucket)})
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            samples.append(f"{self.name}_sum{self.format_labels(key)} {format_value(self.sums[key])}")
+            samples.append(f"{self.name}_count{self.format_labels(key)} {cumulative}")
+        return samples
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    return "".join(metric.render() for metric in registry)
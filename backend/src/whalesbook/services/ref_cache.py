@@ -0,0 +1,82 @@
+import time
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+import anyio
+import logging
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+T = TypeVar("T")
+
+
+class Fetch(Generic[T]):
+    # One in-flight fetch, its waiters read the outcome once done is set
+    def __init__(self):
+        self.done = anyio.Event()
+        self.value: T | None = None
+        self.error: BaseException | None = None
+        self.cancelled = False
+
+
+class RefCache(Generic[K, T]):
+    def __init__(self, fetch: Callable[[K], Awaitable[T]], ttl: float = 60):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._fetch = fetch
+        self._entries: dict[K, tuple[float, T]] = {}
+        self._inflight: dict[K, Fetch[T]] = {}
+
+    async def get(self, key: K, ttl: float | None = None) -> T:
+        ttl = self.ttl if ttl is None else ttl
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[0] < ttl:
+            self.hits += 1
+            return entry[1]
+
+        while fetch := self._inflight.get(key):
+            # Someone is already fetching this key, wait for its result
+            self.coalesced += 1
+            await fetch.done.wait()
+            if fetch.error:
+                raise fetch.error
+            if not fetch.cancelled:
+                return fetch.value  # type: ignore
+            # The owner was cancelled, the first waiter to get here fetches again
+
+        self.misses += 1
+        self._inflight[key] = fetch = Fetch()
+        try:
+            fetch.value = await self._fetch(key)
+            self._entries[key] = (time.monotonic(), fetch.value)
+            return fetch.value
+        except Exception as e:
+            self._entries.pop(key, None)
+            fetch.error = e
+            raise
+        except BaseException:
+            fetch.cancelled = True
+            raise
+        finally:
+            del self._inflight[key]
+            fetch.done.set()
+
+    def keys(self) -> list[K]:
+        return list(self._entries)
+
+    def invalidate(self, key: K | None = None):
+        if key is None:
+            logger.debug("Invalidating all cached refs")
+            self._entries.clear()
+        else:
+            logger.debug(f"Invalidating cached refs of {key}")
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
@@ -1,19 +1,54 @@
+import json
 import ssl
+from importlib.util import find_spec
 from typing import Any
 from pathlib import Path
-from httpx import AsyncClient, BasicAuth
+from httpx import AsyncClient, BasicAuth, Limits, Response, Timeout, TransportError
 from pydantic import BaseModel, HttpUrl, field_validator
 from urllib import parse
+import anyio
 import logging
+from .metrics import Histogram
 
 logger = logging.getLogger(__name__)
 
+MANIFEST_TYPES = ", ".join(
+    (
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+    )
+)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+REQUEST_DURATION = Histogram(
+    "whalesbook_registry_request_duration_seconds",
+    "Registry API request latency per attempt",
+    ("method", "endpoint", "status"),
+)
+
+
+def registry_endpoint(url: str) -> str:
+    # Repository names and references left out, e.g. manifests or tags/list
+    path = parse.urlsplit(url).path
+    for endpoint in ("_catalog", "tags/list", "manifests", "blobs/uploads", "blobs"):
+        if f"/{endpoint}" in f"/{path}":
+            return endpoint
+    return "other"
+
 
 class RegistryConfig(BaseModel):
     url: HttpUrl = HttpUrl(url="https://localhost:5000")
     username: str | None = None  # TODO: from docker config or manually login
     password: str | None = None
     cafile: Path | None = None
+    max_connections: int = 32
+    http2: bool = False  # needs the h2 package
+    retries: int = 3  # transient errors (connection, 429, 5xx) are retried with backoff
+    retry_backoff: float = 0.5  # seconds, doubled on every attempt
+    page_size: int = 1000  # catalog and tag list page size
+    delete_concurrency: int = 8
 
     @field_validator("url", mode="before")
     @classmethod
@@ -31,10 +66,15 @@ class Registry:
         self._username = registry_config.username
         self._password = registry_config.password
         self._cafile = registry_config.cafile
+        self._config = registry_config
         self.client: AsyncClient
         self.repositories: list[str] = []
 
     async def init(self):
+        http2 = self._config.http2
+        if http2 and not find_spec("h2"):
+            logger.warning("HTTP/2 needs the h2 package, using HTTP/1.1")
+            http2 = False
         self.client = AsyncClient(
             base_url=str(self._base_url),
             auth=(
@@ -45,36 +85,168 @@ class Registry:
             verify=ssl.create_default_context(cafile=self._cafile)
             if self._cafile
             else True,
+            limits=Limits(
+                max_connections=self._config.max_connections,
+                max_keepalive_connections=self._config.max_connections,
+            ),
+            timeout=Timeout(30, connect=5),
+            http2=http2,
         )
-        await self.update_catalog()
+
+    async def request(self, method: str, url: str, **kwargs) -> Response:
+        retries = self._config.retries
+        for attempt in range(retries + 1):
+            delay = self._config.retry_backoff * 2**attempt
+            labels = {"method": method, "endpoint": registry_endpoint(url)}
+            start = anyio.current_time()
+            try:
+                resp = await self.client.request(method, url, **kwargs)
+            except TransportError as e:
+                REQUEST_DURATION.observe(anyio.current_time() - start, status="error", **labels)
+                if attempt == retries:
+                    raise
+                logger.debug(f"Retrying {method} {url} in {delay}s: {e!r}")
+            else:
+                REQUEST_DURATION.observe(
+                    anyio.current_time() - start, status=str(resp.status_code), **labels
+                )
+                if resp.status_code not in RETRY_STATUS or attempt == retries:
+                    return resp
+                if (retry_after := resp.headers.get("retry-after", "")).isdigit():
+                    delay = max(delay, int(retry_after))
+                logger.debug(f"Retrying {method} {url} in {delay}s: {resp.status_code}")
+            await anyio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    async def get_pages(self, url: str, key: str, error: str) -> list[str]:
+        # Follows the Link header, registries truncate long lists without it
+        items: list[str] = []
+        next_url: str | None = url
+        params: dict | None = {"n": self._config.page_size}
+        while next_url:
+            resp = await self.request("GET", next_url, params=params)
+            if not resp.status_code == 200:
+                raise Exception(error, resp.status_code, resp.url)
+            items.extend(resp.json().get(key) or [])
+            next_link = resp.links.get("next", {}).get("url")
+            next_url = parse.urljoin(str(resp.url), next_link) if next_link else None
+            params = None  # part of the next link
+        return items
 
     async def update_catalog(self) -> list[str]:
-        resp = await self.client.get("_catalog")
-        if not resp.status_code == 200:
-            raise Exception("Failed to get catalog", resp.status_code, resp.url)
-        self.repositories = resp.json()["repositories"]
+        # Walks every repository of the registry, only on demand
+        self.repositories = await self.get_pages("_catalog", "repositories", "Failed to get catalog")
         return self.repositories
 
     async def get_tags(self, repository: str) -> list[str]:
-        resp = await self.client.get(f"{repository}/tags/list")
-        if not resp.status_code == 200:
-            raise Exception("Failed to get tags", resp.status_code, repository)
-        return resp.json()["tags"]
+        return await self.get_pages(f"{repository}/tags/list", "tags", "Failed to get tags")
 
     async def delete_by_tag(self, repository: str, tag: str):
         logger.info(f"Deleting {tag} in repository {repository}")
 
-        tag_manifest = await self.client.get(
-            f"{repository}/manifests/{tag}",
-            headers={"Accept": "application/vnd.docker.distribution.manifest.v2+json"},
-        )
-        digest = tag_manifest.headers["docker-content-digest"]
+        digest = await self.get_digest(repository, tag)
+        if digest is None:
+            logger.info(f"{tag} in repository {repository} is already gone")
+            return
 
-        delete_result = await self.client.delete(f"{repository}/manifests/{digest}")
-        if not delete_result.status_code == 202:
+        delete_result = await self.request("DELETE", f"{repository}/manifests/{digest}")
+        if delete_result.status_code not in (202, 404):
             raise Exception(f"Failed to delete {repository}:{tag}\n\tDigest: {digest}")
         logger.info(f"Deleted {tag} in repository {repository}")
 
+    async def delete_tags(self, repository: str, tags: list[str]) -> list[str]:
+        # Returns the tags that failed to delete
+        limiter = anyio.CapacityLimiter(self._config.delete_concurrency)
+        failed: list[str] = []
+
+        async def delete(tag: str):
+            async with limiter:
+                try:
+                    await self.delete_by_tag(repository, tag)
+                except Exception as e:
+                    logger.error(f"Failed to delete {repository}:{tag}: {e}")
+                    failed.append(tag)
+
+        async with anyio.create_task_group() as tg:
+            for tag in tags:
+                tg.start_soon(delete, tag)
+        return failed
+
+    async def get_digest(self, repository: str, reference: str) -> str | None:
+        resp = await self.request(
+            "HEAD", f"{repository}/manifests/{reference}", headers={"Accept": MANIFEST_TYPES}
+        )
+        if resp.status_code == 404:
+            return None
+        if not resp.status_code == 200:
+            raise Exception("Failed to get digest", resp.status_code, repository, reference)
+        return resp.headers["docker-content-digest"]
+
+    async def get_manifest(self, repository: str, reference: str) -> tuple[bytes, str]:
+        resp = await self.request(
+            "GET", f"{repository}/manifests/{reference}", headers={"Accept": MANIFEST_TYPES}
+        )
+        if not resp.status_code == 200:
+            raise Exception("Failed to get manifest", resp.status_code, repository, reference)
+        return resp.content, resp.headers["content-type"]
+
+    async def put_manifest(
+        self, repository: str, reference: str, manifest: bytes, content_type: str
+    ):
+        resp = await self.request(
+            "PUT",
+            f"{repository}/manifests/{reference}",
+            content=manifest,
+            headers={"Content-Type": content_type},
+        )
+        if not resp.status_code == 201:
+            raise Exception("Failed to put manifest", resp.status_code, repository, reference)
+
+    async def mount_blob(self, repository: str, digest: str, from_repository: str):
+        resp = await self.request(
+            "POST",
+            f"{repository}/blobs/uploads/",
+            params={"mount": digest, "from": from_repository},
+        )
+        if not resp.status_code == 201:
+            raise Exception("Failed to mount blob", resp.status_code, repository, digest)
+
+    async def copy_manifest(
+        self,
+        repository: str,
+        reference: str,
+        target_reference: str,
+        from_repository: str | None = None,
+    ):
+        from_repository = from_repository or repository
+        manifest, content_type = await self.get_manifest(from_repository, reference)
+
+        if from_repository != repository:
+            content = json.loads(manifest)
+            # Child manifests of an index and blobs must exist in the target repository
+            for child in content.get("manifests", []):
+                await self.copy_manifest(
+                    repository, child["digest"], child["digest"], from_repository
+                )
+            async with anyio.create_task_group() as tg:
+                for blob in [content.get("config"), *content.get("layers", [])]:
+                    if blob:
+                        tg.start_soon(self.mount_blob, repository, blob["digest"], from_repository)
+
+        await self.put_manifest(repository, target_reference, manifest, content_type)
+
+    async def retag(
+        self,
+        repository: str,
+        tag: str,
+        new_tag: str,
+        from_repository: str | None = None,
+    ):
+        logger.info(
+            f"Retagging {from_repository or repository}:{tag} as {repository}:{new_tag}"
+        )
+        await self.copy_manifest(repository, tag, new_tag, from_repository)
+
 
 async def create_registry(registry_config: RegistryConfig):
     registry = Registry(registry_config)
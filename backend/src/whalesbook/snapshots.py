@@ -0,0 +1,235 @@
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterable
+from anyio.abc import TaskGroup
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
+from pydantic import HttpUrl
+import anyio
+import time
+from . import config, docker
+from .config import Book
+from .services.metrics import Gauge
+from .state import (
+    MainTag,
+    RefState,
+    get_all_refs_state,
+    get_refs_state,
+    record_exit,
+    state_listeners,
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+BookState = dict[str, dict[str, RefState]]
+
+
+class BookSnapshots:
+    def __init__(self):
+        self._states: dict[str, BookState] = {}
+        self._errors: dict[str, Exception] = {}
+        self._refreshed: dict[str, float] = {}
+        self._running: dict[str, anyio.Event] = {}
+        self._pending: set[str] = set()
+        self._subscribers: dict[str, set[MemoryObjectSendStream[dict]]] = defaultdict(set)
+        self._watchers: dict[str, tuple[list[Book], anyio.CancelScope]] = {}
+        self._task_group: TaskGroup | None = None
+        self.refreshes = 0
+        self.events = 0
+
+    @property
+    def registry_url(self) -> HttpUrl:
+        return config.settings.docker_registry.url  # type: ignore
+
+    async def get(self, book: Book) -> BookState:
+        if book.name not in self._states:
+            if done := self._running.get(book.name):
+                await done.wait()
+            else:
+                await self.refresh(book)
+            if book.name not in self._states:
+                raise self._errors[book.name]
+        return self._states[book.name]
+
+    async def refresh(self, book: Book):
+        if done := self._running.get(book.name):
+            # Refresh again once the running one is done, changes may have been missed
+            self._pending.add(book.name)
+            await done.wait()
+            return
+
+        done = self._running[book.name] = anyio.Event()
+        try:
+            while True:
+                self._pending.discard(book.name)
+                try:
+                    states = await get_refs_state(self.registry_url, book)
+                    self._publish(book.name, self._states.get(book.name, {}), states)
+                    self._states[book.name] = states
+                    self._refreshed[book.name] = time.time()
+                    self._errors.pop(book.name, None)
+                except Exception as e:
+                    logger.warning(f"Failed to refresh state of book {book.name}: {e}")
+                    self._errors[book.name] = e
+                self.refreshes += 1
+                if book.name not in self._pending:
+                    break
+        finally:
+            del self._running[book.name]
+            done.set()
+
+    async def get_all(self, books: list[Book]) -> dict[str, BookState]:
+        if missing := [book for book in books if book.name not in self._states]:
+            await self.refresh_all(missing)
+        return {book.name: self._states[book.name] for book in books if book.name in self._states}
+
+    async def refresh_all(self, books: list[Book]):
+        # One container listing per runner instead of one per book
+        if not books:
+            return
+        try:
+            all_states = await get_all_refs_state(self.registry_url, books)
+        except Exception as e:
+            logger.warning(f"Failed to refresh state of books: {e}")
+            return
+        now = time.time()
+        for book_name, states in all_states.items():
+            self._publish(book_name, self._states.get(book_name, {}), states)
+            self._states[book_name] = states
+            self._refreshed[book_name] = now
+            self._errors.pop(book_name, None)
+        self.refreshes += 1
+
+    @asynccontextmanager
+    async def subscribe(self, book: Book) -> AsyncIterator[MemoryObjectReceiveStream[dict]]:
+        # Ref state changes of the book, closed if the subscriber falls behind
+        send, receive = anyio.create_memory_object_stream[dict](100)
+        self._subscribers[book.name].add(send)
+        try:
+            yield receive
+        finally:
+            self._subscribers[book.name].discard(send)
+            send.close()
+            receive.close()
+
+    def _publish(self, book_name: str, old: BookState, new: BookState):
+        changes = [
+            {"repo": repo_name, "ref": ref_name, "state": state.model_dump(mode="json")}
+            for repo_name, refs in new.items()
+            for ref_name, state in refs.items()
+            if old.get(repo_name, {}).get(ref_name) != state
+        ] + [
+            {"repo": repo_name, "ref": ref_name, "state": None}
+            for repo_name, refs in old.items()
+            for ref_name in refs
+            if ref_name not in new.get(repo_name, {})
+        ]
+        for send in list(self._subscribers[book_name]):
+            try:
+                for change in changes:
+                    send.send_nowait(change)
+            except (anyio.WouldBlock, anyio.ClosedResourceError):
+                logger.info(f"Dropping slow state subscriber of book {book_name}")
+                self._subscribers[book_name].discard(send)
+                send.close()
+
+    async def watch(
+        self, docker_context: str, books: list[Book], refresh: list[Book] | None = None
+    ):
+        while True:
+            try:
+                # Events may have been missed while disconnected, a restart only refreshes new books
+                await self.refresh_all(books if refresh is None else refresh)
+                refresh = None
+
+                async with anyio.create_task_group() as tg:
+                    async for event in docker.container_events(
+                        ["whalesbook.main_tag"], ["start", "stop", "die"], docker_context
+                    ):
+                        self.events += 1
+                        main_tag = (event.get("Actor") or {}).get("Attributes", {}).get(
+                            "whalesbook.main_tag", ""
+                        )
+                        book_name_registry = MainTag.model_validate(main_tag).book_name_registry
+                        for book in books:
+                            if book.name_registry != book_name_registry:
+                                continue
+                            if event.get("Action") == "die":
+                                tg.start_soon(self.died, book, event, docker_context)
+                            else:
+                                tg.start_soon(self.refresh, book)
+            except Exception as e:
+                logger.warning(f"Lost docker events of context {docker_context}: {e}")
+            await anyio.sleep(5)
+
+    async def died(self, book: Book, event: dict, docker_context: str):
+        await record_exit(book, event, docker_context)
+        await self.refresh(book)
+
+    async def resync(self):
+        while True:
+            await anyio.sleep(config.settings.snapshot.resync_interval)
+            await self.refresh_all(config.settings.books)
+
+    async def _watch(
+        self, scope: anyio.CancelScope, docker_context: str, books: list[Book], refresh: list[Book]
+    ):
+        with scope:
+            await self.watch(docker_context, books, refresh)
+
+    async def run(self):
+        async with anyio.create_task_group() as tg:
+            self._task_group = tg
+            self.restart()
+            tg.start_soon(self.resync)
+
+    def restart(self, changed_books: Iterable[str] = ()):
+        # Called on config reloads, unchanged books keep their objects and their runner's watcher
+        for book_name in changed_books:
+            self._states.pop(book_name, None)
+            self._refreshed.pop(book_name, None)
+        if not self._task_group:
+            return
+
+        runners: dict[str, list[Book]] = {}
+        for book in config.settings.books:
+            for runner in book.runners:
+                runners.setdefault(runner, []).append(book)
+        for docker_context in self._watchers.keys() - runners.keys():
+            self._watchers.pop(docker_context)[1].cancel()
+        for docker_context, books in runners.items():
+            old_books, old_scope = self._watchers.get(docker_context, ([], None))
+            if old_scope and list(map(id, old_books)) == list(map(id, books)):
+                continue
+            if old_scope:
+                old_scope.cancel()
+            scope = anyio.CancelScope()
+            self._watchers[docker_context] = (books, scope)
+            refresh = [book for book in books if not any(book is old for old in old_books)]
+            self._task_group.start_soon(self._watch, scope, docker_context, books, refresh)
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "books": len(self._states),
+            "refreshes": self.refreshes,
+            "events": self.events,
+            "subscribers": sum(len(subscribers) for subscribers in self._subscribers.values()),
+            "oldest": min(self._refreshed.values(), default=0),
+        }
+
+
+book_snapshots = BookSnapshots()
+state_listeners.append(book_snapshots.refresh)
+
+# From the snapshots, so scrapes never list containers
+Gauge(
+    "whalesbook_containers_running",
+    "Running ref containers of each book",
+    ("book",),
+    lambda: {
+        (book_name,): sum(
+            ref_state.state == "running" for refs in states.values() for ref_state in refs.values()
+        )
+        for book_name, states in book_snapshots._states.items()
+    },
+)
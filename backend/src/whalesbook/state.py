@@ -1,20 +1,39 @@
+from collections import defaultdict
 import anyio
-from .config import Book
+from . import config
+from .config import Book, Ref, Repo, ResourceLimits
 from .services.cli_runner import CliInstance
+from .services.metrics import Histogram
 from .services.registry import Registry, RegistryConfig
+from .services.ref_cache import RefCache
 from . import docker
-from typing import Any, Literal
+from .builds import build_queue
+from .mirrors import git_mirrors
+from .placement import Placement
+from .readiness import healthcheck, wait_ready
+from .store import store
+from typing import Any, Awaitable, Callable, Iterable, Literal
 from pydantic import (
     HttpUrl,
     BaseModel,
     model_validator,
     field_validator,
 )
+from functools import partial
 import logging
 import re
 
 logger = logging.getLogger(__name__)
 
+BUILD_DURATION = Histogram(
+    "whalesbook_build_duration_seconds",
+    "Ref builds from queueing to push, waits on identical in-flight builds included",
+    ("book", "outcome"),
+)
+RECONCILE_DURATION = Histogram(
+    "whalesbook_reconcile_duration_seconds", "Container reconciles of a book", ("book",)
+)
+
 
 class MainTag(BaseModel):
     registry_url: HttpUrl | None = None  # http[s]://HOST[:PORT]
@@ -68,65 +87,236 @@ class MainTag(BaseModel):
         return data
 
 
-async def ls_remote(repo_url: str) -> list[tuple[str, str]]:
-    cli = CliInstance()
+async def ls_remote(
+    repo_url: str, patterns: Iterable[str] = ()
+) -> list[tuple[str, str]]:
+    if config.settings.git.mirror_dir and config.settings.git.mirror_refs:
+        return await git_mirrors.ls_remote(repo_url, patterns)
+
+    patterns = sorted(patterns)
+    cli = CliInstance(config.settings.process.git_timeout)
     cli.add_arg("git")
     cli.add_arg("ls-remote")
+    # Only ask the server for the namespaces we track, patterns filter the rest
+    if patterns and all(p.startswith(("refs/heads/", "refs/tags/")) for p in patterns):
+        if any(p.startswith("refs/heads/") for p in patterns):
+            cli.add_arg("--heads")
+        if any(p.startswith("refs/tags/") for p in patterns):
+            cli.add_arg("--tags")
     cli.add_arg(repo_url)
+    cli.add_arg(*patterns)
 
     logger.info(f"Fetching refs from {repo_url}")
     stdout, stderr, code = await cli.run()
     if code:
         raise Exception("ls-remote failed", stdout, stderr, code)
-    return [tuple(line.split()) for line in stdout.split("\n")]  # type: ignore
+    return [tuple(line.split()) for line in stdout.split("\n") if line]  # type: ignore
 
 
-async def get_tracking_ref_pairs(book: Book):
-    tracking_ref_pairs: set[tuple[str, str]] = set()
-    for repo in book.repos:
-        tracking_refs_names = [ref.name for ref in repo.refs]
-        repo_refs_all = await ls_remote(repo.url)
-        tracking_ref_pairs.update(
-            [item for item in repo_refs_all if item[1] in tracking_refs_names]
-        )
-    return tracking_ref_pairs
+ref_cache: RefCache[tuple[str, tuple[str, ...]], list[tuple[str, str]]] = RefCache(
+    lambda key: ls_remote(*key)
+)
 
 
-async def get_new_refs(registry: Registry, book: Book):
-    outdated_registry_hashes: set[str] = set()
-    ref_pairs_to_update: set[tuple[str, str]] = set()
+def invalidate_refs(repo_url: str | None = None):
+    for key in ref_cache.keys():
+        if repo_url is None or key[0] == repo_url:
+            ref_cache.invalidate(key)
+
 
-    # Old hashes from registry
-    registry_repo_tags = (
-        await registry.get_tags(book.name_registry)
-        if book.name_registry in registry.repositories
-        else []
+# Called when ref states of a book change outside of container events (builds)
+state_listeners: list[Callable[[Book], Awaitable[Any]]] = []
+
+
+async def notify_state_changed(book: Book):
+    for listener in state_listeners:
+        try:
+            await listener(book)
+        except Exception as e:
+            logger.warning(f"State listener failed for book {book.name}: {e}")
+
+
+async def ls_remote_all(repos: Iterable[Repo]) -> dict[str, list[tuple[str, str]]]:
+    # One ls-remote per distinct url, shared by every book and repo tracking it
+    repos = list(repos)
+    patterns: dict[str, set[str]] = {repo.url: set() for repo in repos}
+    for repo in repos + [r for book in config.settings.books for r in book.repos]:
+        if repo.url in patterns:
+            patterns[repo.url].update(ref.name for ref in repo.refs)
+
+    remote_refs: dict[str, list[tuple[str, str]]] = {}
+    limiter = anyio.CapacityLimiter(config.settings.git.max_concurrent_remotes)
+
+    async def fetch(repo_url: str):
+        async with limiter:
+            try:
+                remote_refs[repo_url] = await ref_cache.get(
+                    (repo_url, tuple(sorted(patterns[repo_url]))),
+                    config.settings.git.ref_cache_ttl,
+                )
+            except Exception as e:
+                logger.error(f"Failed to fetch refs from {repo_url}: {e}")
+
+    async with anyio.create_task_group() as tg:
+        for repo_url in patterns:
+            tg.start_soon(fetch, repo_url)
+    return remote_refs
+
+
+async def get_tracking_refs(
+    book: Book, remote_refs: dict[str, list[tuple[str, str]]] | None = None
+) -> list[tuple[Repo, Ref, str]]:
+    # (repo, ref, hash) for every remote ref matching a tracked name or pattern
+    if remote_refs is None:
+        remote_refs = await ls_remote_all(book.repos)
+
+    tracking_refs: list[tuple[Repo, Ref, str]] = []
+    for repo in book.repos:
+        if repo.url not in remote_refs:
+            raise Exception(f"No refs fetched from {repo.url}")
+        for git_hash, ref_name in remote_refs[repo.url]:
+            if ref := repo.match_ref(ref_name):
+                tracking_refs.append((repo, ref, git_hash))
+    return tracking_refs
+
+
+async def get_tracking_ref_pairs(
+    book: Book, remote_refs: dict[str, list[tuple[str, str]]] | None = None
+):
+    return set(
+        (git_hash, ref.name)
+        for _, ref, git_hash in await get_tracking_refs(book, remote_refs)
     )
-    registry_hashes = [tag for tag in registry_repo_tags if tag.startswith("git-")]
-    logger.debug(f"Registry_hashes: {registry_hashes}")
+
+
+async def get_new_refs(
+    registry: Registry,
+    book: Book,
+    remote_refs: dict[str, list[tuple[str, str]]] | None = None,
+):
+    ref_pairs_to_update: set[tuple[str, str]] = set()
 
     # Git remote
-    tracking_ref_pairs: set[tuple[str, str]] = await get_tracking_ref_pairs(book)
-    logger.debug(f"tracking_ref_pairs: {tracking_ref_pairs}")
-
-    ref_name_to_subdomain_name = {
-        ref.name: ref.subdomain_name for repo in book.repos for ref in repo.refs
-    }  # subdomain name == registry repo tag
-    for ref_pair in tracking_ref_pairs:
-        if (
-            ref_name_to_subdomain_name[ref_pair[1]] not in registry_repo_tags
-            or f"git-{ref_pair[0]}" not in registry_repo_tags
-        ):
-            ref_pairs_to_update.add(ref_pair)
+    tracking_refs = await get_tracking_refs(book, remote_refs)
+    logger.debug(f"tracking_refs: {tracking_refs}")
+
+    store.record_refs(
+        book.name,
+        [
+            (repo.name, ref.name, ref.subdomain_name, git_hash)  # type: ignore
+            for repo, ref, git_hash in tracking_refs
+        ],
+    )
+    known_digests = store.get_digests(book.name)
+
+    async def check(ref: Ref, git_hash: str):
+        # Up to date when the subdomain tag points at the image of git-<hash>,
+        # a ref moved to an already built commit leaves its subdomain tag stale
+        digest = known_digests.get(ref.subdomain_name)  # type: ignore
+        if digest and digest == known_digests.get(f"git-{git_hash}"):
+            return
+        try:
+            digest = await registry.get_digest(book.name_registry, ref.subdomain_name)  # type: ignore
+            git_digest = await registry.get_digest(book.name_registry, f"git-{git_hash}")
+            store.record_digest(book.name, ref.subdomain_name, digest)  # type: ignore
+            store.record_digest(book.name, f"git-{git_hash}", git_digest)
+            if digest and digest == git_digest:
+                return
+        except Exception as e:
+            logger.warning(f"Failed to compare digests of {ref.name}: {e}")
+        ref_pairs_to_update.add((git_hash, ref.name))
 
-    all_hashes = [ref[0] for ref in tracking_ref_pairs]
-    for registry_hash in registry_hashes:
-        if registry_hash.replace("git-", "") not in all_hashes:
-            outdated_registry_hashes.add(registry_hash)
+    async with anyio.create_task_group() as tg:
+        for _, ref, git_hash in tracking_refs:  # subdomain name == registry repo tag
+            tg.start_soon(check, ref, git_hash)
 
     logger.debug(f"ref_pairs_to_update: {ref_pairs_to_update}")
 
-    return ref_pairs_to_update, outdated_registry_hashes
+    return ref_pairs_to_update
+
+
+async def find_built_image(
+    registry: Registry, book: Book, repo: Repo, git_hash: str
+) -> str | None:
+    # Registry repository already holding git-<hash> built the same way
+    candidates = [book.name_registry] + [
+        other.name_registry
+        for other in config.settings.books
+        if other.name_registry != book.name_registry
+        and other.docker_file == book.docker_file
+        and any(other_repo.url == repo.url for other_repo in other.repos)
+    ]
+    for candidate in candidates:
+        try:
+            if await registry.get_digest(candidate, f"git-{git_hash}"):
+                return candidate
+        except Exception as e:
+            logger.warning(f"Failed to look up git-{git_hash} in {candidate}: {e}")
+    return None
+
+
+async def retag_built_refs(
+    registry: Registry, book: Book, ref_pairs_to_update: set[tuple[str, str]]
+) -> set[tuple[str, str]]:
+    # Point refs at already built commits by copying manifests, return pairs left to build
+    ref_pairs_to_build: set[tuple[str, str]] = set()
+
+    async def retag(repo: Repo, ref: Ref, git_hash: str):
+        source = await find_built_image(registry, book, repo, git_hash)
+        if not source:
+            ref_pairs_to_build.add((git_hash, ref.name))
+            return
+        try:
+            if source != book.name_registry:
+                await registry.retag(
+                    book.name_registry, f"git-{git_hash}", f"git-{git_hash}", source
+                )
+            await registry.retag(
+                book.name_registry, f"git-{git_hash}", ref.subdomain_name  # type: ignore
+            )
+        except Exception as e:
+            logger.warning(f"Failed to retag {ref.name}, building instead: {e}")
+            ref_pairs_to_build.add((git_hash, ref.name))
+            return
+        store.record_build(book.name, ref.subdomain_name, git_hash, "retagged")  # type: ignore
+        digest = await registry.get_digest(book.name_registry, f"git-{git_hash}")
+        store.record_digest(book.name, f"git-{git_hash}", digest)
+        store.record_digest(book.name, ref.subdomain_name, digest)  # type: ignore
+
+    async with anyio.create_task_group() as tg:
+        for repo in book.repos:
+            for git_hash, ref_name in ref_pairs_to_update:
+                if ref := repo.match_ref(ref_name):
+                    tg.start_soon(retag, repo, ref, git_hash)
+
+    return ref_pairs_to_build
+
+
+async def build_ref(book: Book, ref: Ref, git_hash: str, dry_run: bool, *args, **kwargs):
+    if dry_run:
+        return await build_queue.build_image(*args, dry_run=dry_run, **kwargs)
+
+    store.record_build(book.name, ref.subdomain_name, git_hash, "building")  # type: ignore
+    await notify_state_changed(book)
+    start = anyio.current_time()
+    try:
+        stdout, stderr, code = await build_queue.build_image(*args, **kwargs)  # type: ignore
+    except Exception as e:
+        BUILD_DURATION.observe(anyio.current_time() - start, book=book.name, outcome="failed")
+        store.record_build(book.name, ref.subdomain_name, git_hash, "failed", error=str(e))  # type: ignore
+        await notify_state_changed(book)
+        raise
+    BUILD_DURATION.observe(anyio.current_time() - start, book=book.name, outcome="success")
+    log = docker.build_logs.get(args[0][0])  # missing if another book's build was awaited
+    cached_steps, total_steps = log.cache_stats if log else (None, None)
+    store.record_build(
+        book.name, ref.subdomain_name, git_hash, "success", cached_steps, total_steps  # type: ignore
+    )
+    # Pushed tags changed, digests are looked up again on the next check
+    store.record_digest(book.name, ref.subdomain_name, None)  # type: ignore
+    store.record_digest(book.name, f"git-{git_hash}", None)
+    await notify_state_changed(book)
+    return stdout, stderr, code
 
 
 async def update_images(
@@ -134,59 +324,91 @@ async def update_images(
     book: Book,
     ref_pairs_to_update: set[tuple[str, str]],
     dry_run: bool = False,
+    registry: Registry | None = None,  # tags identical in-flight builds instead of rebuilding
 ):
-    ref_pair_dicts_to_update = {
-        ref_pair[1]: ref_pair[0] for ref_pair in ref_pairs_to_update
-    }
-
     tag_name = MainTag(
         registry_url=registry_url, book_name_registry=book.name_registry
     ).to_string()
 
-    logger.debug(f"Refs to update {ref_pair_dicts_to_update.keys()}")
+    logger.debug(f"Refs to update {[ref_pair[1] for ref_pair in ref_pairs_to_update]}")
     async with anyio.create_task_group() as tg:
         for repo in book.repos:
-            for ref in repo.refs:
-                if ref.name not in ref_pair_dicts_to_update.keys():
-                    logger.debug(f"No need to update {ref.name}")
+            for git_hash, ref_name in ref_pairs_to_update:
+                if not (ref := repo.match_ref(ref_name)):
                     continue
+
+                # Own cache first, then the default branch's for new refs
+                cache_from, cache_to = [], None
+                if book.build_cache:
+                    cache_name = f"{tag_name}{book.build_cache.repository_suffix}"
+                    cache_from.append(f"{cache_name}:{ref.subdomain_name}")
+                    default_ref = repo.default_ref
+                    if default_ref and default_ref.subdomain_name != ref.subdomain_name:
+                        cache_from.append(f"{cache_name}:{default_ref.subdomain_name}")
+                    cache_to = f"{cache_name}:{ref.subdomain_name}"
+
                 tg.start_soon(
-                    docker.build_image,
-                    [
-                        f"{tag_name}:{ref.subdomain_name}",
-                        f"{tag_name}:git-{ref_pair_dicts_to_update[ref.name]}",
-                    ],
-                    f"{repo.url}#{ref_pair_dicts_to_update[ref.name]}",
-                    book.builder,
-                    book.docker_file,
-                    True,
-                    dry_run,
+                    partial(
+                        build_ref,
+                        book,
+                        ref,
+                        git_hash,
+                        dry_run,
+                        [
+                            f"{tag_name}:{ref.subdomain_name}",
+                            f"{tag_name}:git-{git_hash}",
+                        ],
+                        f"{repo.url}#{git_hash}",
+                        book.builders,
+                        book.docker_file,
+                        True,
+                        cache_from=cache_from,
+                        cache_to=cache_to,
+                        cache_mode=book.build_cache.mode if book.build_cache else "max",
+                        priority=ref.priority,
+                        affinity=repo.url,
+                        registry=registry,
+                    )
                 )
 
 
 async def delete_old_images(registry: Registry, book: Book):
-    tracking_ref_pairs = await get_tracking_ref_pairs(book)
+    tracking_refs = await get_tracking_refs(book)
     tracking_main_tags = [
         MainTag(
             registry_url=registry.url,
             book_name_registry=book.name_registry,
-            subdomain_name=ref_pair[1],
+            subdomain_name=ref.subdomain_name,
         ).to_string()
-        for ref_pair in tracking_ref_pairs
+        for _, ref, _ in tracking_refs
     ]
-    tracking_git_tags = [f"git-{ref_pair[0]}" for ref_pair in tracking_ref_pairs]
+    tracking_git_tags = [f"git-{git_hash}" for _, _, git_hash in tracking_refs]
 
     # registry
     registry_tags = await registry.get_tags(book.name_registry)
-    for tag in registry_tags:
-        if tag.startswith("git-") and tag not in tracking_git_tags:
-            try:
-                await registry.delete_by_tag(book.name_registry, tag)
-            except Exception as e:
-                logger.error(e)
+    old_git_tags = [
+        tag for tag in registry_tags if tag.startswith("git-") and tag not in tracking_git_tags
+    ]
+    failed = await registry.delete_tags(book.name_registry, old_git_tags)
+    for tag in old_git_tags:
+        if tag not in failed:
+            store.record_digest(book.name, tag, None)
+
+    # registry build cache of refs no longer tracked
+    if book.build_cache:
+        cache_repository = f"{book.name_registry}{book.build_cache.repository_suffix}"
+        tracking_subdomains = [ref.subdomain_name for _, ref, _ in tracking_refs]
+        try:
+            cache_tags = await registry.get_tags(cache_repository)
+        except Exception as e:
+            logger.debug(f"No build cache for book {book.name}: {e}")
+            cache_tags = []
+        await registry.delete_tags(
+            cache_repository, [tag for tag in cache_tags if tag not in tracking_subdomains]
+        )
 
     # builder & runner
-    for context in (book.builder, book.runner):
+    for context in dict.fromkeys((*book.builders, *book.runners)):
         images, stderr, code = await docker.get_images(
             labels=[f"whalesbook.main_tag={tag}" for tag in tracking_main_tags],
             docker_context=context,
@@ -206,35 +428,106 @@ async def delete_old_images(registry: Registry, book: Book):
             logger.info(f"No images to remove for docker context {context}")
 
 
-async def get_containers_for_book(registry_url: HttpUrl, book: Book):
-    image_prefix = MainTag(
-        registry_url=registry_url, book_name_registry=book.name_registry
-    ).to_string()
+def index_containers(containers: Iterable[dict]) -> dict[str, list[dict]]:
+    # Containers by the MainTag of their book, i.e. registry and repository without tag
+    index: dict[str, list[dict]] = defaultdict(list)
+    for container in containers:
+        try:
+            main_tag = MainTag.model_validate(parse_labels(container)["whalesbook.main_tag"])
+        except Exception:
+            continue
+        main_tag.subdomain_name = None
+        index[main_tag.to_string()].append(container)
+    return index
 
-    containers, stderr, code = await docker.get_containers(
-        labels=["whalesbook.main_tag"], docker_context=book.runner
-    )
-    if code:
+
+def book_main_tag(registry_url: HttpUrl, book: Book) -> str:
+    return MainTag(registry_url=registry_url, book_name_registry=book.name_registry).to_string()
+
+
+async def get_containers_by_book(
+    registry_url: HttpUrl, books: list[Book]
+) -> dict[str, list[dict]]:
+    # One container listing per runner context, books with an unreachable runner are left out
+    runners: dict[str, list[Book]] = defaultdict(list)
+    for book in books:
+        for runner in book.runners:
+            runners[runner].append(book)
+    containers_by_book: dict[str, list[dict]] = defaultdict(list)
+    failed: set[str] = set()
+
+    async def list_runner(docker_context: str, runner_books: list[Book]):
+        containers, stderr, code = await docker.get_containers(
+            labels=["whalesbook.main_tag"], docker_context=docker_context
+        )
+        if code:
+            logger.error(f"Failed to get containers of docker context {docker_context}")
+            failed.update(book.name for book in runner_books)
+            return
+        for container in containers or []:
+            container["DockerContext"] = docker_context  # type: ignore
+        index = index_containers(containers or [])  # type: ignore
+        for book in runner_books:
+            containers_by_book[book.name].extend(index.get(book_main_tag(registry_url, book), []))
+
+    async with anyio.create_task_group() as tg:
+        for docker_context, runner_books in runners.items():
+            tg.start_soon(list_runner, docker_context, runner_books)
+    return {book.name: containers_by_book[book.name] for book in books if book.name not in failed}
+
+
+async def get_containers_for_book(registry_url: HttpUrl, book: Book) -> list[dict]:
+    containers_by_book = await get_containers_by_book(registry_url, [book])
+    if book.name not in containers_by_book:
         raise Exception("Failed to get current containers")
+    logger.debug(f"Current containers for book {book.name}: {containers_by_book[book.name]}")
+    return containers_by_book[book.name]
 
-    containers = (
-        container
-        for container in containers
-        if image_prefix in container["Image"]  # type:ignore
-    )
-    logger.debug(f"Current containers for book {book.name}: {containers}")
-    return containers
+
+def parse_labels(container: dict) -> dict[str, str]:
+    return {
+        k: v
+        for label in container["Labels"].split(",")
+        if "=" in label
+        for k, v in [label.split("=", maxsplit=1)]
+    }
 
 
 class RefState(BaseModel):
-    state: Literal["building", "running", "unknown"]
+    state: Literal["building", "running", "idle", "stopped", "oom_killed", "failed", "unknown"]
     url: HttpUrl | None = None
     build_context: str | None = None
+    git_hash: str | None = None
+    runner: str | None = None
+    resources: ResourceLimits | None = None  # applied limits
+
+
+async def record_exit(book: Book, event: dict, docker_context: str):
+    # Inspected once per die event, refreshes read whether the memory limit was hit from the store
+    actor = event.get("Actor") or {}
+    container_id = actor.get("ID", "")[:12]
+    subdomain_name = MainTag.model_validate(
+        actor.get("Attributes", {}).get("whalesbook.main_tag", "")
+    ).subdomain_name
+    details, stderr, code = await docker.inspect_container(container_id, docker_context)
+    if code:
+        return  # removed with the container
+    if details["State"].get("OOMKilled"):  # type: ignore
+        logger.warning(f"Container {container_id} of book {book.name} hit its memory limit")
+        store.record_oom_kill(book.name, subdomain_name, container_id)  # type: ignore
+    else:
+        store.remove_oom_kill(book.name, subdomain_name)  # type: ignore
 
 
-async def get_refs_state(registry_url: HttpUrl, book: Book):
+async def get_refs_state(
+    registry_url: HttpUrl, book: Book, containers: list[dict] | None = None
+):
     states = {
-        repo.name: {ref.name: RefState(state="unknown") for ref in repo.refs}
+        repo.name: {
+            ref.name: RefState(state="unknown")
+            for ref in repo.refs
+            if not ref.is_pattern
+        }
         for repo in book.repos
     }
 
@@ -242,88 +535,343 @@ async def get_refs_state(registry_url: HttpUrl, book: Book):
         ref.subdomain_name: (repo.name, ref.name)
         for repo in book.repos
         for ref in repo.refs
+        if not ref.is_pattern
     }
 
-    containers_raw = await get_containers_for_book(registry_url, book)
+    # Last seen hashes and build results, also resolves refs matched by patterns
+    seen_refs = store.get_refs(book.name)
+    if not seen_refs and any(ref.is_pattern for repo in book.repos for ref in repo.refs):
+        try:
+            seen_refs = [
+                {"repo": repo.name, "ref": ref.name, "subdomain": ref.subdomain_name, "hash": git_hash}
+                for repo, ref, git_hash in await get_tracking_refs(book)
+            ]
+        except Exception as e:
+            logger.warning(f"Failed to resolve ref patterns of book {book.name}: {e}")
+    builds = store.get_builds(book.name)
+    for row in seen_refs:
+        if row["repo"] not in states:
+            continue
+        build = builds.get(row["subdomain"], {})
+        states[row["repo"]][row["ref"]] = RefState(
+            state=build["status"] if build.get("status") in ("building", "failed") else "unknown",
+            git_hash=row["hash"],
+        )
+        mapping[row["subdomain"]] = (row["repo"], row["ref"])
 
-    for container in containers_raw:
-        labels = {
-            k: v
-            for label in container["Labels"].split(",")  # type:ignore
-            for k, v in [label.split("=", maxsplit=1)]
-        }
+    if containers is None:
+        containers = await get_containers_for_book(registry_url, book)
+    idle = store.get_idle(book.name)
+    oom_kills = store.get_oom_kills(book.name)
+
+    for container in containers:
+        labels = parse_labels(container)
         subdomain_name = MainTag.model_validate(
             labels["whalesbook.main_tag"]
         ).subdomain_name
+        if subdomain_name not in mapping:
+            continue
 
-        states[mapping[subdomain_name][0]][mapping[subdomain_name][1]] = RefState(
-            state="running",
+        repo_name, ref_name = mapping[subdomain_name]
+        if states[repo_name][ref_name].state == "running":
+            continue  # a migrating ref briefly has containers on two runners
+        if container["State"] == "running":
+            state = "running"
+        elif idle.get(subdomain_name) == container["ID"]:
+            state = "idle"
+        elif oom_kills.get(subdomain_name) == container["ID"]:
+            state = "oom_killed"
+        else:
+            state = "stopped"
+        states[repo_name][ref_name] = RefState(
+            state=state,
+            resources=(
+                ResourceLimits.from_label(labels["whalesbook.resources"])
+                if "whalesbook.resources" in labels
+                else None
+            ),
+            runner=container.get("DockerContext"),
             url=(
                 HttpUrl(f"https://{subdomain_name}.{book.name}.{book.traefik_config.base_domain}")
                 if book.traefik_config
                 else None
             ),
             build_context=labels["whalesbook.build_context"],
+            git_hash=states[repo_name][ref_name].git_hash,
         )
 
     return states
 
 
-async def update_containers(registry: Registry, book: Book):
-    # Get current (old) containers
-    old_containers = await get_containers_for_book(registry.url, book)
+async def get_all_refs_state(
+    registry_url: HttpUrl, books: list[Book]
+) -> dict[str, dict[str, dict[str, RefState]]]:
+    containers_by_book = await get_containers_by_book(registry_url, books)
+    return {
+        book.name: await get_refs_state(registry_url, book, containers_by_book[book.name])
+        for book in books
+        if book.name in containers_by_book
+    }
+
+
+class ReconcileReport(BaseModel):
+    kept: int = 0
+    replaced: int = 0
+    migrated: int = 0  # moved to another runner of the pool
+    started: int = 0
+    removed: int = 0
+    failed: int = 0
+
+
+async def update_containers(registry: Registry, book: Book) -> ReconcileReport:
+    with RECONCILE_DURATION.time(book=book.name):
+        return await _update_containers(registry, book)
+
 
-    # Start new containers first
-    book_repo_refs = {
-        ref.name: ref.subdomain_name for repo in book.repos for ref in repo.refs
+async def _update_containers(registry: Registry, book: Book) -> ReconcileReport:
+    report = ReconcileReport()
+
+    # Current containers grouped by subdomain name
+    current_containers: dict[str, list[dict]] = {}
+    for container in await get_containers_for_book(registry.url, book):
+        subdomain_name = MainTag.model_validate(
+            parse_labels(container)["whalesbook.main_tag"]
+        ).subdomain_name
+        current_containers.setdefault(subdomain_name, []).append(container)  # type: ignore
+
+    # Desired image digest per subdomain name (registry tag == subdomain name)
+    tracking_subdomains = {
+        ref.subdomain_name: ref for _, ref, _ in await get_tracking_refs(book)
+    }
+    resources = {
+        subdomain_name: book.resources.merge(ref.resources).to_label()
+        for subdomain_name, ref in tracking_subdomains.items()
     }
-    logger.debug(f"book_repo_refs: {book_repo_refs}")
+    digests: dict[str, str] = {}
+    known_digests = store.get_digests(book.name)
+
+    async def get_digest(tag: str):
+        if tag in known_digests:
+            digests[tag] = known_digests[tag]
+        elif digest := await registry.get_digest(book.name_registry, tag):
+            store.record_digest(book.name, tag, digest)
+            digests[tag] = digest
+
     async with anyio.create_task_group() as tg:
-        for tag in await registry.get_tags(
-            book.name_registry
-        ):  # registry tag == subdomain name
-            if tag in book_repo_refs.values():
-                labels = book.custom_labels.copy()
-                if book.traefik_config:
-                    labels.extend(
-                        docker.gen_traefik_labels(tag, book.name, book.traefik_config)
-                    )
-                tg.start_soon(
-                    docker.run_container,
-                    MainTag(
-                        registry_url=registry.url,
-                        book_name_registry=book.name_registry,
-                        subdomain_name=tag,
-                    ).to_string(),
-                    book.docker_network,
-                    None,
-                    "always",
-                    labels,
-                    True,
-                    book.runner,
+        for tag in tracking_subdomains:
+            tg.start_soon(get_digest, tag)
+    logger.debug(f"Desired digests for book {book.name}: {digests}")
+
+    async def start(subdomain_name: str, runner: str, old_containers: list[dict]):
+        main_tag = MainTag(
+            registry_url=registry.url,
+            book_name_registry=book.name_registry,
+            subdomain_name=subdomain_name,
+        ).to_string()
+        labels = book.custom_labels.copy()
+        labels.append(f"whalesbook.main_tag={main_tag}")
+        labels.append(f"whalesbook.image_digest={digests[subdomain_name]}")
+        labels.append(f"whalesbook.resources={resources[subdomain_name]}")
+        if book.traefik_config:
+            labels.extend(
+                docker.gen_traefik_labels(
+                    subdomain_name, book.name, book.traefik_config
                 )
+            )
 
-    # Remove old containers
-    if old_containers:
-        async with anyio.create_task_group() as tg:
-            for container in old_containers:
-                tg.start_soon(docker.stop_container, container["ID"], book.runner)  # type: ignore
+        # Start the new container first, old ones are only removed once it runs.
+        # Traefik leaves containers out while their healthcheck is starting
+        image_name = MainTag(
+            registry_url=registry.url, book_name_registry=book.name_registry
+        ).to_string()
+        stdout, stderr, code = await docker.run_container(
+            f"{image_name}@{digests[subdomain_name]}",
+            book.docker_network,
+            None,
+            "unless-stopped" if book.idle else "always",  # idle containers stay stopped on daemon restarts
+            labels,
+            None,
+            runner,
+            ResourceLimits.from_label(resources[subdomain_name]),
+            healthcheck(book),
+        )
+        if code:
+            report.failed += 1
+            return
+
+        if not await wait_ready(book, stdout, runner):  # type: ignore
+            # Keep the old containers serving
+            logger.error(f"Aborting swap of {main_tag}, new container never became ready")
+            await docker.stop_container(stdout, runner)  # type: ignore
+            report.failed += 1
+            return
+        if book.readiness and old_containers:
+            await anyio.sleep(book.readiness.drain)
+
+        store.record_container(
+            book.name, subdomain_name, stdout, digests[subdomain_name], runner  # type: ignore
+        )
+        store.remove_idle(book.name, subdomain_name)
+        for container in old_containers:
+            await docker.stop_container(container["ID"], container["DockerContext"])
+        if any(container["DockerContext"] != runner for container in old_containers):
+            logger.info(f"Migrated {main_tag} to runner {runner}")
+            report.migrated += 1
+        elif old_containers:
+            report.replaced += 1
+        else:
+            report.started += 1
+
+    placement = await Placement.load(book)
+    idle = store.get_idle(book.name)
+    async with anyio.create_task_group() as tg:
+        for subdomain_name, digest in digests.items():
+            containers = current_containers.pop(subdomain_name, [])
+            # Idle containers count as serving, they are woken by their next request
+            running = [
+                container
+                for container in containers
+                if container["State"] == "running" or idle.get(subdomain_name) == container["ID"]
+            ]
+            runner = placement.choose(
+                subdomain_name, running[0]["DockerContext"] if running else None
+            )
+            # A placement change goes through the same swap as a new image
+            up_to_date = [
+                container
+                for container in running
+                if container["DockerContext"] == runner
+                and parse_labels(container).get("whalesbook.image_digest") == digest
+                # Changed limits swap the container like a new image
+                and parse_labels(container).get("whalesbook.resources", "") == resources[subdomain_name]
+            ]
+            if up_to_date:
+                report.kept += 1
+                store.record_container(
+                    book.name, subdomain_name, up_to_date[0]["ID"], digest, runner
+                )
+                for container in containers:
+                    if container is not up_to_date[0]:
+                        report.removed += 1
+                        tg.start_soon(
+                            docker.stop_container, container["ID"], container["DockerContext"]
+                        )
+            else:
+                tg.start_soon(start, subdomain_name, runner, containers)
+
+        # Refs no longer tracked or without image
+        for subdomain_name, containers in current_containers.items():
+            store.remove_container(book.name, subdomain_name)
+            for container in containers:
+                report.removed += 1
+                tg.start_soon(docker.stop_container, container["ID"], container["DockerContext"])
+
+    logger.info(f"Reconciled containers of book {book.name}: {report}")
+    return report
 
 
 async def stop_containers(registry_url: HttpUrl, book: Book):
     old_containers = await get_containers_for_book(registry_url, book)
 
     for container in old_containers:
-        await docker.stop_container(container["ID"])  # type: ignore
+        await docker.stop_container(container["ID"], container["DockerContext"])
+
 
+# One update of a book at a time, whether scheduled, pushed or forced
+book_locks: dict[str, anyio.Lock] = defaultdict(anyio.Lock)
+# Updates of different books running at once, from any caller
+book_limiter = anyio.CapacityLimiter(4)
 
-async def update_book(registry: Registry, book: Book, force: bool = False):
-    ref_pairs_to_update, outdated_registry_hashes = await get_new_refs(registry, book)
+
+async def update_book(
+    registry: Registry,
+    book: Book,
+    force: bool = False,
+    remote_refs: dict[str, list[tuple[str, str]]] | None = None,
+    on_start: Callable[[], Any] | None = None,
+):
+    # The book's own lock first, so updates waiting on it do not hold a slot
+    async with book_locks[book.name], book_limiter:
+        if on_start:
+            on_start()
+        await _update_book(registry, book, force, remote_refs)
+
+
+async def _update_book(
+    registry: Registry,
+    book: Book,
+    force: bool = False,
+    remote_refs: dict[str, list[tuple[str, str]]] | None = None,
+):
+    if force and remote_refs is None:
+        for repo in book.repos:
+            invalidate_refs(repo.url)
+    if remote_refs is None:
+        remote_refs = await ls_remote_all(book.repos)
+    ref_pairs_to_update = await get_new_refs(registry, book, remote_refs)
     if not ref_pairs_to_update and not force:
         logger.info(f"Nothing to update for book {book.name}")
         return
     if force:
         logger.info(f"Forceing update for book {book.name}")
-        ref_pairs_to_update = await get_tracking_ref_pairs(book)
-    await update_images(registry.url, book, ref_pairs_to_update, dry_run=False)
+        ref_pairs_to_update = await get_tracking_ref_pairs(book, remote_refs)
+    else:
+        ref_pairs_to_update = await retag_built_refs(
+            registry, book, ref_pairs_to_update
+        )
+    if ref_pairs_to_update:
+        await update_images(
+            registry.url, book, ref_pairs_to_update, dry_run=False, registry=registry
+        )
     await update_containers(registry, book)
+    await notify_state_changed(book)
+
+
+async def update_pushed_ref(
+    registry: Registry, book: Book, repo: Repo, ref_name: str, git_hash: str | None
+):
+    # Targeted update for a push to a single ref, without checking the other refs
+    async with book_locks[book.name], book_limiter:
+        await _update_pushed_ref(registry, book, repo, ref_name, git_hash)
+
+
+async def _update_pushed_ref(
+    registry: Registry, book: Book, repo: Repo, ref_name: str, git_hash: str | None
+):
+    invalidate_refs(repo.url)
+    ref = repo.match_ref(ref_name)
+    if ref is None:
+        logger.debug(f"Ref {ref_name} is not tracked by book {book.name}")
+        return
+    if git_hash is None:
+        logger.info(f"Ref {ref_name} of book {book.name} was deleted")
+        await update_containers(registry, book)
+        await notify_state_changed(book)
+        return
+
+    logger.info(f"Updating ref {ref_name} of book {book.name} to {git_hash}")
+    store.record_ref(book.name, repo.name, ref.name, ref.subdomain_name, git_hash)  # type: ignore
+    ref_pairs_to_build = await retag_built_refs(registry, book, {(git_hash, ref.name)})
+    if ref_pairs_to_build:
+        await update_images(
+            registry.url, book, ref_pairs_to_build, dry_run=False, registry=registry
+        )
+    await update_containers(registry, book)
+    await notify_state_changed(book)
+
+
+async def update_books(registry: Registry, books: list[Book], force: bool = False):
+    if force:
+        invalidate_refs()
+    remote_refs = await ls_remote_all(repo for book in books for repo in book.repos)
+    logger.debug(f"Ref cache: {ref_cache.stats()}")
+
+    async def update(book: Book):
+        try:
+            await update_book(registry, book, force, remote_refs)
+        except Exception as e:
+            logger.error(f"Failed to update book {book.name}: {e}")
+
+    async with anyio.create_task_group() as tg:
+        for book in books:
+            tg.start_soon(update, book)
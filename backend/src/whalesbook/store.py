@@ -0,0 +1,229 @@
+from pathlib import Path
+import json
+import sqlite3
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS refs (
+    book TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    subdomain TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (book, repo, ref)
+);
+CREATE TABLE IF NOT EXISTS builds (
+    book TEXT NOT NULL,
+    subdomain TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    status TEXT NOT NULL,  -- building, success, retagged, failed
+    cached_steps INTEGER,
+    total_steps INTEGER,
+    error TEXT,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    PRIMARY KEY (book, subdomain)
+);
+CREATE TABLE IF NOT EXISTS digests (
+    book TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (book, tag)
+);
+CREATE TABLE IF NOT EXISTS containers (
+    book TEXT NOT NULL,
+    subdomain TEXT NOT NULL,
+    container_id TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    context TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (book, subdomain)
+);
+CREATE TABLE IF NOT EXISTS idle (
+    book TEXT NOT NULL,
+    subdomain TEXT NOT NULL,
+    container_id TEXT NOT NULL,  -- stopped for idleness, kept until woken
+    stopped_at REAL NOT NULL,
+    PRIMARY KEY (book, subdomain)
+);
+CREATE TABLE IF NOT EXISTS oom_kills (
+    book TEXT NOT NULL,
+    subdomain TEXT NOT NULL,
+    container_id TEXT NOT NULL,  -- last exit hit the memory limit
+    killed_at REAL NOT NULL,
+    PRIMARY KEY (book, subdomain)
+);
+"""
+
+
+class StateStore:
+    def __init__(self, path: Path | str = ":memory:"):
+        self.path = path
+        self.conn = self._connect(path)
+
+    @staticmethod
+    def _connect(path: Path | str):
+        conn = sqlite3.connect(path, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def open(self, path: Path | str):
+        logger.info(f"Using state store {path}")
+        self.conn.close()
+        self.path = path
+        self.conn = self._connect(path)
+
+    def _rows(self, query: str, *params) -> list[dict]:
+        return [dict(row) for row in self.conn.execute(query, params)]
+
+    # refs
+    def record_refs(self, book: str, refs: list[tuple[str, str, str, str]]):
+        # (repo, ref, subdomain, hash) of every tracked ref, replaces what was seen before
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM refs WHERE book = ?", (book,))
+            self.conn.executemany(
+                "INSERT INTO refs VALUES (?, ?, ?, ?, ?, ?)",
+                [(book, *ref, now) for ref in refs],
+            )
+            # Builds and digests of refs no longer tracked, and of commits they left
+            subdomains = [subdomain for _, _, subdomain, _ in refs]
+            tags = subdomains + [f"git-{git_hash}" for _, _, _, git_hash in refs]
+            self.conn.execute(
+                "DELETE FROM builds WHERE book = ? AND subdomain NOT IN (SELECT value FROM json_each(?))",
+                (book, json.dumps(subdomains)),
+            )
+            self.conn.execute(
+                "DELETE FROM digests WHERE book = ? AND tag NOT IN (SELECT value FROM json_each(?))",
+                (book, json.dumps(tags)),
+            )
+
+    def record_ref(self, book: str, repo: str, ref: str, subdomain: str, git_hash: str):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?, ?, ?)",
+            (book, repo, ref, subdomain, git_hash, time.time()),
+        )
+
+    def get_refs(self, book: str) -> list[dict]:
+        return self._rows("SELECT * FROM refs WHERE book = ?", book)
+
+    # builds
+    def record_build(
+        self,
+        book: str,
+        subdomain: str,
+        git_hash: str,
+        status: str,
+        cached_steps: int | None = None,
+        total_steps: int | None = None,
+        error: str | None = None,
+    ):
+        now = time.time()
+        if status == "building":
+            self.conn.execute(
+                "INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, NULL, NULL, NULL, ?, NULL)",
+                (book, subdomain, git_hash, status, now),
+            )
+        else:
+            self.conn.execute(
+                "INSERT INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (book, subdomain) DO UPDATE SET hash = excluded.hash, "
+                "status = excluded.status, cached_steps = excluded.cached_steps, "
+                "total_steps = excluded.total_steps, error = excluded.error, "
+                "finished_at = excluded.finished_at",
+                (book, subdomain, git_hash, status, cached_steps, total_steps, error, now, now),
+            )
+
+    def get_builds(self, book: str) -> dict[str, dict]:
+        return {
+            row["subdomain"]: row
+            for row in self._rows("SELECT * FROM builds WHERE book = ?", book)
+        }
+
+    # registry digests
+    def record_digest(self, book: str, tag: str, digest: str | None):
+        if digest is None:
+            self.conn.execute(
+                "DELETE FROM digests WHERE book = ? AND tag = ?", (book, tag)
+            )
+        else:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+                (book, tag, digest, time.time()),
+            )
+
+    def get_digests(self, book: str) -> dict[str, str]:
+        return {
+            row["tag"]: row["digest"]
+            for row in self._rows("SELECT tag, digest FROM digests WHERE book = ?", book)
+        }
+
+    # containers
+    def record_container(
+        self, book: str, subdomain: str, container_id: str, digest: str, context: str
+    ):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO containers VALUES (?, ?, ?, ?, ?, ?)",
+            (book, subdomain, container_id, digest, context, time.time()),
+        )
+
+    def remove_container(self, book: str, subdomain: str):
+        self.conn.execute(
+            "DELETE FROM containers WHERE book = ? AND subdomain = ?", (book, subdomain)
+        )
+        self.remove_idle(book, subdomain)
+        self.remove_oom_kill(book, subdomain)
+
+    def get_containers(self, book: str) -> dict[str, dict]:
+        return {
+            row["subdomain"]: row
+            for row in self._rows("SELECT * FROM containers WHERE book = ?", book)
+        }
+
+    # idle
+    def record_idle(self, book: str, subdomain: str, container_id: str):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO idle VALUES (?, ?, ?, ?)",
+            (book, subdomain, container_id, time.time()),
+        )
+
+    def remove_idle(self, book: str, subdomain: str):
+        self.conn.execute("DELETE FROM idle WHERE book = ? AND subdomain = ?", (book, subdomain))
+
+    def get_idle(self, book: str) -> dict[str, str]:
+        # subdomain -> id of the stopped container
+        return {
+            row["subdomain"]: row["container_id"]
+            for row in self._rows("SELECT * FROM idle WHERE book = ?", book)
+        }
+
+    # oom kills
+    def record_oom_kill(self, book: str, subdomain: str, container_id: str):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO oom_kills VALUES (?, ?, ?, ?)",
+            (book, subdomain, container_id, time.time()),
+        )
+
+    def remove_oom_kill(self, book: str, subdomain: str):
+        self.conn.execute(
+            "DELETE FROM oom_kills WHERE book = ? AND subdomain = ?", (book, subdomain)
+        )
+
+    def get_oom_kills(self, book: str) -> dict[str, str]:
+        # subdomain -> id of the container killed
+        return {
+            row["subdomain"]: row["container_id"]
+            for row in self._rows("SELECT * FROM oom_kills WHERE book = ?", book)
+        }
+
+
+# In memory until opened with the configured state file
+store = StateStore()
@@ -0,0 +1,88 @@
+from collections.abc import Mapping
+from fastapi import HTTPException
+from urllib import parse
+import hashlib
+import hmac
+import re
+from .config import Book, Repo
+
+NULL_HASH = "0" * 40
+
+
+def normalize_repo_url(url: str) -> str:
+    # host/owner/repo for https, ssh and scp-like urls
+    if match := re.fullmatch(r"[\w.-]+@([\w.-]+):(.+)", url):
+        host, path = match.groups()
+    else:
+        parts = parse.urlsplit(url)
+        host, path = parts.hostname or "", parts.path
+    return f"{host.lower()}/{path.strip('/').removesuffix('.git').lower()}"
+
+
+def verify_webhook(headers: Mapping[str, str], body: bytes, secret: str) -> str:
+    # Returns the provider, Gitea also sends GitHub headers so it goes first
+    def expected(prefix: str = "") -> str:
+        return prefix + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+    if "x-gitea-event" in headers:
+        provider, valid = "gitea", hmac.compare_digest(
+            headers.get("x-gitea-signature", ""), expected()
+        )
+    elif "x-github-event" in headers:
+        provider, valid = "github", hmac.compare_digest(
+            headers.get("x-hub-signature-256", ""), expected("sha256=")
+        )
+    elif "x-gitlab-event" in headers:
+        provider, valid = "gitlab", hmac.compare_digest(
+            headers.get("x-gitlab-token", ""), secret
+        )
+    else:
+        raise HTTPException(400, "Unknown webhook provider")
+
+    if not valid:
+        raise HTTPException(401, f"Invalid {provider} webhook signature")
+    return provider
+
+
+def is_push_event(provider: str, headers: Mapping[str, str]) -> bool:
+    if provider == "gitlab":
+        return headers["x-gitlab-event"] in ("Push Hook", "Tag Push Hook")
+    return headers[f"x-{provider}-event"] == "push"
+
+
+def parse_push(provider: str, payload: dict) -> tuple[set[str], str, str | None]:
+    # (normalized repo urls, full ref name, new hash or None if deleted)
+    repository = payload.get("repository") or {}
+    if provider == "gitlab":
+        project = payload.get("project") or {}
+        urls = (
+            repository.get("git_http_url"),
+            repository.get("git_ssh_url"),
+            project.get("git_http_url"),
+            project.get("git_ssh_url"),
+            project.get("web_url"),
+        )
+    else:
+        urls = (
+            repository.get("clone_url"),
+            repository.get("ssh_url"),
+            repository.get("html_url"),
+        )
+    try:
+        ref_name, git_hash = payload["ref"], payload["after"]
+    except KeyError:
+        raise HTTPException(400, "Push payload without ref")
+    return (
+        {normalize_repo_url(url) for url in urls if url},
+        ref_name,
+        None if git_hash == NULL_HASH else git_hash,
+    )
+
+
+def find_pushed_repos(books: list[Book], repo_urls: set[str]) -> list[tuple[Book, Repo]]:
+    return [
+        (book, repo)
+        for book in books
+        for repo in book.repos
+        if normalize_repo_url(repo.url) in repo_urls
+    ]
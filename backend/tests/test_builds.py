@@ -0,0 +1,106 @@
+import anyio
+from functools import partial
+import pytest
+from whalesbook import builds
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_build_queue(monkeypatch):
+    started = []
+
+    async def fake_build_image(tags, build_context, *args):
+        started.append(tags[0])
+        await anyio.sleep(0.01)
+        return "", "", 0
+
+    monkeypatch.setattr(builds.docker, "build_image", fake_build_image)
+    queue = builds.BuildQueue()
+    monkeypatch.setattr(queue, "limit", lambda builder: 1)
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(queue.build_image, ["r/b:first", "r/b:git-1"], "repo#1")
+        await anyio.sleep(0)
+        tg.start_soon(partial(queue.build_image, ["r/b:feat", "r/b:git-2"], "repo#2", priority=100))
+        tg.start_soon(partial(queue.build_image, ["r/b:main", "r/b:git-3"], "repo#3", priority=0))
+        tg.start_soon(partial(queue.build_image, ["r/b:main", "r/b:git-3"], "repo#3", priority=0))
+
+    assert started == ["r/b:first", "r/b:main", "r/b:feat"]
+
+
+async def test_builder_pool(monkeypatch):
+    built, down = [], {"dead"}
+
+    async def fake_build_image(tags, build_context, docker_context, *args):
+        if docker_context in down:
+            raise Exception("Cannot connect to the Docker daemon")
+        built.append((tags[0], docker_context))
+        await anyio.sleep(0.01)
+        return "", "", 0
+
+    async def fake_get_info(docker_context):
+        if docker_context in down:
+            return "", "unreachable", 1
+        return {"NCPU": 4, "MemTotal": 8}, "", 0
+
+    monkeypatch.setattr(builds.docker, "build_image", fake_build_image)
+    monkeypatch.setattr(builds.docker, "get_info", fake_get_info)
+    queue = builds.BuildQueue()
+    monkeypatch.setattr(queue, "limit", lambda builder: 1)
+
+    # Least loaded first, the unreachable builder hands its build over
+    async with anyio.create_task_group() as tg:
+        for n, builder in enumerate(["a", "b", "dead"]):
+            tg.start_soon(queue.build_image, [f"r/b:{n}", f"r/b:git-{n}"], f"repo{n}#1", [builder, "c"])
+            await anyio.sleep(0)
+    assert sorted(built) == [("r/b:0", "a"), ("r/b:1", "b"), ("r/b:2", "c")]
+    assert queue.stats()["dead"]["unreachable"] == 1
+
+    # Repos stick to their last builder, the unreachable one is skipped
+    built.clear()
+    await queue.build_image(["r/b:3", "r/b:git-3"], "repo#3", ["a", "b", "dead"], affinity="repo")
+    await queue.build_image(["r/b:4", "r/b:git-4"], "repo#4", ["dead", "b", "a"], affinity="repo")
+    assert built[0][1] == built[1][1]
+
+    # Failed builds on a reachable builder are not retried
+    attempts = []
+
+    async def failing_build_image(tags, build_context, docker_context, *args):
+        attempts.append(docker_context)
+        raise Exception(f"Failed to build tag {tags[0]}")
+
+    monkeypatch.setattr(builds.docker, "build_image", failing_build_image)
+    with pytest.raises(Exception, match="Failed to build"):
+        await queue.build_image(["r/b:5", "r/b:git-5"], "repo#5", ["a", "b"])
+    assert len(attempts) == 1
+
+
+async def test_inflight_build_retag(monkeypatch):
+    built, retagged = [], []
+
+    async def fake_build_image(tags, build_context, *args):
+        built.append(tags)
+        await anyio.sleep(0.01)
+        return "", "", 0
+
+    class FakeRegistry:
+        async def retag(self, repository, tag, new_tag, from_repository=None):
+            retagged.append((repository, tag, new_tag, from_repository))
+
+    monkeypatch.setattr(builds.docker, "build_image", fake_build_image)
+    queue = builds.BuildQueue()
+    build = partial(queue.build_image, push=True, registry=FakeRegistry())
+
+    # Two refs of one book and another book on the same commit share one build
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(build, ["r:5000/l/a:main", "r:5000/l/a:git-1"], "repo#1")
+        await anyio.sleep(0)
+        tg.start_soon(build, ["r:5000/l/a:dev", "r:5000/l/a:git-1"], "repo#1")
+        tg.start_soon(build, ["r:5000/l/b:main", "r:5000/l/b:git-1"], "repo#1")
+    assert built == [["r:5000/l/a:main", "r:5000/l/a:git-1"]]
+    # Copied from the commit tag, the ref tag may have moved since the push
+    assert sorted(retagged) == [
+        ("l/a", "git-1", "dev", "l/a"),
+        ("l/b", "git-1", "git-1", "l/a"),
+        ("l/b", "git-1", "main", "l/a"),
+    ]
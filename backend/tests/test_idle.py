@@ -0,0 +1,67 @@
+import pytest
+from whalesbook import config, idle
+from whalesbook.config import Book, IdleConfig, RegistryConfig, Settings
+from whalesbook.store import StateStore
+
+pytestmark = pytest.mark.anyio
+
+METRICS = """# TYPE traefik_service_requests_total counter
+traefik_service_requests_total{code="200",method="GET",protocol="http",service="book--main@docker"} 3
+traefik_service_requests_total{code="404",method="GET",protocol="http",service="book--main@docker"} 1
+traefik_service_requests_total{code="200",method="GET",protocol="http",service="book--dev@docker"} 7
+"""
+
+
+def test_find_idle_ref():
+    assert idle.parse_service_requests(METRICS) == {"book--main": 4, "book--dev": 7}
+    books = [Book(name="always"), Book(name="book", idle=IdleConfig())]
+    assert idle.find_idle_ref(books, "main.book.localhost:443") == (books[1], "main")
+    assert idle.find_idle_ref(books, "main.always.localhost") is None
+    assert idle.find_idle_ref(books, "a.main.book.localhost") is None
+
+
+async def test_idle_watcher(monkeypatch):
+    store = StateStore()
+    settings = Settings(docker_registry=RegistryConfig(url="localhost:5000"))  # type: ignore
+    book = Book(name="book", idle=IdleConfig(timeout=0))
+    metrics, docker_calls = [METRICS], []
+
+    async def fake_scrape(self):
+        return idle.parse_service_requests(metrics[0])
+
+    async def fake_get_containers_by_book(registry_url, books):
+        main_tag = "localhost:5000/library/book"
+        return {
+            "book": [
+                {"ID": f"c-{sub}", "State": state, "DockerContext": "runner", "Labels": f"whalesbook.main_tag={main_tag}:{sub}"}
+                for sub, state in (("main", "running"), ("dev", "running"), ("old", "exited"))
+            ]
+        }
+
+    async def fake_stop_container(identifier, docker_context, remove=True):
+        docker_calls.append(("stop", identifier, docker_context, remove))
+        return identifier, "", 0
+
+    async def fake_start_container(identifier, docker_context):
+        docker_calls.append(("start", identifier, docker_context))
+        return identifier, "", 0
+
+    monkeypatch.setattr(config, "settings", settings)
+    monkeypatch.setattr(idle, "store", store)
+    monkeypatch.setattr(idle.IdleWatcher, "scrape", fake_scrape)
+    monkeypatch.setattr(idle, "get_containers_by_book", fake_get_containers_by_book)
+    monkeypatch.setattr(idle.docker, "stop_container", fake_stop_container)
+    monkeypatch.setattr(idle.docker, "start_container", fake_start_container)
+    watcher = idle.IdleWatcher()
+
+    # First seen containers are active, dev had requests since the last scrape
+    await watcher.check([book])
+    metrics[0] = METRICS.replace("} 7", "} 8")
+    await watcher.check([book])
+    assert docker_calls == [("stop", "c-main", "runner", False)]
+    assert store.get_idle("book") == {"main": "c-main"} and watcher.is_idle(book, "main")
+
+    store.record_container("book", "main", "c-main-full-id", "sha256:m", "runner")
+    assert await watcher.wake(book, "main")
+    assert docker_calls[-1] == ("start", "c-main", "runner")
+    assert store.get_idle("book") == {} and not await watcher.wake(book, "main")
@@ -0,0 +1,47 @@
+import subprocess
+import pytest
+from whalesbook import config, mirrors
+from whalesbook.config import Settings
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_git_mirrors(tmp_path, monkeypatch):
+    def git(*args: str) -> str:
+        return subprocess.run(
+            ["git", "-C", str(origin), "-c", "user.name=t", "-c", "user.email=t@t", *args],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+
+    origin = tmp_path / "origin"
+    subprocess.run(["git", "init", "--quiet", "-b", "main", str(origin)], check=True)
+    (origin / "Dockerfile").write_text("FROM scratch\n")
+    git("add", "Dockerfile")
+    git("commit", "--quiet", "-m", "first")
+    git("tag", "-a", "v1", "-m", "v1")
+    first = git("rev-parse", "HEAD")
+
+    settings = Settings()
+    settings.git.mirror_dir = tmp_path / "mirrors"
+    monkeypatch.setattr(config, "settings", settings)
+    git_mirrors = mirrors.GitMirrors()
+
+    refs = await git_mirrors.ls_remote(f"file://{origin}")
+    # The annotated tag is peeled to its commit
+    assert sorted(refs) == [(first, "refs/heads/main"), (first, "refs/tags/v1")]
+    # Another url of the same repo shares the mirror
+    assert git_mirrors.path(f"file://{origin}/") == git_mirrors.path(f"file://{origin}.git")
+
+    # New commits are fetched on demand
+    (origin / "app.py").write_text("print()\n")
+    git("add", "app.py")
+    git("commit", "--quiet", "-m", "second")
+    second = git("rev-parse", "HEAD")
+    async with git_mirrors.checkout(f"file://{origin}#{second}") as worktree:
+        assert sorted(path.name for path in worktree.iterdir()) == ["Dockerfile", "app.py"]
+    assert not worktree.exists()
+
+    async with git_mirrors.checkout("https://example.com/repo.git#main") as worktree:
+        assert worktree is None
@@ -0,0 +1,65 @@
+from pathlib import Path
+import pytest
+import yaml
+from whalesbook import config, reload, schedule
+from whalesbook.config import Book, Repo, Settings
+from whalesbook.store import StateStore
+
+pytestmark = pytest.mark.anyio
+
+
+def write_config(path: Path, books: list[dict], cron: str = "*/5 * * * *"):
+    path.write_text(yaml.safe_dump({"schedule": {"cron": cron}, "books": books}))
+
+
+def test_diff_books():
+    old = [Book(name="a"), Book(name="b"), Book(name="c")]
+    new = [
+        Book(name="a"),
+        Book(name="b", repos=[Repo(name="main", refs=["main", "dev"])]),
+        Book(name="d"),
+    ]
+    diff = reload.diff_books(old, new)
+    assert (diff.added, diff.removed, diff.changed, diff.unchanged) == (["d"], ["c"], ["b"], ["a"])
+
+
+async def test_reload_settings(tmp_path, monkeypatch):
+    path = tmp_path / "config.yml"
+    write_config(path, [{"name": "a"}, {"name": "b"}])
+    monkeypatch.setattr(config, "settings", Settings.from_yaml(path))
+    schedule.schedule_books("*/5 * * * *", None, config.settings.books)  # type: ignore
+    restarted = []
+    monkeypatch.setattr(reload.book_snapshots, "restart", lambda books: restarted.extend(books))
+    book_a = config.settings.books[0]
+    try:
+        a_run = schedule.scheduler.get_job("book:a").next_run_time  # type: ignore
+
+        write_config(path, [{"name": "a"}, {"name": "b", "repos": [{"name": "main", "refs": ["dev"]}]}, {"name": "c"}])
+        diff = reload.reload_settings(path, None)  # type: ignore
+        assert diff and (diff.added, diff.changed, diff.unchanged) == (["c"], ["b"], ["a"])
+        # Untouched books keep their object and job, changed ones run now
+        assert config.settings.books[0] is book_a
+        assert schedule.scheduler.get_job("book:a").next_run_time == a_run  # type: ignore
+        assert schedule.scheduler.get_job("book:b").next_run_time < a_run  # type: ignore
+        assert restarted == ["b"]
+
+        # Invalid config keeps the last good one
+        path.write_text("books: [{repos: 1}]")
+        assert reload.reload_settings(path, None) is None  # type: ignore
+        assert [book.name for book in config.settings.books] == ["a", "b", "c"]
+
+        write_config(path, [{"name": "a"}])
+        reload.reload_settings(path, None)  # type: ignore
+        assert [job.id for job in schedule.scheduler.get_jobs()] == ["book:a"]
+
+        # Process limit and state file apply without a restart
+        monkeypatch.setattr(reload, "store", StateStore())
+        monkeypatch.setattr(reload.process_limiter, "total_tokens", 16)
+        path.write_text(yaml.safe_dump({"process": {"max_processes": 3}, "state_file": "other.sqlite3", "books": [{"name": "a"}]}))
+        reload.reload_settings(path, None)  # type: ignore
+        assert reload.process_limiter.total_tokens == 3
+        assert reload.store.path == tmp_path / "other.sqlite3"
+    finally:
+        schedule.scheduler.shutdown(wait=False)
+        for job in schedule.scheduler.get_jobs():
+            job.remove()
@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta, timezone
+import anyio
+import pytest
+from apscheduler.triggers.cron import CronTrigger
+from whalesbook import schedule, state
+from whalesbook.config import Book, Repo
+
+pytestmark = pytest.mark.anyio
+
+
+def test_staggered_trigger():
+    cron = CronTrigger.from_crontab("*/5 * * * *", timezone=timezone.utc)
+    now = datetime(2024, 1, 1, 0, 0, 30, tzinfo=timezone.utc)
+
+    offsets = set()
+    for key in ("a", "b", "c", "d"):
+        trigger = schedule.StaggeredTrigger(cron, key)
+        # Deterministic and within the interval
+        assert trigger.offset == schedule.StaggeredTrigger(cron, key).offset
+        assert timedelta(0) <= trigger.offset < timedelta(minutes=5)
+        first = trigger.get_next_fire_time(None, now)
+        second = trigger.get_next_fire_time(first, first)
+        assert first > now and second - first == timedelta(minutes=5)  # type: ignore
+        offsets.add(trigger.offset)
+    assert len(offsets) == 4
+
+
+def test_stagger_keys():
+    books = [
+        Book(name="a", repos=[Repo(name="x", url="https://x"), Repo(name="y", url="https://y")]),
+        Book(name="b", repos=[Repo(name="y", url="https://y")]),
+        Book(name="c", repos=[Repo(name="z", url="https://z"), Repo(name="w", url="https://w")]),
+        Book(name="d", repos=[Repo(name="w", url="https://w")]),
+    ]
+    # Different url sets still fire together when they share a repo
+    assert schedule.stagger_keys(books) == {"a": "https://x", "b": "https://x", "c": "https://w", "d": "https://w"}
+    assert schedule.stagger_keys(books[::-1]) == schedule.stagger_keys(books)
+
+
+async def test_scheduled_update(monkeypatch):
+    running, peak = 0, 0
+
+    async def fake_update(registry, book, *args):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await anyio.sleep(0.05)
+        running -= 1
+
+    monkeypatch.setattr(state, "_update_book", fake_update)
+    monkeypatch.setattr(state, "_update_pushed_ref", fake_update)
+    monkeypatch.setattr(schedule.book_limiter, "total_tokens", 2)
+    async with anyio.create_task_group() as tg:
+        for i in range(4):
+            tg.start_soon(schedule.scheduled_update, None, Book(name=f"book{i}"))
+        # Webhook updates take a slot too
+        tg.start_soon(state.update_pushed_ref, None, Book(name="pushed"), None, "main", "a" * 40)
+        await anyio.sleep(0.01)
+        stats = schedule.schedule_stats()
+        assert (stats.running, stats.queued) == (2, 3)
+    assert peak == 2
+    assert schedule.book_runs["book3"].lag >= 0.05  # type: ignore
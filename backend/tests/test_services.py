@@ -1,5 +1,17 @@
+import hashlib
+import json
+import math
+import anyio
+import httpx
 import pytest
-from whalesbook.services.cli_runner import CliInstance
+from whalesbook import config, docker
+from whalesbook.config import Settings
+from whalesbook.services.build_log import BuildLog
+from whalesbook.services import cli_runner, metrics
+from whalesbook.services.cli_runner import CliInstance, CommandTimeout
+from whalesbook.services.docker_engine import DockerEngine, resolve_docker_host, split_image
+from whalesbook.services.ref_cache import RefCache
+from whalesbook.services.registry import Registry, RegistryConfig, registry_endpoint
 
 pytestmark = pytest.mark.anyio
 
@@ -15,7 +27,337 @@ async def test_cli_runner():
 
 async def test_registry(settings, registry):
     assert settings.docker_registry
-    repositories: list = registry.repositories
+    repositories: list = await registry.update_catalog()
 
     if len(repositories):
         assert len(await registry.get_tags(repositories[0])) > 0
+
+
+async def test_docker_engine_context(tmp_path, monkeypatch):
+    meta = tmp_path / "contexts" / "meta" / hashlib.sha256(b"remote").hexdigest()
+    meta.mkdir(parents=True)
+    (meta / "meta.json").write_text(
+        json.dumps({"Name": "remote", "Endpoints": {"docker": {"Host": "tcp://10.0.0.2:2375"}}})
+    )
+    monkeypatch.setenv("DOCKER_CONFIG", str(tmp_path))
+    monkeypatch.delenv("DOCKER_HOST", raising=False)
+
+    assert resolve_docker_host("remote") == ("tcp://10.0.0.2:2375", None, False)
+    assert resolve_docker_host()[0] == "unix:///var/run/docker.sock"
+
+    # A missing context fails its own calls instead of raising
+    monkeypatch.setattr(config, "settings", Settings(docker_backend="api"))
+    stdout, stderr, code = await docker.get_containers(docker_context="missing")
+    assert (stdout, code) == ("", 1) and "missing" in stderr
+    assert split_image("registry:5000/library/name:main") == ("registry:5000/library/name", "main")
+    assert split_image("registry:5000/library/name") == ("registry:5000/library/name", "latest")
+
+
+async def test_docker_engine_timeout():
+    async def progress():
+        yield b'{"status":"Pulling fs layer"}\n'
+        await anyio.sleep_forever()
+
+    def handler(request: httpx.Request):
+        assert request.url.path == "/images/create"
+        return httpx.Response(200, content=progress())
+
+    docker_engine = DockerEngine("tcp://10.0.0.2:2375")
+    docker_engine.client = httpx.AsyncClient(
+        base_url="http://10.0.0.2:2375", transport=httpx.MockTransport(handler)
+    )
+    docker_engine.timeout = 0.2
+    # A pull that never finishes fails like the CLI killed at docker_timeout
+    with anyio.fail_after(2):
+        with pytest.raises(CommandTimeout, match="docker image pull registry/book:main"):
+            await docker_engine.pull_image("registry/book:main")
+        with pytest.raises(CommandTimeout, match="docker container run"):
+            await docker_engine.run_container("registry/book:main")
+
+
+async def test_ref_cache():
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await anyio.sleep(0.01)
+        return [key]
+
+    cache = RefCache(fetch, ttl=60)
+    async with anyio.create_task_group() as tg:
+        for _ in range(5):
+            tg.start_soon(cache.get, "url")
+    assert calls == ["url"]
+    assert await cache.get("url") == ["url"]
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 1, "coalesced": 4}
+
+    cache.invalidate("url")
+    await cache.get("url")
+    assert calls == ["url", "url"]
+
+
+async def test_ref_cache_failed_fetch():
+    calls, results = [], []
+
+    async def fetch(key):
+        calls.append(key)
+        await anyio.sleep(0.05)
+        if len(calls) == 3:
+            raise Exception("ls-remote failed")
+        return [len(calls)]
+
+    async def get():
+        try:
+            results.append(await cache.get("url"))
+        except Exception as e:
+            results.append(str(e))
+
+    cache = RefCache(fetch, ttl=0)
+    async with anyio.create_task_group() as tg:
+        owner = anyio.CancelScope()
+
+        async def cancelled_get():
+            with owner:
+                await cache.get("url")
+
+        tg.start_soon(cancelled_get)
+        await anyio.sleep(0.01)
+        tg.start_soon(get)
+        tg.start_soon(get)
+        await anyio.sleep(0.01)
+        owner.cancel()
+    # One waiter fetches again for both instead of returning nothing
+    assert calls == ["url", "url"] and results == [[2], [2]]
+
+    results.clear()
+    async with anyio.create_task_group() as tg:
+        for _ in range(3):
+            tg.start_soon(get)
+    assert calls == ["url"] * 3 and results == ["ls-remote failed"] * 3
+
+
+async def test_registry_retag():
+    manifest = json.dumps(
+        {
+            "mediaType": "application/vnd.oci.image.manifest.v1+json",
+            "config": {"digest": "sha256:c"},
+            "layers": [{"digest": "sha256:l1"}, {"digest": "sha256:l2"}],
+        }
+    ).encode()
+    requests = []
+
+    def handler(request: httpx.Request):
+        requests.append((request.method, request.url.path, request.url.query.decode()))
+        if request.method == "GET":
+            return httpx.Response(
+                200,
+                content=manifest,
+                headers={"content-type": "application/vnd.oci.image.manifest.v1+json"},
+            )
+        if request.method == "PUT":
+            assert request.content == manifest
+        return httpx.Response(201)
+
+    reg = Registry(RegistryConfig(url="https://registry:5000"))
+    reg.client = httpx.AsyncClient(
+        base_url="https://registry:5000/v2", transport=httpx.MockTransport(handler)
+    )
+    await reg.retag("library/b", "git-abc", "feat", "library/a")
+
+    assert requests == [
+        ("GET", "/v2/library/a/manifests/git-abc", ""),
+        ("POST", "/v2/library/b/blobs/uploads/", "mount=sha256%3Ac&from=library%2Fa"),
+        ("POST", "/v2/library/b/blobs/uploads/", "mount=sha256%3Al1&from=library%2Fa"),
+        ("POST", "/v2/library/b/blobs/uploads/", "mount=sha256%3Al2&from=library%2Fa"),
+        ("PUT", "/v2/library/b/manifests/feat", ""),
+    ]
+
+
+def test_build_log():
+    log = BuildLog(max_lines=3)
+    for i in range(10):
+        log.append(f"line {i}")
+    log.append("#5 [2/3] RUN make")
+    log.append("#5 CACHED")
+    assert log.line_count == 12 and list(log.lines) == ["line 9", "#5 [2/3] RUN make", "#5 CACHED"]
+    assert log.cache_stats == (1, 1)
+    tail = log.tail(1)
+    assert tail.running and tail.lines == ["#5 CACHED"]
+    log.finish(0)
+    assert not log.tail().running and log.tail().returncode == 0
+
+
+def test_build_log_cache_stats():
+    log = BuildLog()
+    for line in [
+        "#1 [internal] load build definition from Dockerfile",
+        "#1 DONE 0.0s",
+        "#5 [1/3] FROM docker.io/library/alpine",
+        "#5 CACHED",
+        "#6 [builder 2/3] RUN make",
+        "#6 CACHED",
+        "#7 [3/3] COPY . .",
+        "#7 DONE 0.1s",
+    ]:
+        log.append(line)
+    # Internal steps are not Dockerfile steps
+    assert log.cache_stats == (2, 3)
+
+
+async def test_cli_stream():
+    cli = CliInstance()
+    cli.add_arg("sh", "-c", "echo out; echo err >&2; printf 'no newline'; exit 3")
+    lines = [line async for line in cli.stream()]
+    assert sorted(lines) == ["err", "no newline", "out"]
+    assert cli.returncode == 3
+
+
+async def test_cli_timeout(tmp_path):
+    # The background child must be killed with its parent
+    marker = tmp_path / "marker"
+    cli = CliInstance(timeout=0.2)
+    cli.add_arg("sh", "-c", f"(sleep 1; touch {marker}) & sleep 10")
+    with anyio.fail_after(2):
+        with pytest.raises(CommandTimeout):
+            await cli.run()
+
+    cli = CliInstance(timeout=0.2)
+    cli.add_arg("sh", "-c", "echo started; sleep 10")
+    lines = []
+    with anyio.fail_after(2):
+        with pytest.raises(CommandTimeout):
+            async for line in cli.stream():
+                lines.append(line)
+    assert lines == ["started"]
+    await anyio.sleep(1.2)
+    assert not marker.exists()
+
+
+async def test_process_limiter(monkeypatch):
+    monkeypatch.setattr(cli_runner.process_limiter, "total_tokens", 2)
+    running, peak = 0, 0
+    real_open_process = anyio.open_process
+
+    async def counting_open_process(*args, **kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        return await real_open_process(*args, **kwargs)
+
+    async def run():
+        nonlocal running
+        cli = CliInstance()
+        cli.add_arg("sleep", "0.1")
+        await cli.run()
+        running -= 1
+
+    monkeypatch.setattr(cli_runner.anyio, "open_process", counting_open_process)
+    async with anyio.create_task_group() as tg:
+        for _ in range(5):
+            tg.start_soon(run)
+    assert peak == 2
+
+
+async def test_registry_pagination_and_retries():
+    requests = []
+    failures = {"library/a/tags/list": 2}
+
+    def handler(request: httpx.Request):
+        path = request.url.path.removeprefix("/v2/")
+        requests.append((request.method, path, request.url.query.decode()))
+        if failures.get(path):
+            failures[path] -= 1
+            return httpx.Response(503, headers={"retry-after": "0"})
+        if path == "library/a/tags/list":
+            if "last" not in request.url.params:
+                return httpx.Response(
+                    200,
+                    json={"tags": ["git-1", "git-2"]},
+                    headers={"link": '</v2/library/a/tags/list?last=git-2&n=2>; rel="next"'},
+                )
+            return httpx.Response(200, json={"tags": ["main"]})
+        if request.method == "HEAD":
+            if path.endswith("/missing"):
+                return httpx.Response(404)
+            return httpx.Response(200, headers={"docker-content-digest": f"sha256:{path[-1]}"})
+        if request.method == "DELETE":
+            return httpx.Response(202)
+        return httpx.Response(500)
+
+    reg = Registry(RegistryConfig(url="https://registry:5000", retry_backoff=0, page_size=2))
+    reg.client = httpx.AsyncClient(
+        base_url="https://registry:5000/v2", transport=httpx.MockTransport(handler)
+    )
+
+    assert await reg.get_tags("library/a") == ["git-1", "git-2", "main"]
+    assert [r[2] for r in requests] == ["n=2", "n=2", "n=2", "last=git-2&n=2"]
+
+    assert await reg.get_digest("library/a", "git-1") == "sha256:1"
+    assert await reg.get_digest("library/a", "missing") is None
+
+    requests.clear()
+    assert await reg.delete_tags("library/a", ["git-1", "git-2", "missing"]) == []
+    assert sorted(r[:2] for r in requests if r[0] == "DELETE") == [
+        ("DELETE", "library/a/manifests/sha256:1"),
+        ("DELETE", "library/a/manifests/sha256:2"),
+    ]
+
+
+async def test_metrics():
+    assert cli_runner.command_labels(
+        ["docker", "--context", "runner", "container", "ls", "-a", "--format", "json"]
+    ) == {"command": "docker container ls", "context": "runner"}
+    assert cli_runner.command_labels(["/usr/bin/git", "-C", "/m/r.git", "fetch", "origin"]) == {
+        "command": "git fetch",
+        "context": "",
+    }
+    assert registry_endpoint("library/book/manifests/sha256:1") == "manifests"
+    assert registry_endpoint("https://r/v2/_catalog?n=2&last=a") == "_catalog"
+
+    duration = metrics.Histogram("test_duration_seconds", "Test", ("command",), buckets=(1, 10))
+    duration.observe(0.5, command='say "hi"')
+    duration.observe(10, command='say "hi"')
+    running = metrics.Gauge("test_running", "Test", ("book",), lambda: {("a",): 2})
+    cli = CliInstance()
+    cli.add_arg("true")
+    await cli.run()
+
+    text = metrics.render()
+    assert 'test_duration_seconds_bucket{command="say \\"hi\\"",le="1"} 1' in text
+    assert 'test_duration_seconds_bucket{command="say \\"hi\\"",le="10"} 2' in text
+    assert 'test_duration_seconds_bucket{command="say \\"hi\\"",le="+Inf"} 2' in text
+    assert 'test_duration_seconds_sum{command="say \\"hi\\""} 10.5' in text
+    assert 'test_running{book="a"} 2' in text
+    assert 'whalesbook_command_duration_seconds_count{command="true",context=""} ' in text
+    metrics.registry.remove(duration)
+    metrics.registry.remove(running)
+
+
+def test_metrics_exposition():
+    with pytest.raises(TypeError):
+        metrics.Metric("test_abstract", "Test")  # type: ignore
+
+    # Exact text format: HELP escapes backslashes and newlines, label values quotes too
+    duration = metrics.Histogram(
+        "test_exposition_seconds", 'Waits "in" C:\\tmp\nper step', ("step",), buckets=(0.5, 1)
+    )
+    duration.observe(0.5, step='a\\b"c\nd')
+    duration.observe(2, step='a\\b"c\nd')
+    ratio = metrics.Gauge("test_exposition_ratio", "Ratio")
+    ratio.set(math.nan)
+    metrics.registry.remove(duration)
+    metrics.registry.remove(ratio)
+
+    labels = 'step="a\\\\b\\"c\\nd"'
+    assert duration.render() == (
+        "# HELP test_exposition_seconds Waits \"in\" C:\\\\tmp\\nper step\n"
+        "# TYPE test_exposition_seconds histogram\n"
+        f'test_exposition_seconds_bucket{{{labels},le="0.5"}} 1\n'
+        f'test_exposition_seconds_bucket{{{labels},le="1"}} 1\n'
+        f'test_exposition_seconds_bucket{{{labels},le="+Inf"}} 2\n'
+        f"test_exposition_seconds_sum{{{labels}}} 2.5\n"
+        f"test_exposition_seconds_count{{{labels}}} 2\n"
+    )
+    assert ratio.render() == (
+        "# HELP test_exposition_ratio Ratio\n# TYPE test_exposition_ratio gauge\ntest_exposition_ratio NaN\n"
+    )
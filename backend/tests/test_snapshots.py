@@ -0,0 +1,130 @@
+import anyio
+import pytest
+from whalesbook import config, snapshots
+from whalesbook.config import Book, Settings
+from whalesbook.state import RefState
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_book_snapshots(monkeypatch):
+    calls = []
+    events: list[dict] = []
+    event_sent = anyio.Event()
+
+    async def fake_get_refs_state(registry_url, book):
+        calls.append(book.name)
+        await anyio.sleep(0.01)
+        return {"main": {"main": RefState(state="running")}}
+
+    async def fake_container_events(labels, events_filter, docker_context):
+        assert labels == ["whalesbook.main_tag"] and docker_context == "default"
+        for event in events:
+            yield event
+        event_sent.set()
+        await anyio.sleep_forever()
+
+    async def fake_get_all_refs_state(registry_url, books):
+        calls.append(tuple(book.name for book in books))
+        return {book.name: {"main": {"main": RefState(state="running")}} for book in books}
+
+    monkeypatch.setattr(snapshots, "get_refs_state", fake_get_refs_state)
+    monkeypatch.setattr(snapshots, "get_all_refs_state", fake_get_all_refs_state)
+    monkeypatch.setattr(snapshots.docker, "container_events", fake_container_events)
+    book_snapshots = snapshots.BookSnapshots()
+    monkeypatch.setattr(
+        snapshots.BookSnapshots, "registry_url", property(lambda self: None)
+    )
+    book, other = Book(name="book"), Book(name="other")
+
+    # Concurrent readers share one refresh, later reads are served from memory
+    async with anyio.create_task_group() as tg:
+        for _ in range(10):
+            tg.start_soon(book_snapshots.get, book)
+    assert calls == ["book"]
+    assert (await book_snapshots.get(book))["main"]["main"].state == "running"
+    assert calls == ["book"]
+
+    # Events only refresh the book of the container
+    events.append(
+        {"Action": "die", "Actor": {"Attributes": {"whalesbook.main_tag": "localhost/library/other:main"}}}
+    )
+    calls.clear()
+    with anyio.move_on_after(1):
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(book_snapshots.watch, "default", [book, other])
+            await event_sent.wait()
+            await anyio.sleep(0.05)
+            tg.cancel_scope.cancel()
+    # One listing for the runner on connect, then the event
+    assert calls == [("book", "other"), "other"]
+    assert book_snapshots.stats()["events"] == 1
+
+
+async def test_book_snapshot_restart(monkeypatch):
+    connects, refreshed = [], []
+
+    async def fake_container_events(labels, events_filter, docker_context):
+        connects.append(docker_context)
+        await anyio.sleep_forever()
+        yield {}
+
+    async def fake_get_all_refs_state(registry_url, books):
+        refreshed.append([book.name for book in books])
+        return {book.name: {} for book in books}
+
+    settings = Settings(books=[Book(name="a", runner="one"), Book(name="b", runner="two")])
+    monkeypatch.setattr(config, "settings", settings)
+    monkeypatch.setattr(snapshots, "get_all_refs_state", fake_get_all_refs_state)
+    monkeypatch.setattr(snapshots.docker, "container_events", fake_container_events)
+    monkeypatch.setattr(
+        snapshots.BookSnapshots, "registry_url", property(lambda self: None)
+    )
+    book_snapshots = snapshots.BookSnapshots()
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(book_snapshots.run)
+        await anyio.sleep(0.01)
+        assert sorted(connects) == ["one", "two"] and sorted(refreshed) == [["a"], ["b"]]
+
+        # Only the watchers of the changed book restart, and only it is refreshed
+        connects.clear()
+        refreshed.clear()
+        settings.books = [settings.books[0], Book(name="b", runner="three")]
+        book_snapshots.restart(["b"])
+        await anyio.sleep(0.01)
+        assert connects == ["three"] and refreshed == [["b"]]
+        assert book_snapshots._watchers.keys() == {"one", "three"}
+        tg.cancel_scope.cancel()
+
+
+async def test_book_snapshot_subscribe(monkeypatch):
+    states = [
+        {"main": {"main": RefState(state="building"), "dev": RefState(state="running")}},
+        {"main": {"main": RefState(state="running", git_hash="a" * 40)}},
+    ]
+
+    async def fake_get_refs_state(registry_url, book):
+        return states.pop(0)
+
+    monkeypatch.setattr(snapshots, "get_refs_state", fake_get_refs_state)
+    monkeypatch.setattr(
+        snapshots.BookSnapshots, "registry_url", property(lambda self: None)
+    )
+    book_snapshots = snapshots.BookSnapshots()
+    book = Book(name="book")
+
+    async with book_snapshots.subscribe(book) as changes:
+        await book_snapshots.get(book)
+        assert len([await changes.receive(), await changes.receive()]) == 2
+        await book_snapshots.refresh(book)
+        # Only the transition of main and the removal of dev
+        assert await changes.receive() == {
+            "repo": "main",
+            "ref": "main",
+            "state": {"state": "running", "url": None, "build_context": None, "git_hash": "a" * 40, "runner": None, "resources": None},
+        }
+        assert await changes.receive() == {"repo": "main", "ref": "dev", "state": None}
+        with pytest.raises(anyio.WouldBlock):
+            changes.receive_nowait()
+    assert book_snapshots.stats()["subscribers"] == 0
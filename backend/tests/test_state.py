@@ -1,7 +1,11 @@
+from whalesbook import placement, readiness, state
+from whalesbook.placement import Placement
 from whalesbook.state import get_new_refs, stop_containers
 from whalesbook.state import update_images, update_containers, delete_old_images, MainTag
 from whalesbook.docker import get_containers
-from pydantic import ValidationError
+from whalesbook.config import Book, ReadinessConfig, Repo, ResourceLimits, TraefikConfig
+from whalesbook.store import StateStore
+from pydantic import HttpUrl, ValidationError
 import logging
 import pytest
 
@@ -34,9 +38,8 @@ async def test_update(settings, registry):
 
     assert settings.docker_registry is not None
 
-    ref_pairs_to_update, outdated_registry_hashes = await get_new_refs(registry, book)
+    ref_pairs_to_update = await get_new_refs(registry, book)
     logger.debug(ref_pairs_to_update)
-    logger.debug(outdated_registry_hashes)
 
     await update_images(registry.url, book, ref_pairs_to_update, dry_run=False)
 
@@ -53,3 +56,278 @@ async def test_update(settings, registry):
     assert not containers[0]
 
     await delete_old_images(registry, book)
+
+
+async def test_ls_remote_all_dedup(monkeypatch):
+    calls = []
+
+    async def fake_ls_remote(repo_url, patterns=()):
+        calls.append(repo_url)
+        return [("a" * 40, "refs/heads/main")]
+
+    monkeypatch.setattr(state, "ls_remote", fake_ls_remote)
+    urls = ["https://example.com/a.git", "https://example.com/b.git"] * 3
+    remote_refs = await state.ls_remote_all(Repo(name="r", url=url) for url in urls)
+    assert sorted(calls) == sorted(set(urls))
+    assert remote_refs.keys() == set(urls)
+
+
+async def test_ref_patterns(monkeypatch):
+    async def fake_ls_remote(repo_url, patterns=()):
+        assert "refs/heads/feat-*" in patterns
+        return [
+            ("a" * 40, "refs/heads/main"),
+            ("b" * 40, "refs/heads/feat-one"),
+            ("c" * 40, "refs/heads/fix-two"),
+            ("d" * 40, "refs/pull/7/head"),
+        ]
+
+    monkeypatch.setattr(state, "ls_remote", fake_ls_remote)
+    book = Book(
+        name="patterns",
+        repos=[
+            Repo(
+                name="r",
+                url="https://example.com/patterns.git",
+                refs=["main", "feat-*", "refs/pull/*/head"],
+            )
+        ],
+    )
+    tracking_refs = await state.get_tracking_refs(book)
+    assert sorted((ref.subdomain_name, git_hash[0]) for _, ref, git_hash in tracking_refs) == [
+        ("feat-one", "b"),
+        ("main", "a"),
+        ("refs-pull-7-head", "d"),
+    ]
+
+
+async def test_update_containers_incremental(monkeypatch):
+    book = Book(
+        name="inc",
+        repos=[Repo(name="r", refs=["main", "dev", {"name": "feat", "resources": {"memory": "1g"}}, "moved"])],
+        placement="least_containers",
+        resources=ResourceLimits(cpus=0.5),
+    )
+    main_tag = "registry:5000/library/inc"
+    containers = [
+        {"ID": "keep", "State": "running", "Labels": f"whalesbook.main_tag={main_tag}:main,whalesbook.image_digest=sha256:m,whalesbook.resources=cpus=0.5"},
+        {"ID": "stale", "State": "running", "Labels": f"whalesbook.main_tag={main_tag}:dev,whalesbook.image_digest=sha256:old"},
+        {"ID": "gone", "State": "running", "Labels": f"whalesbook.main_tag={main_tag}:removed"},
+        # Up to date, but on a runner removed from the pool
+        {"ID": "away", "State": "running", "Labels": f"whalesbook.main_tag={main_tag}:moved,whalesbook.image_digest=sha256:v,whalesbook.resources=cpus=0.5", "DockerContext": "old"},
+    ]
+    for container in containers:
+        container.setdefault("DockerContext", "default")
+    started, stopped, limits = [], [], {}
+
+    class FakeRegistry:
+        url = HttpUrl("https://registry:5000")
+
+        async def get_digest(self, repository, tag):
+            return {"main": "sha256:m", "dev": "sha256:d", "feat": "sha256:f", "moved": "sha256:v"}.get(tag)
+
+    async def fake_get_containers_for_book(registry_url, book):
+        return containers
+
+    async def fake_get_tracking_refs(book, remote_refs=None):
+        return [(book.repos[0], ref, "1") for ref in book.repos[0].refs]
+
+    async def fake_run_container(image, network, name, restart, labels, pull, docker_context, resources, healthcheck):
+        started.append((image, docker_context))
+        limits[image] = resources
+        return "id", "", 0
+
+    async def fake_stop_container(identifier, docker_context="default", remove=True):
+        stopped.append(identifier)
+        return identifier, "", 0
+
+    monkeypatch.setattr(state, "get_containers_for_book", fake_get_containers_for_book)
+    monkeypatch.setattr(state, "get_tracking_refs", fake_get_tracking_refs)
+    monkeypatch.setattr(state.docker, "run_container", fake_run_container)
+    monkeypatch.setattr(state.docker, "stop_container", fake_stop_container)
+
+    report = await state.update_containers(FakeRegistry(), book)  # type: ignore
+    assert (report.kept, report.replaced, report.started, report.removed) == (1, 1, 1, 1)
+    assert report.migrated == 1
+    assert sorted(started) == [
+        (f"{main_tag}@sha256:d", "default"),
+        (f"{main_tag}@sha256:f", "default"),
+        (f"{main_tag}@sha256:v", "default"),
+    ]
+    assert sorted(stopped) == ["away", "gone", "stale"]
+    assert limits[f"{main_tag}@sha256:d"] == ResourceLimits(cpus=0.5)
+    assert limits[f"{main_tag}@sha256:f"] == ResourceLimits(cpus=0.5, memory="1g")
+
+
+async def test_wait_ready(monkeypatch):
+    book = Book(
+        name="ready",
+        traefik_config=TraefikConfig(port=3000),
+        readiness=ReadinessConfig(path="/health?full=1", timeout=1, interval=0.05),
+    )
+    check = readiness.healthcheck(book)
+    assert check["Test"] == [
+        "CMD-SHELL",
+        "wget -q -O /dev/null 'http://127.0.0.1:3000/health?full=1'"
+        " || curl -fsS -o /dev/null 'http://127.0.0.1:3000/health?full=1'",
+    ]
+    assert (check["Interval"], check["StartPeriod"]) == (50_000_000, 1_000_000_000)
+    slow = Book(name="slow", readiness=ReadinessConfig(interval=30))
+    assert readiness.healthcheck(slow)["Timeout"] == 5_000_000_000  # type: ignore
+    assert readiness.healthcheck(Book(name="b", readiness=ReadinessConfig(check="healthcheck"))) is None
+
+    # Health is read through the runner's engine, turning healthy on the third inspect
+    inspected = []
+
+    async def fake_inspect_container(identifier, docker_context="default"):
+        inspected.append(docker_context)
+        status = "healthy" if len(inspected) >= 3 else "starting"
+        return {"Id": "new", "State": {"Status": "running", "Running": True, "Health": {"Status": status}}}, "", 0
+
+    monkeypatch.setattr(readiness.docker, "inspect_container", fake_inspect_container)
+    assert await readiness.wait_ready(book, "new", "remote")
+    assert inspected == ["remote"] * 3
+
+    async def fake_inspect_exited(identifier, docker_context="default"):
+        return {"Id": "new", "State": {"Status": "exited", "Running": False}}, "", 0
+
+    monkeypatch.setattr(readiness.docker, "inspect_container", fake_inspect_exited)
+    assert not await readiness.wait_ready(book, "new", "remote")
+
+
+async def test_get_containers_by_book(monkeypatch):
+    listings = []
+
+    def container(main_tag: str, image: str):
+        return {"ID": main_tag, "Image": image, "Labels": f"whalesbook.main_tag={main_tag},other=x", "State": "running"}
+
+    async def fake_get_containers(labels, docker_context):
+        listings.append(docker_context)
+        if docker_context == "broken":
+            return "", "error", 1
+        return [
+            container("localhost:5000/library/book:main", "localhost:5000/library/book@sha256:1"),
+            # Prefix of another book's image no longer matches
+            container("localhost:5000/library/book-two:main", "localhost:5000/library/book-two:main"),
+            container("other:5000/library/book:main", "other:5000/library/book:main"),
+        ], "", 0
+
+    monkeypatch.setattr(state.docker, "get_containers", fake_get_containers)
+    books = [
+        Book(name="book"),
+        Book(name="book-two"),
+        Book(name="three"),
+        Book(name="far", runner="broken"),
+    ]
+    containers = await state.get_containers_by_book(HttpUrl("https://localhost:5000"), books)
+    assert sorted(listings) == ["broken", "default"]
+    assert [c["ID"] for c in containers["book"]] == ["localhost:5000/library/book:main"]
+    assert [c["ID"] for c in containers["book-two"]] == ["localhost:5000/library/book-two:main"]
+    assert containers["three"] == [] and "far" not in containers
+
+
+async def test_runner_pool(monkeypatch):
+    async def fake_get_containers(labels, docker_context):
+        if docker_context == "broken":
+            return "", "error", 1
+        main_tag = f"localhost:5000/library/pool:{docker_context}"
+        return [{"ID": docker_context, "Labels": f"whalesbook.main_tag={main_tag}", "State": "running"}], "", 0
+
+    monkeypatch.setattr(state.docker, "get_containers", fake_get_containers)
+    books = [Book(name="pool", runner=["one", "two"]), Book(name="half", runner=["one", "broken"])]
+    containers = await state.get_containers_by_book(HttpUrl("https://localhost:5000"), books)
+    assert sorted(c["DockerContext"] for c in containers["pool"]) == ["one", "two"]
+    assert "half" not in containers
+    with pytest.raises(ValidationError):
+        Book(name="empty", runner=[])
+
+    # Sticky placement only moves the refs of a removed runner
+    book = Book(name="pool", runner=["one", "two", "three"])
+    placed = {ref: Placement(book, {}).choose(ref) for ref in map(str, range(50))}
+    assert set(placed.values()) == {"one", "two", "three"}
+    book.runner = ["one", "two"]
+    for ref, runner in placed.items():
+        if runner != "three":
+            assert Placement(book, {}).choose(ref) == runner
+
+    async def fake_get_info(docker_context):
+        return {"ContainersRunning": {"one": 3, "two": 1}[docker_context], "MemTotal": 8}, "", 0
+
+    monkeypatch.setattr(placement.docker, "get_info", fake_get_info)
+    book = Book(name="pool", runner=["one", "two"], placement="least_containers")
+    pool = await Placement.load(book)
+    assert [pool.choose(ref) for ref in ("a", "b", "c")] == ["two", "two", "one"]
+    # Running refs stay unless their runner left the pool
+    assert pool.choose("d", "one") == "one" and pool.choose("e", "gone") == "two"
+
+
+async def test_delete_old_images_digests(monkeypatch):
+    book = Book(name="prune")
+    store = StateStore()
+    for tag in ("git-1", "git-old", "git-stuck"):
+        store.record_digest("prune", tag, f"sha256:{tag}")
+
+    class FakeRegistry:
+        url = HttpUrl("https://registry:5000")
+
+        async def get_tags(self, repository):
+            return ["main", "git-1", "git-old", "git-stuck"]
+
+        async def delete_tags(self, repository, tags):
+            assert tags == ["git-old", "git-stuck"]
+            return ["git-stuck"]
+
+    async def fake_get_tracking_refs(book, remote_refs=None):
+        return [(book.repos[0], book.repos[0].refs[0], "1")]
+
+    async def fake_get_images(labels, docker_context):
+        return "", "", 1
+
+    monkeypatch.setattr(state, "store", store)
+    monkeypatch.setattr(state, "get_tracking_refs", fake_get_tracking_refs)
+    monkeypatch.setattr(state.docker, "get_images", fake_get_images)
+    await delete_old_images(FakeRegistry(), book)  # type: ignore
+    # Only tags actually deleted from the registry lose their digest
+    assert store.get_digests("prune") == {"git-1": "sha256:git-1", "git-stuck": "sha256:git-stuck"}
+
+
+async def test_oom_killed_state(monkeypatch):
+    book = Book(name="oom", repos=[Repo(name="r", refs=["main", "dev"])])
+    main_tag = "localhost:5000/library/oom"
+
+    def container(sub: str):
+        labels = f"whalesbook.main_tag={main_tag}:{sub},whalesbook.build_context=x,whalesbook.resources=memory=64m;pids=10"
+        return {"ID": sub, "State": "exited", "Labels": labels, "DockerContext": "default"}
+
+    inspected = []
+
+    async def fake_inspect_container(identifier, docker_context):
+        inspected.append(identifier)
+        return {"State": {"OOMKilled": identifier == "main"}}, "", 0
+
+    def die_event(sub: str):
+        return {
+            "Action": "die",
+            "Actor": {"ID": sub, "Attributes": {"whalesbook.main_tag": f"{main_tag}:{sub}"}},
+        }
+
+    monkeypatch.setattr(state, "store", StateStore())
+    monkeypatch.setattr(state.docker, "inspect_container", fake_inspect_container)
+    await state.record_exit(book, die_event("main"), "default")
+    await state.record_exit(book, die_event("dev"), "default")
+    for _ in range(2):
+        states = await state.get_refs_state(
+            HttpUrl("https://localhost:5000"), book, [container("main"), container("dev")]
+        )
+    # Only die events inspect containers, refreshes read the store
+    assert inspected == ["main", "dev"]
+    assert states["r"]["refs/heads/main"].state == "oom_killed"
+    assert states["r"]["refs/heads/dev"].state == "stopped"
+    assert states["r"]["refs/heads/main"].resources == ResourceLimits(memory="64m", pids=10)
+    assert state.docker.resource_host_config(ResourceLimits(cpus=1.5, memory="64m", pids=10)) == {
+        "NanoCpus": 1_500_000_000,
+        "Memory": 64 * 1024**2,
+        "PidsLimit": 10,
+    }
+    with pytest.raises(ValidationError):
+        ResourceLimits(memory="lots")
@@ -0,0 +1,41 @@
+from whalesbook.store import StateStore
+
+
+def test_state_store(tmp_path):
+    path = tmp_path / "state.sqlite3"
+    store = StateStore(path)
+    store.record_refs("book", [("repo", "main", "main", "a" * 40)])
+    store.record_build("book", "main", "a" * 40, "building")
+    store.record_build("book", "main", "a" * 40, "success", 3, 5)
+    store.record_digest("book", "main", "sha256:1")
+    store.record_digest("book", "git-old", "sha256:0")
+    store.record_digest("book", "git-old", None)
+    store.record_container("book", "main", "abc", "sha256:1", "default")
+    store.record_oom_kill("book", "main", "abc")
+
+    # Survives reopening
+    store.open(path)
+    assert [ref["hash"] for ref in store.get_refs("book")] == ["a" * 40]
+    build = store.get_builds("book")["main"]
+    assert build["status"] == "success"
+    assert (build["cached_steps"], build["total_steps"]) == (3, 5)
+    assert build["finished_at"] >= build["started_at"]
+    assert store.get_digests("book") == {"main": "sha256:1"}
+    assert store.get_containers("book")["main"]["container_id"] == "abc"
+    assert store.get_oom_kills("book") == {"main": "abc"}
+
+    # Moving main and dropping dev prunes their old commit, build and digests
+    store.record_refs("book", [("repo", "main", "main", "a" * 40), ("repo", "dev", "dev", "b" * 40)])
+    store.record_build("book", "dev", "b" * 40, "success")
+    store.record_digest("book", "dev", "sha256:2")
+    store.record_digest("book", f"git-{'a' * 40}", "sha256:1")
+    store.record_digest("book", f"git-{'b' * 40}", "sha256:2")
+    store.record_refs("book", [("repo", "main", "main", "c" * 40)])
+    assert store.get_digests("book") == {"main": "sha256:1"}
+    assert list(store.get_builds("book")) == ["main"]
+
+    store.record_refs("book", [])
+    store.remove_container("book", "main")
+    assert store.get_refs("book") == [] and store.get_containers("book") == {}
+    assert store.get_oom_kills("book") == {}
+    assert store.get_refs("other") == []
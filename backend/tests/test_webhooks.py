@@ -0,0 +1,90 @@
+import hashlib
+import hmac
+import json
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from whalesbook import config, server
+from whalesbook.config import Book, Repo, Settings, WebhookConfig
+from whalesbook.webhooks import normalize_repo_url
+
+
+def test_normalize_repo_url():
+    assert (
+        normalize_repo_url("https://GitHub.com/Owner/Repo.git")
+        == normalize_repo_url("git@github.com:owner/repo.git")
+        == normalize_repo_url("ssh://git@github.com/owner/repo/")
+        == "github.com/owner/repo"
+    )
+
+
+def test_webhook(monkeypatch):
+    updates = []
+
+    async def fake_update_pushed_ref(registry, book, repo, ref_name, git_hash):
+        updates.append((book.name, repo.name, ref_name, git_hash))
+
+    monkeypatch.setattr(server, "update_pushed_ref", fake_update_pushed_ref)
+    monkeypatch.setattr(
+        config,
+        "settings",
+        Settings(
+            webhook=WebhookConfig(secret="secret"),
+            books=[
+                Book(name="a", repos=[Repo(name="r", url="https://github.com/o/r.git", refs=["main", "feat/*"])]),
+                Book(name="b", repos=[Repo(name="r", url="git@github.com:o/r.git")]),
+                Book(name="c", repos=[Repo(name="r", url="https://github.com/o/other.git")]),
+            ],
+        ),
+    )
+    app = FastAPI()
+    app.include_router(server.router)
+    app.state.registry = object()
+    client = TestClient(app)
+
+    payload = {
+        "ref": "refs/heads/feat/x",
+        "after": "a" * 40,
+        "repository": {"clone_url": "https://github.com/o/r.git"},
+    }
+    body = json.dumps(payload).encode()
+    signature = hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+
+    # GitHub, only book a tracks the feature branch
+    resp = client.post(
+        "/webhook",
+        content=body,
+        headers={"X-GitHub-Event": "push", "X-Hub-Signature-256": f"sha256={signature}"},
+    )
+    assert resp.status_code == 202 and resp.json() == ["a"]
+    assert updates == [("a", "r", "refs/heads/feat/x", "a" * 40)]
+
+    # Gitea also sends GitHub headers, its own signature wins
+    resp = client.post(
+        "/webhook",
+        content=body,
+        headers={"X-Gitea-Event": "push", "X-GitHub-Event": "push", "X-Gitea-Signature": "bad"},
+    )
+    assert resp.status_code == 401
+
+    # GitLab branch deletion on the default branch
+    payload = {
+        "ref": "refs/heads/main",
+        "after": "0" * 40,
+        "project": {"git_ssh_url": "git@github.com:o/r.git"},
+    }
+    updates.clear()
+    resp = client.post(
+        "/webhook",
+        content=json.dumps(payload),
+        headers={"X-Gitlab-Event": "Push Hook", "X-Gitlab-Token": "secret"},
+    )
+    assert resp.json() == ["a", "b"]
+    assert [update[0] for update in updates] == ["a", "b"] and updates[0][3] is None
+
+    # Other events are acknowledged and ignored
+    resp = client.post(
+        "/webhook",
+        content=b"{}",
+        headers={"X-GitHub-Event": "ping", "X-Hub-Signature-256": "sha256=" + hmac.new(b"secret", b"{}", hashlib.sha256).hexdigest()},
+    )
+    assert resp.status_code == 202 and resp.json() == []
@@ -0,0 +1,35 @@
+import type { Ref } from "vue";
+import type { GetBookStateResponse, RefState } from "@/client";
+import type { AsyncState } from "@/utils/state";
+
+type RefChange = { repo: string; ref: string; state: RefState | null };
+
+// Initial snapshot then ref state changes, EventSource reconnects by itself
+export function streamBookState(
+  bookName: string,
+  asyncState: Ref<AsyncState<GetBookStateResponse>>,
+) {
+  if (asyncState.value?.state !== "ready")
+    asyncState.value = { state: "loading", data: null };
+
+  const source = new EventSource(
+    `/api/v1/books/${encodeURIComponent(bookName)}/state/stream`,
+  );
+  source.addEventListener("snapshot", (event) => {
+    asyncState.value = { state: "ready", data: JSON.parse(event.data) };
+  });
+  source.addEventListener("ref", (event) => {
+    if (asyncState.value.state !== "ready") return;
+    const change: RefChange = JSON.parse(event.data);
+    const refs = (asyncState.value.data[change.repo] ??= {});
+    if (change.state) refs[change.ref] = change.state;
+    else delete refs[change.ref];
+  });
+  source.onerror = (error) => {
+    if (asyncState.value.state !== "ready")
+      asyncState.value = { state: "error", data: null, error };
+    console.error(error);
+  };
+
+  return () => source.close();
+}